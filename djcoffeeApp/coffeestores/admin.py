@@ -7,3 +7,5 @@ admin.site.register(models.Descriptor)
 admin.site.register(models.CoffeeShop)
 admin.site.register(models.CoffeeDrink)
 admin.site.register(models.Review)
+admin.site.register(models.Job)
+admin.site.register(models.Blob)
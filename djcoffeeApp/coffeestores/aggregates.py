@@ -0,0 +1,160 @@
+import math
+from collections import defaultdict
+from decimal import Decimal
+
+from django.apps import apps as global_apps
+from django.db.models import Count, Sum
+from django.db.models.functions import Floor
+from django.utils import timezone
+
+from coffeestores import models
+
+
+FIELDS = ['review_count', 'rating_sum', 'rating_mean', 'rating_histogram']
+
+
+def get_mean(total, count):
+    if not count:
+        return Decimal(0)
+    return (Decimal(total) / count).quantize(Decimal('0.01'))
+
+
+def set_ratings(instance, count, total, histogram):
+    instance.review_count = count
+    instance.rating_sum = total
+    instance.rating_mean = get_mean(total, count)
+    instance.rating_histogram = histogram
+
+
+def get_bucket(rating):
+    # Floored, like the Floor() buckets of rebuild_ratings
+    return str(math.floor(rating))
+
+
+def apply_rating(instance, rating, delta):
+    bucket = get_bucket(rating)
+    histogram = dict(instance.rating_histogram or {})
+    histogram[bucket] = histogram.get(bucket, 0) + delta
+    if histogram[bucket] <= 0:
+        del histogram[bucket]
+
+    count = instance.review_count + delta
+    if count <= 0:
+        # Reviews written around the API were never counted,
+        # rebuild_ratings puts them back
+        set_ratings(instance, 0, Decimal(0), {})
+    else:
+        set_ratings(instance, count, instance.rating_sum + Decimal(rating) * delta,
+                    histogram)
+
+
+def update_ratings(changes):
+    # changes are (drink_id, rating, +1 or -1), call inside a transaction
+    changes = [change for change in changes if change[0] is not None]
+    drinks = models.CoffeeDrink.objects.select_for_update().in_bulk(
+        {drink_id for drink_id, rating, delta in changes})
+    shops = models.CoffeeShop.objects.select_for_update().in_bulk(
+        {drink.shop_id for drink in drinks.values()})
+    for drink_id, rating, delta in changes:
+        if drink_id not in drinks:
+            continue
+        drink = drinks[drink_id]
+        apply_rating(drink, rating, delta)
+        apply_rating(shops[drink.shop_id], rating, delta)
+
+    for instance in [*drinks.values(), *shops.values()]:
+        instance.save(update_fields=[*FIELDS, 'updated_at'])
+
+
+def add_drink(shop, drink, sign):
+    histogram = dict(shop.rating_histogram or {})
+    for bucket, count in (drink.rating_histogram or {}).items():
+        histogram[bucket] = histogram.get(bucket, 0) + sign * count
+        if histogram[bucket] <= 0:
+            del histogram[bucket]
+    count = shop.review_count + sign * drink.review_count
+    if count <= 0:
+        set_ratings(shop, 0, Decimal(0), {})
+    else:
+        set_ratings(shop, count, shop.rating_sum + sign * drink.rating_sum, histogram)
+
+
+def move_drinks(moves):
+    # moves are (drink, shop id before, shop id after), None for no shop as
+    # when the drink is deleted. The drink's ratings go along with it, call
+    # inside the transaction of the write with the drink row locked
+    moves = [(drink, before, after) for drink, before, after in moves
+             if before != after and drink.review_count]
+    if not moves:
+        return
+    shops = models.CoffeeShop.objects.select_for_update().in_bulk(
+        {shop_id for drink, before, after in moves for shop_id in (before, after)
+         if shop_id is not None})
+    for drink, before, after in moves:
+        if before in shops:
+            add_drink(shops[before], drink, -1)
+        if after in shops:
+            add_drink(shops[after], drink, 1)
+    for shop in shops.values():
+        shop.save(update_fields=[*FIELDS, 'updated_at'])
+
+
+def batches(queryset, batch_size):
+    # Keyset batches, safe to write to the table between them
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1].pk
+
+
+def get_changed(instances, old_values):
+    # Instances whose ratings differ from old_values, marked as updated when
+    # the model tracks it. Models of older migrations may not
+    changed = [instance for instance, old in zip(instances, old_values)
+               if [getattr(instance, field) for field in FIELDS] != old]
+    fields = FIELDS
+    if any(field.name == 'updated_at' for field in type(instances[0])._meta.fields):
+        fields = [*FIELDS, 'updated_at']
+        now = timezone.now()
+        for instance in changed:
+            instance.updated_at = now
+    return changed, fields
+
+
+def rebuild_ratings(batch_size=1000, apps=global_apps):
+    CoffeeDrink = apps.get_model('coffeestores', 'CoffeeDrink')
+    CoffeeShop = apps.get_model('coffeestores', 'CoffeeShop')
+    Review = apps.get_model('coffeestores', 'Review')
+
+    drink_stats = defaultdict(lambda: [0, Decimal(0), {}])
+    rows = Review.objects.filter(drink__isnull=False).order_by().values(
+        'drink_id', bucket=Floor('overall_rating')).annotate(
+        count=Count('id'), total=Sum('overall_rating'))
+    for row in rows:
+        stats = drink_stats[row['drink_id']]
+        stats[0] += row['count']
+        stats[1] += Decimal(row['total'])
+        stats[2][get_bucket(row['bucket'])] = row['count']
+
+    shop_stats = defaultdict(lambda: [0, Decimal(0), {}])
+    for drinks in batches(CoffeeDrink.objects.only('id', 'shop_id', *FIELDS), batch_size):
+        old_values = [[getattr(drink, field) for field in FIELDS] for drink in drinks]
+        for drink in drinks:
+            count, total, histogram = drink_stats.get(drink.id, (0, Decimal(0), {}))
+            set_ratings(drink, count, total, histogram)
+            stats = shop_stats[drink.shop_id]
+            stats[0] += count
+            stats[1] += total
+            for bucket, bucket_count in histogram.items():
+                stats[2][bucket] = stats[2].get(bucket, 0) + bucket_count
+        CoffeeDrink.objects.bulk_update(*get_changed(drinks, old_values))
+
+    for shops in batches(CoffeeShop.objects.only('id', *FIELDS), batch_size):
+        old_values = [[getattr(shop, field) for field in FIELDS] for shop in shops]
+        for shop in shops:
+            set_ratings(shop, *shop_stats.get(shop.id, (0, Decimal(0), {})))
+        CoffeeShop.objects.bulk_update(*get_changed(shops, old_values))
+    return len(drink_stats), len(shop_stats)
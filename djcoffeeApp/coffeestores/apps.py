@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CoffeestoresConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'coffeestores'
+
+    def ready(self):
+        from coffeestores import signals, tasks
@@ -0,0 +1,64 @@
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt import models as jwt_models
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from coffeestores import models, revocations, roles
+
+
+def get_tokens(user):
+    token = RefreshToken.for_user(user)
+    token['username'] = user.username
+    return {'refresh': str(token), 'access': str(token.access_token)}
+
+
+class TokenUser(jwt_models.TokenUser):
+    # Id and username come from the token, roles and flags from the roles
+    # cache. The CoffeeDrinker row is loaded by the code that needs it
+    @cached_property
+    def id(self):
+        # Tokens carry the id as a string
+        return int(self.token[api_settings.USER_ID_CLAIM])
+
+    @cached_property
+    def identity(self):
+        return roles.get_identity(self.id)
+
+    @property
+    def is_active(self):
+        return self.identity['is_active']
+
+    @property
+    def is_staff(self):
+        return self.identity['is_staff']
+
+    @property
+    def is_superuser(self):
+        return self.identity['is_superuser']
+
+    @cached_property
+    def drinker(self):
+        return models.CoffeeDrinker.objects.get(id=self.id)
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    # No user query per request, the cached identity tells deleted and
+    # inactive users apart
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        if revocations.is_revoked(token[api_settings.JTI_CLAIM]):
+            raise InvalidToken(_('Token is revoked'))
+        return token
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+        user = TokenUser(validated_token)
+        if not user.identity['exists']:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return user
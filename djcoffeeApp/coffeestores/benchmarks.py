@@ -0,0 +1,307 @@
+import random
+import time
+
+from django.contrib.auth.hashers import get_hasher, make_password
+from django.contrib.auth.models import Group
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from coffeestores import (descriptors, geo, models, paginators, responses, roles, search,
+                          throttling, views)
+
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def timed(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+@scenario('pagination')
+def pagination(stdout, size=100000, repeat=20):
+    models.CoffeeShop.objects.bulk_create(
+        [models.CoffeeShop(name='shop%06d' % i, address='addr%d' % i)
+         for i in range(size)], batch_size=5000)
+    view = views.CoffeeShopViewSet.as_view(actions={'get': 'list'})
+    factory = APIRequestFactory()
+    last_page = (size - 1) // paginators.CoffeeShopPaginator.page_size + 1
+    deep_page = min(10000, last_page)
+
+    # Cursor of the row just before the deep page, as a client would get it
+    # after following `next` links from the first page.
+    boundary = models.CoffeeShop.objects.order_by('name', 'id')[
+        (deep_page - 1) * paginators.KeysetPaginator.page_size - 1]
+    deep_cursor = paginators.KeysetPaginator().encode_cursor([boundary.name, boundary.id])
+
+    cases = [
+        ('page', 1, {'ordering': 'name', 'page': 1}),
+        ('page', deep_page, {'ordering': 'name', 'page': deep_page}),
+        ('cursor', 1, {'ordering': 'name', 'pagination': 'cursor'}),
+        ('cursor', deep_page, {'ordering': 'name', 'cursor': deep_cursor}),
+        ('cursor, skip_count', deep_page,
+         {'ordering': 'name', 'cursor': deep_cursor, 'skip_count': 1}),
+    ]
+    stdout.write('%d shops, median of %d runs' % (size, repeat))
+
+    def get(query):
+        # Built every time, not served from the response cache
+        responses.clear()
+        view(factory.get('/shops/', query)).render()
+
+    for mode, page, query in cases:
+        ms = timed(lambda: get(query), repeat)
+        stdout.write('  %-20s page %-6d %8.2f ms' % (mode, page, ms))
+
+
+@scenario('bulk_menu')
+def bulk_menu(stdout, size=1000, repeat=3):
+    owner = models.CoffeeDrinker.objects.create(username='benchmark-owner')
+    owner.groups.add(Group.objects.get_or_create(name=roles.SHOP_OWNER)[0])
+    shop = models.CoffeeShop.objects.create(name='shop', address='addr', owner=owner)
+    menu = [{'shop': shop.id, 'name': 'drink%d' % i, 'price': '2.50', 'volume': 100 + i}
+            for i in range(size)]
+    factory = APIRequestFactory()
+
+    def post(view, data):
+        request = factory.post('/drink/', data, format='json')
+        force_authenticate(request, user=owner)
+        response = view(request)
+        assert response.status_code == 201, response.data
+
+    single = views.CoffeeDrinkViewSet.as_view(actions={'post': 'create'})
+    bulk = views.CoffeeDrinkViewSet.as_view(actions={'post': 'bulk_create'})
+    cases = [
+        ('one request per drink', lambda: [post(single, item) for item in menu]),
+        ('drink/bulk', lambda: post(bulk, menu)),
+    ]
+    stdout.write('%d-item menu, median of %d runs' % (size, repeat))
+    for name, func in cases:
+        ms = timed(func, repeat)
+        stdout.write('  %-22s %10.1f ms %10.0f items/s' % (name, ms, size / ms * 1000))
+
+
+@scenario('descriptor_search')
+def descriptor_search(stdout, size=1000000, repeat=20):
+    # size is the number of reviews, each naming 3 of 100 leaf descriptors
+    rng = random.Random(0)
+    roots = [models.Descriptor.objects.create(name='root%d' % i) for i in range(10)]
+    middle = [models.Descriptor.objects.create(name='%s-%d' % (root.name, i), parent=root)
+              for root in roots for i in range(10)]
+    leaves = [descriptor.id for descriptor in middle]
+    shop = models.CoffeeShop.objects.create(name='shop', address='addr')
+    drinks = models.CoffeeDrink.objects.bulk_create(
+        [models.CoffeeDrink(name='drink%d' % i, price='2.50', volume=100, shop=shop)
+         for i in range(1000)])
+    for start in range(0, size, 10000):
+        reviews = models.Review.objects.bulk_create(
+            [models.Review(drink=rng.choice(drinks), overall_rating=3,
+                           descriptors={str(descriptor_id): rng.randint(1, 5)
+                                        for descriptor_id in rng.sample(leaves, 3)})
+             for _ in range(min(10000, size - start))])
+        descriptors.index_reviews(reviews, replace=False)
+
+    view = views.CoffeeDrinkViewSet.as_view(actions={'get': 'search'})
+    factory = APIRequestFactory()
+    cases = [
+        ('leaf', {'descriptor': middle[0].id}),
+        ('leaf, min_intensity', {'descriptor': middle[0].id, 'min_intensity': 4}),
+        ('subtree', {'descriptor': roots[0].id}),
+        ('subtree, page 10', {'descriptor': roots[0].id, 'page': 10}),
+    ]
+    stdout.write('%d reviews, %d index rows, median of %d runs'
+                 % (size, models.ReviewDescriptor.objects.count(), repeat))
+    for name, query in cases:
+        ms = timed(lambda: view(factory.get('/drinks/search', query)).render(), repeat)
+        stdout.write('  %-22s %8.2f ms' % (name, ms))
+
+
+@scenario('search')
+def search_scan(stdout, size=200000, repeat=20):
+    # size is the number of reviews, with a tenth as many shops and drinks
+    rng = random.Random(0)
+    words = ['%s%s' % (rng.choice(['choco', 'berr', 'nut', 'flor', 'roast', 'cit']),
+                       ''.join(rng.choice('abcdefghij') for _ in range(4)))
+             for _ in range(5000)]
+
+    def text(count):
+        return ' '.join(rng.choice(words) for _ in range(count))
+
+    shops = models.CoffeeShop.objects.bulk_create(
+        [models.CoffeeShop(name=text(2), address=text(3)) for _ in range(size // 10)],
+        batch_size=5000)
+    drinks = models.CoffeeDrink.objects.bulk_create(
+        [models.CoffeeDrink(name=text(2), price='2.50', volume=100, shop=rng.choice(shops))
+         for _ in range(size // 10)], batch_size=5000)
+    reviews = models.Review.objects.bulk_create(
+        [models.Review(drink=rng.choice(drinks), notes=text(12), overall_rating=3)
+         for _ in range(size)], batch_size=5000)
+    for kind, instances in [('shop', shops), ('drink', drinks), ('review', reviews)]:
+        for start in range(0, len(instances), 5000):
+            search.index_objects(kind, instances[start:start + 5000])
+
+    def scan(term):
+        # What the API could do without an index
+        return [*models.CoffeeShop.objects.filter(name__icontains=term)[:20],
+                *models.CoffeeDrink.objects.filter(name__icontains=term)[:20],
+                *models.Review.objects.filter(notes__icontains=term)[:20]]
+
+    view = views.SearchViewSet.as_view(actions={'get': 'search'})
+    factory = APIRequestFactory()
+    word = words[0]
+    rare = word[:5] + 'zzzz'
+    typo = word[:3] + word[4:]
+    cases = [
+        ('icontains, word', lambda: scan(word)),
+        ('icontains, no match', lambda: scan(rare)),
+        ('/search, word', lambda: view(factory.get('/search', {'q': word})).render()),
+        ('/search, prefix', lambda: view(factory.get('/search', {'q': word[:5]})).render()),
+        ('/search, typo', lambda: view(factory.get('/search', {'q': typo})).render()),
+        ('/search, no match', lambda: view(factory.get('/search', {'q': rare})).render()),
+    ]
+    stdout.write('%d reviews, %d shops, %d drinks, median of %d runs'
+                 % (size, len(shops), len(drinks), repeat))
+    for name, func in cases:
+        stdout.write('  %-22s %8.2f ms' % (name, timed(func, repeat)))
+
+
+@scenario('nearby')
+def nearby(stdout, size=100000, repeat=20):
+    # Shops spread over a 100 x 100 km area
+    rng = random.Random(0)
+    models.CoffeeShop.objects.bulk_create(
+        [models.CoffeeShop(name='shop%d' % i, address='addr', latitude=lat, longitude=lon,
+                           geohash=geo.get_geohash(lat, lon))
+         for i, (lat, lon) in enumerate((55.3 + rng.random() * 0.9, 37.0 + rng.random() * 1.6)
+                                        for _ in range(size))], batch_size=5000)
+    queryset = models.CoffeeShop.objects.exclude(latitude=None)
+
+    def scan(radius):
+        # Exact distance to every shop, no buckets
+        found = [(geo.distance(55.75, 37.62, lat, lon), shop_id) for shop_id, lat, lon
+                 in queryset.values_list('id', 'latitude', 'longitude')]
+        return sorted(item for item in found if item[0] <= radius)
+
+    view = views.CoffeeShopViewSet.as_view(actions={'get': 'nearby'})
+    factory = APIRequestFactory()
+    stdout.write('%d shops, median of %d runs' % (size, repeat))
+    for radius in [1, 5, 20]:
+        query = {'lat': 55.75, 'lon': 37.62, 'radius': radius}
+        stdout.write('  radius %2d km  full scan %8.2f ms  /shops/nearby %8.2f ms' % (
+            radius, timed(lambda: scan(radius), repeat),
+            timed(lambda: view(factory.get('/shops/nearby', query)).render(), repeat)))
+
+
+@scenario('response_cache')
+def response_cache(stdout, size=10000, repeat=20):
+    shops = models.CoffeeShop.objects.bulk_create(
+        [models.CoffeeShop(name='shop%d' % i, address='addr') for i in range(size)],
+        batch_size=5000)
+    models.CoffeeDrink.objects.bulk_create(
+        [models.CoffeeDrink(name='drink%d' % i, price='2.50', volume=100, shop=shop)
+         for shop in shops for i in range(5)], batch_size=5000)
+    drink_id = models.CoffeeDrink.objects.values_list('id', flat=True).last()
+    shop_list = views.CoffeeShopViewSet.as_view(actions={'get': 'list'})
+    drink = views.CoffeeDrinkViewSet.as_view(actions={'get': 'get'})
+    factory = APIRequestFactory()
+
+    def uncached(view, path, query):
+        responses.clear()
+        view(factory.get(path, query)).render()
+
+    cases = [
+        ('/shops/ page 1', shop_list, '/shops/', {'ordering': 'name'}),
+        ('/shops/ page 500', shop_list, '/shops/', {'ordering': 'name', 'page': 500}),
+        ('/drink/', drink, '/drink/', {'id': drink_id}),
+    ]
+    stdout.write('%d shops with 5 drinks each, median of %d runs' % (size, repeat))
+    for name, view, path, query in cases:
+        stdout.write('  %-18s uncached %8.2f ms  cached %8.2f ms' % (
+            name, timed(lambda: uncached(view, path, query), repeat),
+            timed(lambda: view(factory.get(path, query)).render(), repeat)))
+
+
+@scenario('conditional')
+def conditional(stdout, size=100000, repeat=20):
+    shops = models.CoffeeShop.objects.bulk_create(
+        [models.CoffeeShop(name='shop%d' % i, address='addr') for i in range(size)],
+        batch_size=5000)
+    models.CoffeeDrink.objects.bulk_create(
+        [models.CoffeeDrink(name='drink', price='2.50', volume=100, shop=shop)
+         for shop in shops[:size // 10] for _ in range(5)], batch_size=5000)
+    shop_list = views.CoffeeShopViewSet.as_view(actions={'get': 'list'})
+    drink = views.CoffeeDrinkViewSet.as_view(actions={'get': 'get'})
+    factory = APIRequestFactory()
+
+    def get(view, path, query, **headers):
+        # Not served from the response cache
+        responses.clear()
+        response = view(factory.get(path, query, **headers))
+        return response.render() if hasattr(response, 'render') else response
+
+    cases = [
+        ('/shops/', shop_list, '/shops/', {'ordering': 'name'}),
+        ('/shops/?id=', shop_list, '/shops/', {'id': shops[0].id}),
+        ('/drink/', drink, '/drink/', {'id': models.CoffeeDrink.objects.last().id}),
+    ]
+    stdout.write('%d shops, median of %d runs' % (size, repeat))
+    for name, view, path, query in cases:
+        response = get(view, path, query)
+        etag = response['ETag']
+        stdout.write('  %-12s 200 %8.2f ms %6d bytes  304 %8.2f ms' % (
+            name, timed(lambda: get(view, path, query), repeat), len(response.content),
+            timed(lambda: get(view, path, query, HTTP_IF_NONE_MATCH=etag), repeat)))
+
+
+
+@scenario('login')
+def login(stdout, size=100, repeat=20):
+    # One request at a time, so logins/s is what a single core sustains
+    hasher = get_hasher()
+    current = make_password('password')
+    legacy = make_password('password', hasher='pbkdf2_sha1')
+    # Multi-table inheritance rules out bulk_create
+    users = [models.CoffeeDrinker.objects.create(username='benchmark-login%d' % i,
+                                                 password=current) for i in range(size)]
+    users += [models.CoffeeDrinker.objects.create(username='benchmark-legacy%d' % i,
+                                                  password=legacy) for i in range(repeat)]
+    view = views.AuthViewSet.as_view(actions={'post': 'login'})
+    factory = APIRequestFactory()
+
+    def post(users, password, expected):
+        user = users.pop(0)
+        users.append(user)
+        response = view(factory.post('/auth/login',
+                                     {'username': user.username, 'password': password},
+                                     format='json'))
+        assert response.status_code == expected, response.status_code
+
+    def report(name, func):
+        ms = timed(func, repeat)
+        stdout.write('  %-18s %8.2f ms  %8.1f logins/s per core' % (name, ms, 1000 / ms))
+
+    logins, upgrades = users[:size], users[size:]
+    stdout.write('%s, %d iterations, median of %d runs'
+                 % (hasher.algorithm, hasher.iterations, repeat))
+    with override_settings(LOGIN_FAILURES_PER_IP=10 ** 9):
+        report('login', lambda: post(logins, 'password', 200))
+        # Each user once, the login upgrades their hash
+        report('login and rehash', lambda: post(upgrades, 'password', 200))
+        report('wrong password', lambda: post(logins, 'wrong', 401))
+    # Every address over its limit
+    with override_settings(LOGIN_FAILURES_PER_IP=0):
+        report('throttled', lambda: post(logins, 'password', 429))
+    for user in users:
+        throttling.reset(user.username)
@@ -0,0 +1,165 @@
+import hashlib
+import json
+
+from django.apps import apps as global_apps
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Q, Value
+from django.db.models.functions import Concat, Substr
+
+from coffeestores import aggregates, models
+
+
+TREE_CACHE_KEY = 'descriptors:tree'
+CACHE_TIMEOUT = 24 * 60 * 60
+NODE_FIELDS = ['id', 'name', 'description', 'color', 'parent_id']
+
+
+def get_path(parent_path, descriptor_id):
+    return '%s%d/' % (parent_path, descriptor_id)
+
+
+def subtree_filter(path, prefix=''):
+    # A range rather than startswith so any backend can use the index,
+    # '0' sorts right after '/'
+    return Q(**{prefix + 'path__gte': path, prefix + 'path__lt': path[:-1] + '0'})
+
+
+def get_paths(descriptor):
+    # (current path in the database, path of the new parent)
+    ids = [pk for pk in (descriptor.pk, descriptor.parent_id) if pk is not None]
+    paths = dict(models.Descriptor.objects.filter(id__in=ids).values_list('id', 'path'))
+    parent_path = paths.get(descriptor.parent_id, '')
+    if descriptor.pk is not None and str(descriptor.pk) in parent_path.split('/'):
+        raise ValidationError({'parent': 'A descriptor cannot be its own ancestor'})
+    return paths.get(descriptor.pk, ''), parent_path
+
+
+def move(descriptor, old_path, parent_path):
+    path = get_path(parent_path, descriptor.pk)
+    if path != old_path:
+        if old_path:
+            models.Descriptor.objects.filter(subtree_filter(old_path)).update(
+                path=Concat(Value(path), Substr('path', len(old_path) + 1)))
+        else:
+            models.Descriptor.objects.filter(id=descriptor.pk).update(path=path)
+    descriptor.path = path
+
+
+def rebuild_paths(batch_size=1000, apps=global_apps):
+    Descriptor = apps.get_model('coffeestores', 'Descriptor')
+    parents = dict(Descriptor.objects.values_list('id', 'parent_id'))
+    paths = {}
+
+    def resolve(descriptor_id):
+        chain = []
+        while descriptor_id is not None and descriptor_id not in paths:
+            if descriptor_id in chain:
+                # Cycles left over from before paths existed become roots
+                parents[descriptor_id] = None
+                chain.remove(descriptor_id)
+                chain.append(descriptor_id)
+                break
+            chain.append(descriptor_id)
+            descriptor_id = parents.get(descriptor_id)
+        for chain_id in reversed(chain):
+            paths[chain_id] = get_path(paths.get(parents[chain_id], ''), chain_id)
+
+    descriptors = []
+    for descriptor_id in parents:
+        resolve(descriptor_id)
+        descriptors.append(Descriptor(id=descriptor_id, path=paths[descriptor_id]))
+    Descriptor.objects.bulk_update(descriptors, ['path'], batch_size=batch_size)
+    return len(descriptors)
+
+
+def build_tree(rows):
+    nodes = {}
+    for row in rows:
+        nodes[row['id']] = {'id': row['id'], 'name': row['name'],
+                            'description': row['description'], 'color': row['color'],
+                            'parent': row['parent_id'], 'children': []}
+    roots = []
+    for node in nodes.values():
+        parent = nodes.get(node['parent'])
+        (parent['children'] if parent else roots).append(node)
+    content = json.dumps(roots, sort_keys=True).encode()
+    return {'etag': hashlib.md5(content, usedforsecurity=False).hexdigest(),
+            'roots': roots, 'nodes': nodes}
+
+
+def get_tree():
+    tree = cache.get(TREE_CACHE_KEY)
+    if tree is None:
+        tree = build_tree(models.Descriptor.objects.order_by('id').values(*NODE_FIELDS))
+        cache.set(TREE_CACHE_KEY, tree, CACHE_TIMEOUT)
+    return tree
+
+
+def get_subtree_ids(descriptor_ids):
+    # The descriptors and their descendants, by path ranges on the index
+    paths = models.Descriptor.objects.filter(id__in=descriptor_ids).exclude(
+        path='').values_list('path', flat=True)
+    subtrees = Q(pk__in=[])
+    for path in paths:
+        subtrees |= subtree_filter(path)
+    return set(models.Descriptor.objects.filter(subtrees).values_list('id', flat=True))
+
+
+def invalidate():
+    cache.delete(TREE_CACHE_KEY)
+
+
+def parse_review_descriptors(value):
+    # Reviews store either a list of descriptor ids or {id: intensity}
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = [(descriptor_id, None) for descriptor_id in value]
+    else:
+        return {}
+    parsed = {}
+    for descriptor_id, intensity in items:
+        if str(descriptor_id).isdigit():
+            parsed[int(descriptor_id)] = int(intensity) if str(intensity).isdigit() else None
+    return parsed
+
+
+def index_reviews(reviews, replace=True):
+    # Call inside the transaction that wrote the reviews
+    parsed = [(review, parse_review_descriptors(review.descriptors)) for review in reviews]
+    # Not the cached tree, it may hold descriptors of a rolled back transaction
+    known = set(models.Descriptor.objects.filter(
+        id__in={descriptor_id for review, items in parsed for descriptor_id in items}
+    ).values_list('id', flat=True))
+    rows = [models.ReviewDescriptor(review_id=review.id, descriptor_id=descriptor_id,
+                                    drink_id=review.drink_id, intensity=intensity)
+            for review, items in parsed
+            for descriptor_id, intensity in items.items()
+            if descriptor_id in known]
+    if replace:
+        models.ReviewDescriptor.objects.filter(
+            review_id__in=[review.id for review in reviews]).delete()
+    models.ReviewDescriptor.objects.bulk_create(rows)
+    return len(rows)
+
+
+def rebuild_review_index(batch_size=1000):
+    models.ReviewDescriptor.objects.all().delete()
+    reviews = models.Review.objects.only('id', 'drink_id', 'descriptors')
+    return sum(index_reviews(batch, replace=False)
+               for batch in aggregates.batches(reviews, batch_size))
+
+
+def search_drinks(descriptor_ids, min_intensity=None):
+    # Drink ids ranked by the number of reviews mentioning any of the
+    # descriptors or their descendants
+    descriptor_ids = get_subtree_ids(descriptor_ids)
+    mentions = models.ReviewDescriptor.objects.filter(
+        descriptor_id__in=descriptor_ids, drink__isnull=False)
+    if min_intensity is not None:
+        mentions = mentions.filter(intensity__gte=min_intensity)
+    # A review names a descriptor once, so one descriptor needs no DISTINCT
+    return mentions.values('drink_id').annotate(
+        mentions=Count('review_id', distinct=len(descriptor_ids) > 1)
+    ).order_by('-mentions', 'drink_id')
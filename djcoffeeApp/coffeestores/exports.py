@@ -0,0 +1,98 @@
+import csv
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from coffeestores import models
+
+
+# Columns are named like the serializer fields so dumps can be loaded back
+EXPORTS = {
+    'shops': (models.CoffeeShop, [('id', 'id'), ('name', 'name'),
+                                  ('address', 'address'), ('owner', 'owner_id'),
+                                  ('latitude', 'latitude'), ('longitude', 'longitude')]),
+    'drinks': (models.CoffeeDrink, [('id', 'id'), ('name', 'name'), ('price', 'price'),
+                                    ('shop', 'shop_id'), ('volume', 'volume'),
+                                    ('photo', 'photo')]),
+    'reviews': (models.Review, [('id', 'id'), ('drink', 'drink_id'),
+                                ('author', 'author_id'), ('notes', 'notes'),
+                                ('descriptors', 'descriptors'),
+                                ('overall_rating', 'overall_rating')]),
+}
+FORMATS = ['csv', 'ndjson']
+CHUNK_SIZE = 2000
+BUFFER_SIZE = 64 * 1024
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+def parse_since(value):
+    # ISO 8601, in the current timezone when it has none
+    since = parse_datetime(value)
+    if since is None:
+        raise ValueError('Invalid timestamp %s' % value)
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def get_rows(kind, since_id=None, chunk_size=CHUNK_SIZE, since=None):
+    # since_id picks up new rows, since edited ones as well
+    model, columns = EXPORTS[kind]
+    queryset = model.objects.order_by('id')
+    if since_id is not None:
+        queryset = queryset.filter(id__gt=since_id)
+    if since is not None:
+        queryset = queryset.filter(updated_at__gt=since)
+    attrs = [attr for column, attr in columns]
+    return queryset.values_list(*attrs).iterator(chunk_size=chunk_size)
+
+
+def csv_lines(kind, rows):
+    columns = [column for column, attr in EXPORTS[kind][1]]
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([json.dumps(value) if isinstance(value, (dict, list))
+                               else value for value in row])
+
+
+def ndjson_lines(kind, rows):
+    columns = [column for column, attr in EXPORTS[kind][1]]
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def buffered(lines, size=BUFFER_SIZE):
+    buffer, length = [], 0
+    for line in lines:
+        buffer.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(buffer).encode()
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer).encode()
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(kind, output='csv', since_id=None, gzip=False, chunk_size=CHUNK_SIZE,
+           since=None):
+    rows = get_rows(kind, since_id, chunk_size, since)
+    lines = csv_lines(kind, rows) if output == 'csv' else ndjson_lines(kind, rows)
+    chunks = buffered(lines)
+    return gzipped(chunks) if gzip else chunks
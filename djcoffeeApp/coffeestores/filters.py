@@ -4,7 +4,22 @@ from coffeestores import models
 
 
 class CoffeeShopFilterSet(filters.FilterSet):
+    min_rating = filters.NumberFilter(field_name='rating_mean', lookup_expr='gte')
+    max_rating = filters.NumberFilter(field_name='rating_mean', lookup_expr='lte')
+    min_reviews = filters.NumberFilter(field_name='review_count', lookup_expr='gte')
+
     class Meta:
         model = models.CoffeeShop
         fields = ['name', 'address']
 
+
+
+class CoffeeDrinkFilterSet(filters.FilterSet):
+    min_price = filters.NumberFilter(field_name='price', lookup_expr='gte')
+    max_price = filters.NumberFilter(field_name='price', lookup_expr='lte')
+    min_volume = filters.NumberFilter(field_name='volume', lookup_expr='gte')
+    max_volume = filters.NumberFilter(field_name='volume', lookup_expr='lte')
+
+    class Meta:
+        model = models.CoffeeDrink
+        fields = ['shop']
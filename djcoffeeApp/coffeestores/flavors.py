@@ -0,0 +1,96 @@
+from collections import defaultdict
+
+from django.apps import apps as global_apps
+
+from coffeestores import aggregates, descriptors, models
+
+
+FIELDS = ['review_count', 'descriptors']
+
+
+def get_paths(values, apps=global_apps):
+    Descriptor = apps.get_model('coffeestores', 'Descriptor')
+    ids = {descriptor_id for value in values
+           for descriptor_id in descriptors.parse_review_descriptors(value)}
+    return dict(Descriptor.objects.filter(id__in=ids).values_list('id', 'path'))
+
+
+def review_entries(value, paths):
+    # {descriptor id: [intensity sum, intensities given]} of one review,
+    # every descriptor also counts for its ancestors
+    entries = {}
+    for descriptor_id, intensity in descriptors.parse_review_descriptors(value).items():
+        for node in paths.get(descriptor_id, '').split('/')[:-1]:
+            entry = entries.setdefault(node, [0, 0])
+            if intensity is not None:
+                entry[0] += intensity
+                entry[1] += 1
+    return entries
+
+
+def apply_review(profile, entries, delta):
+    profile.review_count = max(profile.review_count + delta, 0)
+    profile_descriptors = dict(profile.descriptors or {})
+    for node, (intensity_sum, intensities) in entries.items():
+        reviews, total, count = profile_descriptors.get(node, (0, 0, 0))
+        entry = [reviews + delta, total + intensity_sum * delta, count + intensities * delta]
+        if entry[0] <= 0:
+            profile_descriptors.pop(node, None)
+        else:
+            profile_descriptors[node] = entry
+    profile.descriptors = profile_descriptors
+
+
+def update_profiles(changes):
+    # changes are (drink_id, review descriptors, +1 or -1), call inside a transaction
+    changes = [change for change in changes if change[0] is not None]
+    if not changes:
+        return
+    drink_ids = {drink_id for drink_id, value, delta in changes}
+    models.FlavorProfile.objects.bulk_create(
+        [models.FlavorProfile(drink_id=drink_id) for drink_id in drink_ids],
+        ignore_conflicts=True)
+    profiles = models.FlavorProfile.objects.select_for_update().in_bulk(drink_ids)
+    paths = get_paths([value for drink_id, value, delta in changes])
+    for drink_id, value, delta in changes:
+        if drink_id in profiles:
+            apply_review(profiles[drink_id], review_entries(value, paths), delta)
+    models.FlavorProfile.objects.bulk_update(profiles.values(), FIELDS)
+
+
+def compute_profiles(batch_size=1000, apps=global_apps):
+    FlavorProfile = apps.get_model('coffeestores', 'FlavorProfile')
+    Review = apps.get_model('coffeestores', 'Review')
+    profiles = defaultdict(lambda: FlavorProfile(descriptors={}))
+    reviews = Review.objects.filter(drink__isnull=False).only('id', 'drink_id', 'descriptors')
+    for batch in aggregates.batches(reviews, batch_size):
+        paths = get_paths([review.descriptors for review in batch], apps)
+        for review in batch:
+            profile = profiles[review.drink_id]
+            profile.drink_id = review.drink_id
+            apply_review(profile, review_entries(review.descriptors, paths), 1)
+    return profiles
+
+
+def rebuild_profiles(batch_size=1000, apps=global_apps):
+    FlavorProfile = apps.get_model('coffeestores', 'FlavorProfile')
+    profiles = compute_profiles(batch_size, apps)
+    FlavorProfile.objects.all().delete()
+    FlavorProfile.objects.bulk_create(profiles.values(), batch_size=batch_size)
+    return len(profiles)
+
+
+def check_profiles(batch_size=1000):
+    # Ids of drinks whose stored profile differs from their reviews
+    expected = compute_profiles(batch_size)
+    drifted = []
+    for batch in aggregates.batches(models.FlavorProfile.objects.all(), batch_size):
+        for profile in batch:
+            correct = expected.pop(profile.drink_id, None)
+            if correct is None:
+                if profile.review_count or profile.descriptors:
+                    drifted.append(profile.drink_id)
+            elif [getattr(profile, field) for field in FIELDS] != \
+                    [getattr(correct, field) for field in FIELDS]:
+                drifted.append(profile.drink_id)
+    return sorted(drifted + list(expected))
@@ -0,0 +1,99 @@
+import math
+
+from django.db.models import Q
+
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+PRECISION = 9
+MAX_CELLS = 16
+EARTH_RADIUS = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def encode(latitude, longitude, precision=PRECISION):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash, bits, bit_count, even = [], 0, 0, True
+    while len(geohash) < precision:
+        value, interval = (longitude, lon_range) if even else (latitude, lat_range)
+        middle = (interval[0] + interval[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits, bit_count = 0, 0
+    return ''.join(geohash)
+
+
+def cell_size(precision):
+    # (height, width) of a cell in degrees
+    bits = 5 * precision
+    return 180 / 2 ** (bits // 2), 360 / 2 ** ((bits + 1) // 2)
+
+
+def get_geohash(latitude, longitude):
+    if latitude is None or longitude is None:
+        return ''
+    return encode(float(latitude), float(longitude))
+
+
+def distance(lat1, lon1, lat2, lon2):
+    # Haversine, in km
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def nearby_cells(latitude, longitude, radius):
+    # The finest cells that cover the circle's bounding box with at most
+    # MAX_CELLS of them, None when the box is too large to prune
+    radius_lat = radius / KM_PER_DEGREE
+    radius_lon = radius_lat / max(math.cos(math.radians(latitude)), 1e-6)
+    if radius_lon >= 90:
+        return None
+    lat_min, lat_max = max(latitude - radius_lat, -90.0), min(latitude + radius_lat, 90.0)
+    for precision in range(PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        rows = range(int((lat_min + 90) // height),
+                     min(int((lat_max + 90) // height), int(180 // height) - 1) + 1)
+        columns = range(int((longitude - radius_lon + 180) // width),
+                        int((longitude + radius_lon + 180) // width) + 1)
+        if len(rows) * len(columns) <= MAX_CELLS:
+            break
+    else:
+        return None
+    cells = set()
+    for row in rows:
+        for column in columns:
+            cell_lon = ((column + 0.5) * width) % 360 - 180
+            cells.add(encode((row + 0.5) * height - 90, cell_lon, precision))
+    return sorted(cells)
+
+
+def cells_filter(cells):
+    # Ranges rather than startswith so the index is used, '{' sorts after 'z'
+    condition = Q()
+    for cell in cells:
+        condition |= Q(geohash__gte=cell, geohash__lt=cell + '{')
+    return condition
+
+
+def nearby(queryset, latitude, longitude, radius):
+    # [(distance, shop id)] within radius km, nearest first
+    cells = nearby_cells(latitude, longitude, radius)
+    candidates = queryset.exclude(geohash='').order_by()
+    if cells is not None:
+        candidates = candidates.filter(cells_filter(cells))
+    found = []
+    for shop_id, shop_lat, shop_lon in candidates.values_list('id', 'latitude', 'longitude'):
+        shop_distance = distance(latitude, longitude, shop_lat, shop_lon)
+        if shop_distance <= radius:
+            found.append((shop_distance, shop_id))
+    found.sort()
+    return found
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    # Same algorithm and hash format as Django's, with the work factor of
+    # PASSWORD_HASH_ITERATIONS. Hashes made with fewer iterations, or by
+    # another hasher, are redone on the next successful login
+    @property
+    def iterations(self):
+        return settings.PASSWORD_HASH_ITERATIONS
+
+    def must_update(self, encoded):
+        # Upgrades only, a hash made with more work is kept as it is
+        decoded = self.decode(encoded)
+        update_salt = hashers.must_update_salt(decoded['salt'], self.salt_entropy)
+        return decoded['iterations'] < self.iterations or update_salt
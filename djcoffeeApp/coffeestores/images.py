@@ -0,0 +1,90 @@
+import os
+from io import BytesIO
+
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from coffeestores import jobs, storage
+
+
+# name: (width, height, crop to fill the box rather than fit inside it)
+VARIANTS = {
+    'thumbnail': (160, 160, True),
+    'medium': (800, 800, False),
+}
+# format: (extension, save options)
+FORMATS = {
+    'webp': ('webp', {'format': 'WEBP', 'quality': 80, 'method': 4}),
+    'jpeg': ('jpg', {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def render(image, width, height, crop):
+    if crop:
+        image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+    else:
+        image = image.copy()
+        image.thumbnail((width, height), Image.LANCZOS)
+    return image
+
+
+def save_variant(image, folder, format):
+    # Encoded without the source's EXIF, the storage names it after the
+    # content so the same picture is stored once
+    extension, options = FORMATS[format]
+    content = BytesIO()
+    image.save(content, **options)
+    name = '%s/%s/variant.%s' % (folder, storage.VARIANTS_DIR, extension)
+    return default_storage.save(name, ContentFile(content.getvalue()))
+
+
+def make_variants(photo):
+    # {'source': photo name, variant: {format: name}}
+    folder = os.path.dirname(photo.name) or photo.field.upload_to
+    with photo.open('rb') as f, Image.open(f) as image:
+        # Orientation lives in EXIF, apply it before dropping the rest
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'L'):
+            background = Image.new('RGB', image.size, 'white')
+            image = image.convert('RGBA')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        variants = {'source': photo.name}
+        for variant, (width, height, crop) in VARIANTS.items():
+            resized = render(image, width, height, crop)
+            variants[variant] = {format: save_variant(resized, folder, format)
+                                 for format in FORMATS}
+    return variants
+
+
+def process(model_label, pk, source):
+    model = apps.get_model(model_label)
+    instance = model.objects.filter(pk=pk).first()
+    # A newer upload has a job of its own
+    if instance is None or instance.photo.name != source:
+        return
+    instance.photo_variants = make_variants(instance.photo)
+    update_fields = ['photo_variants']
+    if any(field.name == 'updated_at' for field in model._meta.fields):
+        update_fields.append('updated_at')
+    instance.save(update_fields=update_fields)
+
+
+def schedule(instance, owner_id=None):
+    if not instance.photo:
+        return None
+    return jobs.enqueue('images.variants', instance._meta.label, instance.pk,
+                        instance.photo.name, owner_id=owner_id,
+                        key='images.variants:%s:%d:%s' % (instance._meta.label, instance.pk,
+                                                         instance.photo.name))
+
+
+def get_urls(instance):
+    # Variants of the current photo, None until they are made
+    variants = instance.photo_variants or {}
+    if not instance.photo or variants.get('source') != instance.photo.name:
+        return None
+    return {variant: {format: default_storage.url(name) for format, name in names.items()}
+            for variant, names in variants.items() if variant in VARIANTS}
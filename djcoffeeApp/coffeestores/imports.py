@@ -0,0 +1,175 @@
+import csv
+import gzip
+import json
+import os
+import time
+from itertools import islice
+
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from coffeestores import (aggregates, descriptors, flavors, models, responses, search,
+                          serializers)
+
+
+# Import order matters, later kinds point at rows of the earlier ones
+IMPORTS = {
+    'shops': {'serializer': serializers.CoffeeShopSerializer, 'document': 'shop',
+              'related': {}, 'passthrough': []},
+    'drinks': {'serializer': serializers.CoffeeDrinkSerializer, 'document': 'drink',
+               'related': {'shop': ('shops', models.CoffeeShop)}, 'passthrough': ['photo']},
+    'reviews': {'serializer': serializers.ReviewSerializer, 'document': 'review',
+                'related': {'drink': ('drinks', models.CoffeeDrink)}, 'passthrough': []},
+}
+JSON_COLUMNS = ['descriptors']
+
+
+def open_file(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', newline='')
+    return open(path, newline='')
+
+
+def read_rows(f, path):
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith('.csv'):
+        for row in csv.DictReader(f):
+            # Empty cells fall back to the serializer defaults
+            row = {key: value for key, value in row.items() if value != ''}
+            for column in JSON_COLUMNS:
+                if column in row:
+                    row[column] = json.loads(row[column])
+            yield row
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class Checkpoint:
+    # Row counts are rewritten after every batch, source -> new id pairs are
+    # appended to a sidecar file so resuming does not rewrite the whole map
+    def __init__(self, path=None):
+        self.path = path
+        self.rows = {}
+        self.ids = {kind: {} for kind in IMPORTS}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.rows = json.load(f)
+        if path and os.path.exists(path + '.ids'):
+            with open(path + '.ids') as f:
+                for line in f:
+                    kind, source_id, new_id = json.loads(line)
+                    self.ids[kind][source_id] = new_id
+
+    def save(self, kind, rows, new_ids):
+        self.rows[kind] = rows
+        self.ids[kind].update(new_ids)
+        if not self.path:
+            return
+        with open(self.path + '.ids', 'a') as f:
+            for source_id, new_id in new_ids.items():
+                f.write(json.dumps([kind, source_id, new_id]) + '\n')
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.rows, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class Importer:
+    report_interval = 5
+
+    def __init__(self, checkpoint, batch_size=1000, stdout=None, stderr=None):
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.stdout = stdout
+        self.stderr = stderr
+        self.author_ids = None
+
+    def run(self, kind, path):
+        done = self.checkpoint.rows.get(kind, 0)
+        start, imported, skipped = time.perf_counter(), 0, 0
+        last_report = start
+        with open_file(path) as f:
+            rows = islice(read_rows(f, path), done, None)
+            while True:
+                batch = list(islice(rows, self.batch_size))
+                if not batch:
+                    break
+                count = self.import_batch(kind, batch, first_row=done + 1)
+                imported += count
+                skipped += len(batch) - count
+                done += len(batch)
+                if time.perf_counter() - last_report >= self.report_interval:
+                    self.report(kind, imported, skipped, start)
+                    last_report = time.perf_counter()
+        self.report(kind, imported, skipped, start)
+        if kind == 'reviews' and imported:
+            # Bulk inserts skip the per-review bookkeeping
+            with transaction.atomic():
+                aggregates.rebuild_ratings()
+        return imported, skipped
+
+    def import_batch(self, kind, batch, first_row):
+        config = IMPORTS[kind]
+        prefetched, missing = {}, {}
+        for field, (target, model) in config['related'].items():
+            target_ids = self.checkpoint.ids[target]
+            # Once the parents were imported too, a source id they did not
+            # map was skipped or failed and must not match an unrelated row.
+            # Otherwise the ids are those of the rows already here
+            imported = target in self.checkpoint.rows
+            for index, row in enumerate(batch):
+                if row.get(field) is None:
+                    continue
+                if str(row[field]) in target_ids:
+                    row[field] = target_ids[str(row[field])]
+                elif imported:
+                    missing[index] = '%s %s was not imported' % (field, row[field])
+            ids = {int(row[field]) for row in batch if str(row.get(field)).isdigit()}
+            prefetched[field] = model.objects.only('id').in_bulk(ids)
+
+        child = config['serializer'](context={'prefetched': prefetched})
+        model = child.Meta.model
+        instances, source_ids = [], []
+        for number, row in enumerate(batch, first_row):
+            if number - first_row in missing:
+                self.stderr.write('%s row %d: %s' % (kind, number, missing[number - first_row]))
+                continue
+            extra = {field: row.pop(field) for field in config['passthrough'] if field in row}
+            if kind == 'reviews':
+                extra['author_id'] = self.get_author_id(row.pop('author', None))
+            try:
+                attrs = child.run_validation(row)
+            except ValidationError as exc:
+                self.stderr.write('%s row %d: %s' % (kind, number, exc.detail))
+                continue
+            instance = model(**attrs, **extra)
+            serializers.set_derived_fields(instance)
+            instances.append(instance)
+            source_ids.append(row.get('id'))
+
+        with transaction.atomic():
+            instances = model.objects.bulk_create(instances)
+            search.index_objects(config['document'], instances)
+            responses.clear()
+            if kind == 'reviews':
+                descriptors.index_reviews(instances, replace=False)
+                flavors.update_profiles([(review.drink_id, review.descriptors, 1)
+                                         for review in instances])
+        new_ids = {str(source_id): instance.id
+                   for source_id, instance in zip(source_ids, instances)
+                   if source_id is not None and kind != 'reviews'}
+        self.checkpoint.save(kind, first_row - 1 + len(batch), new_ids)
+        return len(instances)
+
+    def get_author_id(self, author_id):
+        if self.author_ids is None:
+            self.author_ids = set(models.CoffeeDrinker.objects.values_list('id', flat=True))
+        if str(author_id).isdigit() and int(author_id) in self.author_ids:
+            return int(author_id)
+        return None
+
+    def report(self, kind, imported, skipped, start):
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        self.stdout.write('%s: %d imported, %d skipped, %.0f rows/s'
+                          % (kind, imported, skipped, (imported + skipped) / elapsed))
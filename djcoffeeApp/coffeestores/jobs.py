@@ -0,0 +1,203 @@
+import logging
+import os
+import random
+import socket
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from coffeestores import models
+
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+BACKOFF_BASE = 2
+BACKOFF_MAX = 60 * 60
+# A job running for longer lost its worker
+STALE_AFTER = 15 * 60
+KEEP_DONE = 7 * 24 * 60 * 60
+MAX_ERROR_LENGTH = 4000
+
+
+def task(name):
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def enqueue(name, *args, key=None, delay=0, max_attempts=5, owner_id=None):
+    # Call inside the transaction of the write the job follows up on, a
+    # worker only sees the job once both are committed. JOBS_EAGER runs
+    # it right away instead
+    if name not in TASKS:
+        raise ValueError('Unknown task %s' % name)
+    job = models.Job(name=name, args=list(args), idempotency_key=key,
+                     max_attempts=max_attempts, owner_id=owner_id,
+                     run_at=timezone.now() + timedelta(seconds=delay))
+    eager = getattr(settings, 'JOBS_EAGER', False) and not delay
+    if eager:
+        job.status = models.Job.RUNNING
+        job.attempts = 1
+        job.started_at = job.run_at
+    if key is not None:
+        existing = models.Job.objects.filter(idempotency_key=key).first()
+        if existing is not None:
+            return existing
+        try:
+            with transaction.atomic():
+                job.save()
+        except IntegrityError:
+            return models.Job.objects.get(idempotency_key=key)
+    else:
+        job.save()
+    if eager:
+        execute(job)
+    return job
+
+
+def get_backoff(attempts):
+    # Exponential, with jitter so jobs failing together do not retry together
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return timedelta(seconds=delay * random.uniform(0.5, 1))
+
+
+class LostJob(Exception):
+    pass
+
+
+def get_owned(job):
+    # The job row while it is still claimed by the run of job. maintain()
+    # hands jobs that run too long to another worker, this one must not
+    # commit after that
+    return models.Job.objects.filter(id=job.id, status=models.Job.RUNNING,
+                                     worker=job.worker, attempts=job.attempts)
+
+
+def execute(job):
+    # job was claimed, its effects and its status commit together
+    try:
+        with transaction.atomic():
+            job.result = TASKS[job.name](*job.args)
+            if not get_owned(job).select_for_update().exists():
+                raise LostJob()
+            job.status = models.Job.DONE
+            job.finished_at = timezone.now()
+            job.last_error = ''
+            job.save(update_fields=['result', 'status', 'finished_at', 'last_error'])
+    except LostJob:
+        logger.warning('Job %d (%s) was taken back from %s, its run is rolled back',
+                       job.id, job.name, job.worker or 'this worker')
+    except Exception:
+        logger.exception('Job %d (%s) failed, attempt %d of %d',
+                         job.id, job.name, job.attempts, job.max_attempts)
+        job.last_error = traceback.format_exc()[-MAX_ERROR_LENGTH:]
+        job.finished_at = timezone.now()
+        if job.attempts >= job.max_attempts:
+            job.status = models.Job.FAILED
+        else:
+            job.status = models.Job.QUEUED
+            job.run_at = job.finished_at + get_backoff(job.attempts)
+        get_owned(job).update(last_error=job.last_error, finished_at=job.finished_at,
+                              status=job.status, run_at=job.run_at)
+    return job
+
+
+def claim(worker, limit=1):
+    now = timezone.now()
+    with transaction.atomic():
+        # Skips the rows other workers locked where the backend can, the
+        # status condition of the update settles races where it cannot
+        ids = list(models.Job.objects.select_for_update(skip_locked=True).filter(
+            status=models.Job.QUEUED, run_at__lte=now
+        ).order_by('run_at', 'id').values_list('id', flat=True)[:limit])
+        models.Job.objects.filter(id__in=ids, status=models.Job.QUEUED).update(
+            status=models.Job.RUNNING, worker=worker, started_at=now,
+            attempts=F('attempts') + 1)
+    return list(models.Job.objects.filter(id__in=ids, status=models.Job.RUNNING,
+                                          worker=worker, started_at=now).order_by('run_at', 'id'))
+
+
+def run_pending(worker='inline', limit=None):
+    # Runs due jobs until there are none left, or limit of them
+    count = 0
+    while limit is None or count < limit:
+        jobs = claim(worker)
+        if not jobs:
+            break
+        for job in jobs:
+            execute(job)
+            count += 1
+    return count
+
+
+def maintain(stale_after=STALE_AFTER, keep_done=KEEP_DONE):
+    # Jobs of workers that died are retried, or failed when out of attempts.
+    # Finished jobs are kept for a while for their status
+    now = timezone.now()
+    stale = models.Job.objects.filter(status=models.Job.RUNNING,
+                                      started_at__lt=now - timedelta(seconds=stale_after))
+    failed = stale.filter(attempts__gte=F('max_attempts')).update(
+        status=models.Job.FAILED, finished_at=now, last_error='Worker lost')
+    retried = stale.update(status=models.Job.QUEUED, run_at=now, worker='')
+    models.Job.objects.filter(status=models.Job.DONE,
+                              finished_at__lt=now - timedelta(seconds=keep_done)).delete()
+    return retried, failed
+
+
+class WorkerPool:
+    def __init__(self, workers=2, poll_interval=1.0, batch_size=10):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.stopping = threading.Event()
+        self.processed = 0
+        self.lock = threading.Lock()
+
+    def stop(self):
+        self.stopping.set()
+
+    def work(self, once=False):
+        worker = '%s:%d:%s' % (socket.gethostname(), os.getpid(),
+                               threading.current_thread().name)
+        while not self.stopping.is_set():
+            jobs = claim(worker, self.batch_size)
+            for job in jobs:
+                execute(job)
+            with self.lock:
+                self.processed += len(jobs)
+            if not jobs:
+                if once:
+                    return
+                self.stopping.wait(self.poll_interval)
+
+    def work_thread(self, once):
+        try:
+            self.work(once)
+        finally:
+            connection.close()
+
+    def run(self, once=False):
+        # once drains the due jobs and returns. A single worker runs in the
+        # calling thread
+        maintain()
+        if self.workers == 1:
+            self.work(once)
+            return self.processed
+        threads = [threading.Thread(target=self.work_thread, args=(once,),
+                                    name='worker-%d' % number, daemon=True)
+                   for number in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(self.poll_interval * 60)
+            if not self.stopping.is_set():
+                maintain()
+        return self.processed
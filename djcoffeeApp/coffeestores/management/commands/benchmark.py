@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+
+from coffeestores import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Run a benchmark scenario on generated data, rolled back afterwards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(benchmarks.SCENARIOS))
+        parser.add_argument('--size', type=int, help='Number of generated rows')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='Runs per measurement, the median is reported')
+
+    def handle(self, *args, **options):
+        kwargs = {'repeat': options['repeat']}
+        if options['size']:
+            kwargs['size'] = options['size']
+        # Requests are built in-process, so any host name is fine here
+        with override_settings(ALLOWED_HOSTS=['*']), transaction.atomic():
+            benchmarks.SCENARIOS[options['scenario']](self.stdout, **kwargs)
+            transaction.set_rollback(True)
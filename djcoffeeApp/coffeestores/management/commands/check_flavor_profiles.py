@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from coffeestores import flavors
+
+
+class Command(BaseCommand):
+    help = 'Compare stored flavor profiles with the ones computed from reviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        drifted = flavors.check_profiles(options['batch_size'])
+        if drifted:
+            raise CommandError('%d drinks have stale flavor profiles, run '
+                               'rebuild_flavor_profiles: %s'
+                               % (len(drifted), ', '.join(map(str, drifted[:20]))))
+        self.stdout.write('Flavor profiles are consistent')
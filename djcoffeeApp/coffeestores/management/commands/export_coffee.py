@@ -0,0 +1,31 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from coffeestores import exports
+
+
+class Command(BaseCommand):
+    help = 'Stream a full or incremental dump of shops, drinks or reviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(exports.EXPORTS))
+        parser.add_argument('--output', choices=exports.FORMATS, default='csv')
+        parser.add_argument('--since-id', type=int, help='Only rows with a greater id')
+        parser.add_argument('--since', type=exports.parse_since,
+                            help='Only rows created or updated after this ISO 8601 time')
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--file', help='Write to a file instead of stdout')
+        parser.add_argument('--chunk-size', type=int, default=exports.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        chunks = exports.export(options['kind'], options['output'], options['since_id'],
+                                options['gzip'], options['chunk_size'], options['since'])
+        if options['file']:
+            with open(options['file'], 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        else:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
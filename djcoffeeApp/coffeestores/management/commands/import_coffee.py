@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from coffeestores import imports
+
+
+class Command(BaseCommand):
+    help = ('Stream shops, drinks and reviews from CSV or NDJSON files (optionally '
+            'gzipped) into the database in batched transactions')
+
+    def add_arguments(self, parser):
+        for kind in imports.IMPORTS:
+            parser.add_argument('--%s' % kind, metavar='FILE')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--checkpoint', metavar='FILE',
+                            help='Progress file, an existing one resumes the import')
+
+    def handle(self, *args, **options):
+        checkpoint = imports.Checkpoint(options['checkpoint'])
+        importer = imports.Importer(checkpoint, options['batch_size'],
+                                    self.stdout, self.stderr)
+        for kind in imports.IMPORTS:
+            if options[kind]:
+                imported, skipped = importer.run(kind, options[kind])
+                self.stdout.write(self.style.SUCCESS(
+                    'Imported %d %s, skipped %d' % (imported, kind, skipped)))
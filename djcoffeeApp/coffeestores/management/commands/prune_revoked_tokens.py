@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from coffeestores import revocations
+
+
+class Command(BaseCommand):
+    help = 'Delete the revoked token ids of tokens that expired anyway'
+
+    def handle(self, *args, **options):
+        deleted = revocations.prune()
+        self.stdout.write('Pruned %d revoked tokens' % deleted)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from coffeestores import flavors
+
+
+class Command(BaseCommand):
+    help = 'Recompute the flavor profile of every drink from its reviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drinks = flavors.rebuild_profiles(options['batch_size'])
+        self.stdout.write('Rebuilt flavor profiles of %d reviewed drinks' % drinks)
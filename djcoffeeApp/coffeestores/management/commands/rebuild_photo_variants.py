@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from coffeestores import aggregates, images, models
+
+
+class Command(BaseCommand):
+    help = 'Make the missing thumbnails and medium variants of drink and user photos'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--all', action='store_true',
+                            help='Remake the variants of every photo')
+
+    def handle(self, *args, **options):
+        for model in [models.CoffeeDrink, models.CoffeeDrinker]:
+            done = failed = 0
+            queryset = model.objects.exclude(photo='').exclude(photo=None).only(
+                'id', 'photo', 'photo_variants')
+            for batch in aggregates.batches(queryset, options['batch_size']):
+                for instance in batch:
+                    if not options['all'] and images.get_urls(instance) is not None:
+                        continue
+                    try:
+                        images.process(model._meta.label, instance.pk, instance.photo.name)
+                        done += 1
+                    except Exception as exc:
+                        self.stderr.write('%s %d: %s' % (model.__name__, instance.pk, exc))
+                        failed += 1
+            self.stdout.write('%s: %d photos processed, %d failed'
+                              % (model.__name__, done, failed))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from coffeestores import aggregates, responses
+
+
+class Command(BaseCommand):
+    help = 'Recompute review count, rating sum/mean and histogram of drinks and shops'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drinks, shops = aggregates.rebuild_ratings(options['batch_size'])
+            responses.clear()
+        self.stdout.write('Rebuilt ratings of %d reviewed drinks in %d shops'
+                          % (drinks, shops))
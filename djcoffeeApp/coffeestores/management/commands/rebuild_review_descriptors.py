@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from coffeestores import descriptors
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the descriptor search index from the descriptors of every review'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            rows = descriptors.rebuild_review_index(options['batch_size'])
+        self.stdout.write('Indexed %d review descriptors' % rows)
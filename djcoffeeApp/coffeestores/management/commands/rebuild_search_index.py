@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from coffeestores import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the search documents of every shop, drink and review'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            documents = search.rebuild_index(options['batch_size'])
+        self.stdout.write('Indexed %d search documents' % documents)
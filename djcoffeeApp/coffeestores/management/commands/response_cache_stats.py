@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from coffeestores import responses
+
+
+class Command(BaseCommand):
+    help = 'Show hits and misses of the cached shop and drink responses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after')
+
+    def handle(self, *args, **options):
+        for name, stats in responses.get_stats().items():
+            total = stats['hits'] + stats['misses']
+            self.stdout.write('%s: %d hits, %d misses, %.1f%% hit rate'
+                              % (name, stats['hits'], stats['misses'],
+                                 100 * stats['hits'] / total if total else 0))
+        if options['reset']:
+            responses.reset_stats()
@@ -0,0 +1,28 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from coffeestores import jobs
+
+
+class Command(BaseCommand):
+    help = 'Run the queued background jobs, retrying failed ones with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait when there is nothing to run')
+        parser.add_argument('--batch-size', type=int, default=10,
+                            help='Jobs a worker claims at once')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the due jobs are done')
+
+    def handle(self, *args, **options):
+        pool = jobs.WorkerPool(options['workers'], options['poll_interval'],
+                               options['batch_size'])
+        if not options['once']:
+            # Jobs being run are finished before exiting
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, lambda signum, frame: pool.stop())
+        processed = pool.run(options['once'])
+        self.stdout.write('Ran %d jobs' % processed)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from coffeestores import storage
+
+
+class Command(BaseCommand):
+    help = 'Recount photo references and delete the files nothing references'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=storage.SWEEP_GRACE,
+                            help='Seconds a file is kept after it was written')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be deleted')
+
+    def handle(self, *args, **options):
+        files, size = storage.sweep(options['grace'], options['dry_run'])
+        self.stdout.write('%s %d files, %d bytes'
+                          % ('Would remove' if options['dry_run'] else 'Removed', files, size))
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coffeestores', '0008_alter_coffeedrinker_photo'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='coffeeshop',
+            index=models.Index(fields=['name', 'id'], name='coffeeshop_name_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='coffeeshop',
+            index=models.Index(fields=['address', 'id'], name='coffeeshop_address_id_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coffeestores', '0009_coffeeshop_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['drink', 'id'], name='review_drink_id_idx'),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:33
+
+from django.db import migrations, models
+
+
+def rebuild_ratings(apps, schema_editor):
+    from coffeestores import aggregates
+    aggregates.rebuild_ratings(apps=apps)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coffeestores', '0010_review_drink_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coffeedrink',
+            name='rating_histogram',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='coffeedrink',
+            name='rating_mean',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=3),
+        ),
+        migrations.AddField(
+            model_name='coffeedrink',
+            name='rating_sum',
+            field=models.DecimalField(decimal_places=1, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='coffeedrink',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='coffeeshop',
+            name='rating_histogram',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='coffeeshop',
+            name='rating_mean',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=3),
+        ),
+        migrations.AddField(
+            model_name='coffeeshop',
+            name='rating_sum',
+            field=models.DecimalField(decimal_places=1, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='coffeeshop',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='coffeeshop',
+            index=models.Index(fields=['rating_mean', 'id'], name='coffeeshop_rating_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='coffeeshop',
+            index=models.Index(fields=['review_count', 'id'], name='coffeeshop_reviews_id_idx'),
+        ),
+        migrations.RunPython(rebuild_ratings, migrations.RunPython.noop),
+    ]
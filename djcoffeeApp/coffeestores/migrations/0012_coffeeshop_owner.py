@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coffeestores', '0011_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coffeeshop',
+            name='owner',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='shops', to='coffeestores.coffeedrinker'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:45
+
+from django.db import migrations, models
+
+
+def rebuild_paths(apps, schema_editor):
+    from coffeestores import descriptors
+    descriptors.rebuild_paths(apps=apps)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coffeestores', '0012_coffeeshop_owner'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='descriptor',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=255),
+        ),
+        migrations.RunPython(rebuild_paths, migrations.RunPython.noop),
+    ]
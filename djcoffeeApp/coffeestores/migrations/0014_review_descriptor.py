@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coffeestores', '0013_descriptor_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReviewDescriptor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('intensity', models.PositiveSmallIntegerField(null=True)),
+                ('descriptor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='coffeestores.descriptor')),
+                ('drink', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='coffeestores.coffeedrink')),
+                ('review', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='coffeestores.review')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['descriptor', 'drink', 'intensity', 'review'], name='reviewdescriptor_drink_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='reviewdescriptor',
+            constraint=models.UniqueConstraint(fields=('review', 'descriptor'), name='reviewdescriptor_unique'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def rebuild_profiles(apps, schema_editor):
+    from coffeestores import flavors
+    flavors.rebuild_profiles(apps=apps)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coffeestores', '0014_review_descriptor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FlavorProfile',
+            fields=[
+                ('drink', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='flavor_profile', serialize=False, to='coffeestores.coffeedrink')),
+                ('review_count', models.PositiveIntegerField(default=0)),
+                ('descriptors', models.JSONField(blank=True, default=dict)),
+            ],
+        ),
+        migrations.RunPython(rebuild_profiles, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:53
+
+from django.db import migrations, models
+
+
+def install_backend(apps, schema_editor):
+    from coffeestores import search
+    if schema_editor.connection.vendor in search.BACKENDS:
+        search.get_backend(schema_editor.connection).install(schema_editor)
+    search.rebuild_index(apps=apps)
+
+
+def uninstall_backend(apps, schema_editor):
+    from coffeestores import search
+    if schema_editor.connection.vendor in search.BACKENDS:
+        search.get_backend(schema_editor.connection).uninstall(schema_editor)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coffeestores', '0015_flavor_profile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=15)),
+                ('object_id', models.BigIntegerField()),
+                ('title', models.CharField(blank=True, default='', max_length=255)),
+                ('body', models.TextField(blank=True, default='')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='searchdocument',
+            constraint=models.UniqueConstraint(fields=('kind', 'object_id'), name='searchdocument_unique'),
+        ),
+        migrations.RunPython(install_backend, uninstall_backend),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coffeestores', '0016_search_document'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coffeeshop',
+            name='geohash',
+            field=models.CharField(blank=True, default='', max_length=12),
+        ),
+        migrations.AddField(
+            model_name='coffeeshop',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coffeeshop',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='coffeeshop',
+            index=models.Index(fields=['geohash', 'latitude', 'longitude'], name='coffeeshop_geohash_idx'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:02
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def set_price_per_ml(apps, schema_editor):
+    CoffeeDrink = apps.get_model('coffeestores', 'CoffeeDrink')
+    queryset = CoffeeDrink.objects.filter(volume__gt=0).only('id', 'price', 'volume')
+    last_pk = 0
+    while True:
+        drinks = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:1000])
+        if not drinks:
+            return
+        for drink in drinks:
+            drink.price_per_ml = (drink.price / drink.volume).quantize(Decimal('0.000001'))
+        CoffeeDrink.objects.bulk_update(drinks, ['price_per_ml'])
+        last_pk = drinks[-1].pk
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coffeestores', '0017_coffeeshop_location'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coffeedrink',
+            name='price_per_ml',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=12, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='coffeedrink',
+            index=models.Index(fields=['price', 'id'], name='coffeedrink_price_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='coffeedrink',
+            index=models.Index(fields=['volume', 'id'], name='coffeedrink_volume_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='coffeedrink',
+            index=models.Index(fields=['price_per_ml', 'id'], name='coffeedrink_per_ml_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='coffeedrink',
+            index=models.Index(fields=['shop', 'price', 'id'], name='coffeedrink_shop_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='coffeedrink',
+            index=models.Index(fields=['shop', 'price_per_ml', 'id'], name='coffeedrink_shop_per_ml_idx'),
+        ),
+        migrations.RunPython(set_price_per_ml, migrations.RunPython.noop),
+    ]
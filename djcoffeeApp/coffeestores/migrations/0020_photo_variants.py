@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coffeestores', '0019_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coffeedrink',
+            name='photo_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='coffeedrinker',
+            name='photo_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:54
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coffeestores', '0024_revokedtoken_revoked_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='review',
+            name='overall_rating',
+            field=models.DecimalField(decimal_places=1, max_digits=2, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(5)]),
+        ),
+    ]
@@ -1,10 +1,18 @@
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django.contrib.auth.models import User
 
+from coffeestores import geo
+
 # Create your models here.
 class CoffeeDrinker(User):
     education = models.CharField(max_length=63, null=True, blank=True)
     photo = models.ImageField(upload_to='users', null=True, blank=True)
+    # Resized copies of photo made by a background worker, see images.py
+    photo_variants = models.JSONField(default=dict, blank=True)
     ...
 
 class Descriptor(models.Model):
@@ -13,25 +21,185 @@ class Descriptor(models.Model):
     color = models.CharField(max_length=7)
 
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True)
-    ...
+    # Ids from the root down to this descriptor, e.g. "1/5/12/"
+    path = models.CharField(max_length=255, blank=True, default='', db_index=True)
+
+    def clean(self):
+        if self.pk and self.parent_id and str(self.pk) in self.parent.path.split('/'):
+            raise ValidationError({'parent': 'A descriptor cannot be its own ancestor'})
 
-class CoffeeShop(models.Model):
+
+class RatingAggregates(models.Model):
+    review_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.DecimalField(max_digits=12, decimal_places=1, default=0)
+    rating_mean = models.DecimalField(max_digits=3, decimal_places=2, default=0)
+    rating_histogram = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        abstract = True
+
+class CoffeeShop(RatingAggregates):
     name = models.CharField(max_length=63)
     address = models.CharField(max_length=255)
-    ...
+    owner = models.ForeignKey(CoffeeDrinker, on_delete=models.SET_NULL, null=True,
+                              blank=True, related_name='shops')
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    # Set from the coordinates, empty without them
+    geohash = models.CharField(max_length=12, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
-class CoffeeDrink(models.Model):
+    class Meta:
+        indexes = [
+            models.Index(fields=['name', 'id'], name='coffeeshop_name_id_idx'),
+            models.Index(fields=['address', 'id'], name='coffeeshop_address_id_idx'),
+            models.Index(fields=['rating_mean', 'id'], name='coffeeshop_rating_id_idx'),
+            models.Index(fields=['review_count', 'id'], name='coffeeshop_reviews_id_idx'),
+            # Covers the candidate query of a nearby search
+            models.Index(fields=['geohash', 'latitude', 'longitude'],
+                         name='coffeeshop_geohash_idx'),
+        ]
+
+    def set_derived_fields(self):
+        # Called on save by a signal, bulk writes call it themselves
+        self.geohash = geo.get_geohash(self.latitude, self.longitude)
+        return ['geohash']
+
+class CoffeeDrink(RatingAggregates):
     name = models.CharField(max_length=31)
     # coffee_type - ? e.g. espresso, latte, ... 
     price = models.DecimalField(max_digits=6, decimal_places=2)
     shop = models.ForeignKey(CoffeeShop, on_delete=models.CASCADE)
     volume = models.SmallIntegerField()
     photo = models.ImageField(upload_to='files', null=True, blank=True)
-    ...
+    photo_variants = models.JSONField(default=dict, blank=True)
+    # price / volume, kept for ordering by it through an index
+    price_per_ml = models.DecimalField(max_digits=12, decimal_places=6, null=True,
+                                       blank=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['price', 'id'], name='coffeedrink_price_id_idx'),
+            models.Index(fields=['volume', 'id'], name='coffeedrink_volume_id_idx'),
+            models.Index(fields=['price_per_ml', 'id'], name='coffeedrink_per_ml_id_idx'),
+            models.Index(fields=['shop', 'price', 'id'], name='coffeedrink_shop_price_idx'),
+            models.Index(fields=['shop', 'price_per_ml', 'id'],
+                         name='coffeedrink_shop_per_ml_idx'),
+        ]
+
+    def set_derived_fields(self):
+        # Called on save by a signal, bulk writes call it themselves
+        self.price_per_ml = None
+        if self.price is not None and self.volume and self.volume > 0:
+            self.price_per_ml = (Decimal(self.price) / self.volume).quantize(
+                Decimal('0.000001'))
+        return ['price_per_ml']
 
 class Review(models.Model):
     drink = models.ForeignKey(CoffeeDrink, on_delete=models.CASCADE, null=True)
     author = models.ForeignKey(CoffeeDrinker, on_delete=models.SET_NULL, null=True)
     notes = models.TextField(blank=True, null=True)
     descriptors = models.JSONField(default=dict, blank=True, null=True)
-    overall_rating = models.DecimalField(max_digits=2, decimal_places=1)
+    overall_rating = models.DecimalField(max_digits=2, decimal_places=1,
+                                         validators=[MinValueValidator(0),
+                                                     MaxValueValidator(5)])
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['drink', 'id'], name='review_drink_id_idx'),
+            # Count and newest change of a drink's reviews for its ETag
+            models.Index(fields=['drink', 'updated_at'], name='review_drink_updated_idx'),
+        ]
+
+
+class ReviewDescriptor(models.Model):
+    # Descriptors of Review.descriptors, one row each, rebuilt on every review write
+    review = models.ForeignKey(Review, on_delete=models.CASCADE)
+    descriptor = models.ForeignKey(Descriptor, on_delete=models.CASCADE)
+    drink = models.ForeignKey(CoffeeDrink, on_delete=models.CASCADE, null=True)
+    intensity = models.PositiveSmallIntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            # Covers the search query, no table lookups
+            models.Index(fields=['descriptor', 'drink', 'intensity', 'review'],
+                         name='reviewdescriptor_drink_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['review', 'descriptor'],
+                                    name='reviewdescriptor_unique'),
+        ]
+
+
+class FlavorProfile(models.Model):
+    drink = models.OneToOneField(CoffeeDrink, on_delete=models.CASCADE, primary_key=True,
+                                 related_name='flavor_profile')
+    review_count = models.PositiveIntegerField(default=0)
+    # {descriptor id: [reviews, intensity sum, intensities given]}, a descriptor
+    # counts the reviews that name it or any of its descendants
+    descriptors = models.JSONField(default=dict, blank=True)
+
+
+class SearchDocument(models.Model):
+    # Text of a shop, drink or review as the search backend indexes it
+    kind = models.CharField(max_length=15)
+    object_id = models.BigIntegerField()
+    title = models.CharField(max_length=255, blank=True, default='')
+    body = models.TextField(blank=True, default='')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'],
+                                    name='searchdocument_unique'),
+        ]
+
+
+class Job(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    # Name of a function registered with jobs.task, called with args
+    name = models.CharField(max_length=63)
+    args = models.JSONField(default=list, blank=True)
+    # Enqueueing the same key again returns the first job
+    idempotency_key = models.CharField(max_length=255, null=True, blank=True, unique=True)
+    status = models.CharField(max_length=7, choices=STATUSES, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_at = models.DateTimeField()
+    worker = models.CharField(max_length=127, blank=True, default='')
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    owner = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
+                              related_name='jobs')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Due jobs in order, what workers claim from
+            models.Index(fields=['status', 'run_at', 'id'], name='job_status_run_at_idx'),
+            models.Index(fields=['owner', 'id'], name='job_owner_id_idx'),
+        ]
+
+
+class Blob(models.Model):
+    # A stored photo, named after its content, see storage.py
+    name = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField(default=0)
+    # Rows whose photo it is, the file is deleted when it drops to 0
+    references = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class RevokedToken(models.Model):
+    # A refresh or access token refused until it expires, see revocations.py
+    jti = models.CharField(max_length=64, unique=True)
+    expires_at = models.DateTimeField(db_index=True)
+    revoked_at = models.DateTimeField(auto_now_add=True, db_index=True)
@@ -1,4 +1,14 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class CoffeeShopPaginator(PageNumberPagination):
@@ -6,3 +16,121 @@ class CoffeeShopPaginator(PageNumberPagination):
     page_size_query_param = 'page_size'
     max_page_size = 10
 
+
+class KeysetPaginator(BasePagination):
+    # Seeks on the (ordering key, id) tuple of the boundary row instead of
+    # using OFFSET, so every page costs the same no matter how deep it is.
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 10
+    cursor_query_param = 'cursor'
+    skip_count_query_param = 'skip_count'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(queryset)
+        position, reverse = self.decode_cursor(request)
+
+        self.count = None
+        if request.query_params.get(self.skip_count_query_param) not in ('1', 'true'):
+            self.count = queryset.count()
+
+        if position is not None:
+            try:
+                queryset = queryset.filter(self.seek_filter(position, reverse))
+            except (TypeError, ValueError, ValidationError):
+                raise NotFound(self.invalid_cursor_message)
+        order_by = [('-' if desc != reverse else '') + field
+                    for field, desc in self.ordering]
+        results = list(queryset.order_by(*order_by)[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        response = OrderedDict()
+        if self.count is not None:
+            response['count'] = self.count
+        response['next'] = self.get_next_link()
+        response['previous'] = self.get_previous_link()
+        response['results'] = data
+        return Response(response)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_ordering(self, queryset):
+        ordering = []
+        for field in queryset.query.order_by or ['id']:
+            desc = field.startswith('-')
+            field = field.lstrip('-')
+            ordering.append(('id' if field == 'pk' else field, desc))
+        if 'id' not in [field for field, desc in ordering]:
+            ordering.append(('id', ordering[-1][1]))
+        return ordering
+
+    def seek_filter(self, position, reverse):
+        condition = Q()
+        for i, (field, desc) in enumerate(self.ordering):
+            lookup = 'lt' if desc != reverse else 'gt'
+            prefix = {f: position[j] for j, (f, d) in enumerate(self.ordering[:i])}
+            condition |= Q(**prefix, **{'%s__%s' % (field, lookup): position[i]})
+        return condition
+
+    def get_position(self, instance):
+        return [getattr(instance, field) for field, desc in self.ordering]
+
+    def encode_cursor(self, position, reverse=False):
+        data = json.dumps({'p': position, 'r': int(reverse)}, cls=DjangoJSONEncoder)
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None, False
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            position, reverse = data['p'], bool(data['r'])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.get_link(self.encode_cursor(self.get_position(self.page[-1])))
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.get_link(self.encode_cursor(self.get_position(self.page[0]),
+                                                reverse=True))
+
+    def get_link(self, cursor):
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.cursor_query_param, cursor)
+
+
+def get_paginator(request, view):
+    mode = request.query_params.get('pagination',
+                                    getattr(view, 'pagination_mode', 'page'))
+    if mode == 'cursor' or KeysetPaginator.cursor_query_param in request.query_params:
+        return KeysetPaginator()
+    return CoffeeShopPaginator()
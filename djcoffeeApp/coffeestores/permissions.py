@@ -0,0 +1,18 @@
+from rest_framework import permissions
+
+from coffeestores import models, roles
+
+
+class IsShopOwner(permissions.BasePermission):
+    message = 'Not a shop owner'
+
+    def has_permission(self, request, view):
+        return roles.SHOP_OWNER in roles.get_roles(request.user)
+
+    def has_object_permission(self, request, view, obj):
+        # Shops without an owner predate ownership or lost their owner's
+        # account, only staff may change those
+        shop = obj if isinstance(obj, models.CoffeeShop) else obj.shop
+        if shop.owner_id is None:
+            return request.user.is_staff
+        return shop.owner_id == request.user.id
@@ -0,0 +1,180 @@
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Max
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework.response import Response
+
+
+CACHE_TIMEOUT = 10 * 60
+# Part of every key, clear() drops all cached responses at once
+ALL = 'all'
+OUTCOMES = ['hits', 'misses']
+CACHED_HEADERS = ['ETag', 'Last-Modified']
+names = []
+
+
+def get_cache():
+    return caches[getattr(settings, 'RESPONSE_CACHE', 'default')]
+
+
+def generation_key(scope):
+    return 'responses:generation:%s' % scope
+
+
+def counter_key(name, outcome):
+    return 'responses:%s:%s' % (outcome, name)
+
+
+def increment(cache, key, start):
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, start, None):
+            cache.incr(key)
+
+
+def bump(scopes):
+    cache = get_cache()
+    for scope in scopes:
+        # A counter evicted from the cache restarts from the clock, never
+        # from a generation that may still have responses cached
+        increment(cache, generation_key(scope), time.time_ns())
+
+
+def invalidate(scopes):
+    scopes = set(scopes)
+    bump(scopes)
+    # Again once committed, a response built from the old rows before the
+    # commit would otherwise be cached under the new generation
+    transaction.on_commit(lambda: bump(scopes))
+
+
+def invalidate_shops(shop_ids):
+    invalidate(['shops', *('shop:%d' % shop_id for shop_id in shop_ids)])
+
+
+def invalidate_drinks(drinks):
+    # Shops list their drinks
+    invalidate(['shops', *('shop:%d' % drink.shop_id for drink in drinks),
+                *('drink:%d' % drink.pk for drink in drinks)])
+
+
+def clear():
+    invalidate([ALL])
+
+
+def get_generations(scopes):
+    cache = get_cache()
+    keys = [generation_key(scope) for scope in scopes]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            cache.add(key, time.time_ns(), None)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def digest(request, parts):
+    # Parameter order does not matter, the host does as links are absolute
+    query = sorted((key, sorted(request.GET.getlist(key))) for key in request.GET)
+    content = repr((request.build_absolute_uri('/'), query, parts))
+    return hashlib.md5(content.encode(), usedforsecurity=False).hexdigest()
+
+
+def response_key(name, request, scopes):
+    return 'responses:%s:%s' % (name, digest(request, get_generations(scopes)))
+
+
+def make_etag(request, *parts):
+    return quote_etag(digest(request, [request.path, *parts]))
+
+
+def get_version(queryset):
+    # Rows are counted too, a delete leaves the newest timestamp as it was.
+    # Two queries, MAX alone is an index seek but not next to COUNT
+    queryset = queryset.order_by()
+    return queryset.count(), queryset.aggregate(updated_at=Max('updated_at'))['updated_at']
+
+
+def not_modified(request, response):
+    # A 304 carrying the headers of response, None when the request's
+    # conditions do not match
+    last_modified = parse_http_date_safe(response.get('Last-Modified', ''))
+    conditional_response = get_conditional_response(
+        request, etag=response.get('ETag'), last_modified=last_modified, response=response)
+    return None if conditional_response is response else conditional_response
+
+
+def conditional(get_validators):
+    # get_validators(viewset, request) returns an ETag and the last modified
+    # datetime or None, computed without building the body. None skips
+    # straight to the view
+    def decorator(view):
+        @wraps(view)
+        def wrapper(viewset, request, *args, **kwargs):
+            validators = get_validators(viewset, request)
+            if validators is None:
+                return view(viewset, request, *args, **kwargs)
+            etag, last_modified = validators
+            headers = {'ETag': etag}
+            if last_modified is not None:
+                headers['Last-Modified'] = http_date(last_modified.timestamp())
+            response = not_modified(request, Response(headers=headers))
+            if response is None:
+                response = view(viewset, request, *args, **kwargs)
+                if response.status_code == 200:
+                    for header, value in headers.items():
+                        response[header] = value
+            return response
+        return wrapper
+    return decorator
+
+
+def cached(name, get_scopes):
+    # Caches successful responses of a GET view, get_scopes(request) names
+    # the generations the response depends on
+    names.append(name)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(viewset, request, *args, **kwargs):
+            cache = get_cache()
+            key = response_key(name, request, [ALL, *get_scopes(request)])
+            cached_response = cache.get(key)
+            if cached_response is not None:
+                increment(cache, counter_key(name, 'hits'), 1)
+                data, headers = cached_response
+                response = Response(data, headers=headers)
+                response['X-Cache'] = 'HIT'
+                return not_modified(request, response) or response
+
+            increment(cache, counter_key(name, 'misses'), 1)
+            response = view(viewset, request, *args, **kwargs)
+            if response.status_code == 200:
+                headers = {header: response[header] for header in CACHED_HEADERS
+                           if response.has_header(header)}
+                cache.set(key, (response.data, headers), CACHE_TIMEOUT)
+            response['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+def get_stats():
+    cache = get_cache()
+    counters = cache.get_many([counter_key(name, outcome)
+                               for name in names for outcome in OUTCOMES])
+    return {name: {outcome: counters.get(counter_key(name, outcome), 0)
+                   for outcome in OUTCOMES}
+            for name in names}
+
+
+def reset_stats():
+    get_cache().delete_many([counter_key(name, outcome)
+                             for name in names for outcome in OUTCOMES])
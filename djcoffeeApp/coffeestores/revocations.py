@@ -0,0 +1,141 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+from coffeestores import models
+
+
+# Revoked ids rebuilt from scratch this often, dropping the expired ones
+BLOOM_REBUILD = 60 * 60
+BLOOM_ERROR_RATE = 0.001
+# Loads read the revocations of this long before the previous load again.
+# Ids and times are taken before the insert commits, a revocation committed
+# late sorts before ones already loaded
+LOAD_OVERLAP = 5 * 60
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        capacity = max(capacity, 1024)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.capacity = capacity
+        self.count = 0
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, value):
+        # Double hashing over one digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(value))
+
+
+class RevokedFilter:
+    # Revoked ids of this process, and those of others once loaded. Those
+    # are loaded every REVOKED_TOKENS_BLOOM_REFRESH seconds, so a token
+    # another process revoked passes here for at most that long
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.loaded_from = None
+        self.loaded_at = self.built_at = 0
+
+    def rebuild(self):
+        started = timezone.now()
+        jtis = list(models.RevokedToken.objects.filter(
+            expires_at__gt=started).values_list('jti', flat=True))
+        bloom = BloomFilter(2 * len(jtis))
+        for jti in jtis:
+            bloom.add(jti)
+        self.bloom = bloom
+        self.loaded_from = started
+        self.loaded_at = self.built_at = time.monotonic()
+
+    def load(self):
+        started = timezone.now()
+        jtis = models.RevokedToken.objects.filter(
+            revoked_at__gte=self.loaded_from - timedelta(seconds=LOAD_OVERLAP)
+        ).values_list('jti', flat=True)
+        for jti in jtis:
+            # Seen again within the overlap, counted once
+            if jti not in self.bloom:
+                self.bloom.add(jti)
+        self.loaded_from = started
+        self.loaded_at = time.monotonic()
+
+    def refresh(self):
+        now = time.monotonic()
+        if self.bloom is not None and now - self.loaded_at < settings.REVOKED_TOKENS_BLOOM_REFRESH:
+            return
+        with self.lock:
+            if (self.bloom is None or now - self.built_at > BLOOM_REBUILD
+                    or self.bloom.count > self.bloom.capacity):
+                self.rebuild()
+            elif now - self.loaded_at >= settings.REVOKED_TOKENS_BLOOM_REFRESH:
+                self.load()
+
+    def add(self, jti):
+        with self.lock:
+            if self.bloom is not None:
+                self.bloom.add(jti)
+
+    def __contains__(self, jti):
+        self.refresh()
+        return jti in self.bloom
+
+
+revoked = RevokedFilter()
+
+
+def revoke(token):
+    # False when the token was revoked already
+    jti = token[api_settings.JTI_CLAIM]
+    expires_at = datetime_from_epoch(token['exp'])
+    try:
+        with transaction.atomic():
+            models.RevokedToken.objects.create(jti=jti, expires_at=expires_at)
+    except IntegrityError:
+        return False
+    revoked.add(jti)
+    return True
+
+
+def is_revoked(jti):
+    # Most tokens were never revoked, the filter answers those without a query
+    if settings.REVOKED_TOKENS_BLOOM and jti not in revoked:
+        return False
+    return models.RevokedToken.objects.filter(jti=jti).exists()
+
+
+def rotate(token):
+    # The same claims under a new id and expiry, the old token is revoked.
+    # None when it was used before, the token may have been stolen
+    if not revoke(token):
+        return None
+    token.set_jti()
+    token.set_exp()
+    token.set_iat()
+    return token
+
+
+def prune():
+    # Expired tokens are refused for their expiry, their ids are not needed
+    deleted, _ = models.RevokedToken.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
@@ -0,0 +1,35 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+
+SHOP_OWNER = 'shop owner'
+CACHE_TIMEOUT = 60 * 60
+
+
+def cache_key(user_id):
+    return 'roles:%s' % user_id
+
+
+def get_identity(user_id):
+    # Group names and flags of a user, {'exists': False} once deleted
+    key = cache_key(user_id)
+    identity = cache.get(key)
+    if identity is None:
+        rows = list(User.objects.filter(id=user_id).values_list(
+            'is_active', 'is_staff', 'is_superuser', 'groups__name'))
+        identity = {'exists': bool(rows)}
+        if rows:
+            identity.update(zip(['is_active', 'is_staff', 'is_superuser'], rows[0][:3]))
+            identity['roles'] = [row[3] for row in rows if row[3] is not None]
+        cache.set(key, identity, CACHE_TIMEOUT)
+    return identity
+
+
+def get_roles(user):
+    if not user or not user.is_authenticated:
+        return set()
+    return set(get_identity(user.id).get('roles', []))
+
+
+def invalidate(user_ids):
+    cache.delete_many([cache_key(user_id) for user_id in user_ids])
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+from coffeestores import revocations
+
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        # Jobs run inside the request that enqueues them
+        settings.JOBS_EAGER = True
+        # Hashing at the production work factor would dominate the run time
+        settings.PASSWORD_HASH_ITERATIONS = 1000
+        # Loaded once below, tests revoke tokens in this process
+        settings.REVOKED_TOKENS_BLOOM_REFRESH = float('inf')
+
+    def setup_databases(self, **kwargs):
+        config = super().setup_databases(**kwargs)
+        revocations.revoked.rebuild()
+        return config
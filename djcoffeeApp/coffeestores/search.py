@@ -0,0 +1,242 @@
+import difflib
+import re
+
+from django.apps import apps as global_apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection as default_connection
+from django.utils.module_loading import import_string
+
+from coffeestores import aggregates
+
+
+# kind: (model, title field, body field)
+DOCUMENTS = {
+    'shop': ('CoffeeShop', 'name', 'address'),
+    'drink': ('CoffeeDrink', 'name', None),
+    'review': ('Review', None, 'notes'),
+}
+KINDS = {model_name: kind for kind, (model_name, title, body) in DOCUMENTS.items()}
+MAX_TERMS = 8
+MAX_CORRECTIONS = 3
+CORRECTION_CUTOFF = 0.75
+
+
+class SearchBackend:
+    install_sql = []
+    uninstall_sql = []
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def install(self, schema_editor):
+        for statement in self.install_sql:
+            schema_editor.execute(statement)
+
+    def uninstall(self, schema_editor):
+        for statement in self.uninstall_sql:
+            schema_editor.execute(statement)
+
+    def fetch(self, sql, params):
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def expand(self, term):
+        # Every term matches as a prefix, one no indexed word starts with
+        # is replaced by the closest indexed words
+        if self.has_prefix(term):
+            return [term]
+        return self.corrections(term) or [term]
+
+    def closest(self, term, words):
+        # Compares with the start of each word, queries are often typed halfway
+        matcher = difflib.SequenceMatcher(b=term)
+        scored = []
+        for word in set(words):
+            matcher.set_seq1(word[:len(term) + 1])
+            if (matcher.real_quick_ratio() >= CORRECTION_CUTOFF
+                    and matcher.quick_ratio() >= CORRECTION_CUTOFF
+                    and matcher.ratio() >= CORRECTION_CUTOFF):
+                scored.append((-matcher.ratio(), word))
+        return [word for ratio, word in sorted(scored)[:MAX_CORRECTIONS]]
+
+    def has_prefix(self, term):
+        raise NotImplementedError
+
+    def corrections(self, term):
+        raise NotImplementedError
+
+    def search(self, groups, kinds, limit):
+        # groups are lists of alternatives, a document has to match one
+        # alternative of every group. Returns (kind, id, title, body, rank)
+        # rows, best first
+        raise NotImplementedError
+
+
+class SqliteBackend(SearchBackend):
+    # FTS5 index with the documents table as external content, triggers
+    # keep it in sync with every write to that table
+    install_sql = [
+        "CREATE VIRTUAL TABLE coffeestores_search USING fts5("
+        "title, body, content='coffeestores_searchdocument', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2')",
+        "CREATE VIRTUAL TABLE coffeestores_search_vocab "
+        "USING fts5vocab(coffeestores_search, 'row')",
+        "CREATE TRIGGER coffeestores_search_insert AFTER INSERT ON "
+        "coffeestores_searchdocument BEGIN "
+        "INSERT INTO coffeestores_search(rowid, title, body) "
+        "VALUES (new.id, new.title, new.body); END",
+        "CREATE TRIGGER coffeestores_search_delete AFTER DELETE ON "
+        "coffeestores_searchdocument BEGIN "
+        "INSERT INTO coffeestores_search(coffeestores_search, rowid, title, body) "
+        "VALUES ('delete', old.id, old.title, old.body); END",
+        "CREATE TRIGGER coffeestores_search_update AFTER UPDATE ON "
+        "coffeestores_searchdocument BEGIN "
+        "INSERT INTO coffeestores_search(coffeestores_search, rowid, title, body) "
+        "VALUES ('delete', old.id, old.title, old.body); "
+        "INSERT INTO coffeestores_search(rowid, title, body) "
+        "VALUES (new.id, new.title, new.body); END",
+        "INSERT INTO coffeestores_search(coffeestores_search) VALUES ('rebuild')",
+    ]
+    uninstall_sql = [
+        'DROP TRIGGER IF EXISTS coffeestores_search_insert',
+        'DROP TRIGGER IF EXISTS coffeestores_search_delete',
+        'DROP TRIGGER IF EXISTS coffeestores_search_update',
+        'DROP TABLE IF EXISTS coffeestores_search_vocab',
+        'DROP TABLE IF EXISTS coffeestores_search',
+    ]
+    # Title matches weigh more than body matches
+    rank = 'bm25(coffeestores_search, 10.0, 1.0)'
+
+    def has_prefix(self, term):
+        return bool(self.fetch('SELECT 1 FROM coffeestores_search_vocab '
+                               'WHERE term >= %s AND term < %s LIMIT 1',
+                               [term, term + '\U0010ffff']))
+
+    def corrections(self, term):
+        rows = self.fetch('SELECT term FROM coffeestores_search_vocab '
+                          'WHERE term >= %s AND term < %s',
+                          [term[0], chr(ord(term[0]) + 1)])
+        return self.closest(term, [row[0] for row in rows])
+
+    def search(self, groups, kinds, limit):
+        match = ' AND '.join('(%s)' % ' OR '.join('"%s"*' % term for term in group)
+                             for group in groups)
+        rows = self.fetch(
+            'SELECT d.kind, d.object_id, d.title, d.body, %s AS rank '
+            'FROM coffeestores_search JOIN coffeestores_searchdocument d '
+            'ON d.id = coffeestores_search.rowid '
+            'WHERE coffeestores_search MATCH %%s AND d.kind IN (%s) '
+            'ORDER BY rank LIMIT %%s' % (self.rank, ', '.join(['%s'] * len(kinds))),
+            [match, *kinds, limit])
+        return [(kind, object_id, title, body, -rank)
+                for kind, object_id, title, body, rank in rows]
+
+
+class PostgresBackend(SearchBackend):
+    # GIN index on a tsvector expression for matching and a trigram index
+    # to find words close to a misspelled term
+    text = "(title || ' ' || body)"
+    vector = "to_tsvector('simple', %s)" % text
+    install_sql = [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE INDEX coffeestores_search_vector_idx '
+        'ON coffeestores_searchdocument USING gin ((%s))' % vector,
+        'CREATE INDEX coffeestores_search_trigram_idx '
+        'ON coffeestores_searchdocument USING gin (%s gin_trgm_ops)' % text,
+    ]
+    uninstall_sql = [
+        'DROP INDEX IF EXISTS coffeestores_search_vector_idx',
+        'DROP INDEX IF EXISTS coffeestores_search_trigram_idx',
+    ]
+    rank = ("ts_rank(setweight(to_tsvector('simple', title), 'A') || "
+            "setweight(to_tsvector('simple', body), 'D'), query)")
+
+    def has_prefix(self, term):
+        return bool(self.fetch('SELECT 1 FROM coffeestores_searchdocument '
+                               "WHERE %s @@ to_tsquery('simple', %%s) LIMIT 1" % self.vector,
+                               [term + ':*']))
+
+    def corrections(self, term):
+        rows = self.fetch(
+            "SELECT DISTINCT regexp_split_to_table(lower(%s), '[^[:alnum:]]+') "
+            'FROM (SELECT title, body FROM coffeestores_searchdocument '
+            'WHERE %%s <%%%% %s LIMIT 100) documents' % (self.text, self.text),
+            [term])
+        return self.closest(term, [row[0] for row in rows if row[0]])
+
+    def search(self, groups, kinds, limit):
+        query = ' & '.join('(%s)' % ' | '.join(term + ':*' for term in group)
+                           for group in groups)
+        return self.fetch(
+            'SELECT kind, object_id, title, body, %s AS rank '
+            "FROM coffeestores_searchdocument, to_tsquery('simple', %%s) query "
+            'WHERE %s @@ query AND kind = ANY(%%s) '
+            'ORDER BY rank DESC LIMIT %%s' % (self.rank, self.vector),
+            [query, list(kinds), limit])
+
+
+BACKENDS = {'sqlite': SqliteBackend, 'postgresql': PostgresBackend}
+
+
+def get_backend(connection=default_connection):
+    path = getattr(settings, 'SEARCH_BACKEND', None)
+    backend_class = import_string(path) if path else BACKENDS.get(connection.vendor)
+    if backend_class is None:
+        raise ImproperlyConfigured('No search backend for %s, set SEARCH_BACKEND'
+                                   % connection.vendor)
+    return backend_class(connection)
+
+
+def get_terms(query):
+    # Same word boundaries as the FTS5 unicode61 tokenizer
+    return re.findall(r'[^\W_]+', query.lower())[:MAX_TERMS]
+
+
+def document_fields(kind):
+    model_name, title, body = DOCUMENTS[kind]
+    return [field for field in (title, body) if field]
+
+
+def make_document(SearchDocument, kind, instance):
+    model_name, title, body = DOCUMENTS[kind]
+    return SearchDocument(kind=kind, object_id=instance.pk,
+                          title=(getattr(instance, title) or '')[:255] if title else '',
+                          body=(getattr(instance, body) or '') if body else '')
+
+
+def index_objects(kind, instances, apps=global_apps):
+    SearchDocument = apps.get_model('coffeestores', 'SearchDocument')
+    SearchDocument.objects.bulk_create(
+        [make_document(SearchDocument, kind, instance) for instance in instances],
+        update_conflicts=True, unique_fields=['kind', 'object_id'],
+        update_fields=['title', 'body'])
+
+
+def remove_objects(kind, ids):
+    SearchDocument = global_apps.get_model('coffeestores', 'SearchDocument')
+    SearchDocument.objects.filter(kind=kind, object_id__in=ids).delete()
+
+
+def rebuild_index(batch_size=1000, apps=global_apps):
+    apps.get_model('coffeestores', 'SearchDocument').objects.all().delete()
+    count = 0
+    for kind, (model_name, title, body) in DOCUMENTS.items():
+        queryset = apps.get_model('coffeestores', model_name).objects.only(
+            'id', *document_fields(kind))
+        for batch in aggregates.batches(queryset, batch_size):
+            index_objects(kind, batch, apps)
+            count += len(batch)
+    return count
+
+
+def search(query, kinds=None, limit=20):
+    terms = get_terms(query)
+    if not terms:
+        return []
+    backend = get_backend()
+    rows = backend.search([backend.expand(term) for term in terms],
+                          kinds or list(DOCUMENTS), limit)
+    return [{'kind': kind, 'id': object_id, 'title': title, 'body': body, 'rank': rank}
+            for kind, object_id, title, body, rank in rows]
@@ -1,13 +1,71 @@
+from django.utils import timezone
 from rest_framework import serializers
 
-from coffeestores import models
+from coffeestores import images, models
+
+
+def set_derived_fields(instance):
+    # bulk_create and bulk_update skip the pre_save signal that does this
+    if hasattr(instance, 'set_derived_fields'):
+        return instance.set_derived_fields()
+    return []
+
+
+class BulkListSerializer(serializers.ListSerializer):
+    def create(self, validated_data):
+        model = self.child.Meta.model
+        instances = [model(**attrs) for attrs in validated_data]
+        for instance in instances:
+            set_derived_fields(instance)
+        return model.objects.bulk_create(instances)
+
+    def update(self, instances, validated_data):
+        fields = set()
+        for instance, attrs in zip(instances, validated_data):
+            for attr, value in attrs.items():
+                setattr(instance, attr, value)
+            fields.update(attrs)
+            fields.update(set_derived_fields(instance))
+        if fields:
+            # bulk_update skips auto_now too
+            now = timezone.now()
+            for instance in instances:
+                instance.updated_at = now
+            fields.add('updated_at')
+            self.child.Meta.model.objects.bulk_update(instances, list(fields))
+        return instances
+
+
+class PhotoVariantsField(serializers.ReadOnlyField):
+    def __init__(self, **kwargs):
+        super().__init__(source='*', **kwargs)
+
+    def to_representation(self, instance):
+        return images.get_urls(instance)
+
+
+class PrefetchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    # Resolves ids from context['prefetched'][field_name] when the caller
+    # already loaded the related objects in bulk
+    def to_internal_value(self, data):
+        prefetched = self.context.get('prefetched', {}).get(self.field_name)
+        if prefetched is None:
+            return super().to_internal_value(data)
+        if isinstance(data, bool) or not str(data).isdigit():
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if int(data) not in prefetched:
+            self.fail('does_not_exist', pk_value=data)
+        return prefetched[int(data)]
 
 
 class CoffeeDrinkerSerializer(serializers.ModelSerializer):
+    photo_variants = PhotoVariantsField()
+
     class Meta:
         model = models.CoffeeDrinker
         fields = ['id', 'username', 'password', 
-                  'first_name', 'last_name', 'email', 'education', 'photo']
+                  'first_name', 'last_name', 'email', 'education', 'photo',
+                  'photo_variants']
 
     def update(self, instance, data):
         if 'first_name' in list(data):
@@ -22,7 +80,8 @@ class CoffeeDrinkerSerializer(serializers.ModelSerializer):
         return instance
 
     def upload(self, instance, file):
-        instance.photo = file
+        # Photos the upload handler streamed into storage are assigned by name
+        instance.photo = getattr(file, 'stored_name', file)
         instance.save()
         return instance
 
@@ -41,11 +100,26 @@ class DescriptorSeralizer(serializers.ModelSerializer):
         fields = ['id', 'name', 'description', 'color', 'parent']
 
 
+class DescriptorTreeSerializer(serializers.ModelSerializer):
+    children = serializers.ListField(child=serializers.DictField(), read_only=True)
+
+    class Meta:
+        model = models.Descriptor
+        fields = ['id', 'name', 'description', 'color', 'parent', 'children']
+
+
 class CoffeeDrinkSerializer(serializers.ModelSerializer):
     # photo = serializers.ImageField(required=False, null=True)
+    shop = PrefetchedPrimaryKeyRelatedField(queryset=models.CoffeeShop.objects.all())
+    photo_variants = PhotoVariantsField()
+
     class Meta:
         model = models.CoffeeDrink
-        fields = ['id', 'name', 'price', 'shop', 'volume', 'photo']
+        list_serializer_class = BulkListSerializer
+        fields = ['id', 'name', 'price', 'shop', 'volume', 'price_per_ml', 'photo',
+                  'photo_variants', 'review_count', 'rating_mean', 'rating_histogram']
+        read_only_fields = ['price_per_ml', 'review_count', 'rating_mean',
+                            'rating_histogram']
         '''
 
     def update(self, instance, data):
@@ -60,10 +134,32 @@ class CoffeeDrinkSerializer(serializers.ModelSerializer):
     '''
 
     def upload(self, instance, file):
-        instance.photo = file
+        # Photos the upload handler streamed into storage are assigned by name
+        instance.photo = getattr(file, 'stored_name', file)
         instance.save()
         return instance
 
+class DrinkSearchSerializer(CoffeeDrinkSerializer):
+    mentions = serializers.IntegerField(read_only=True)
+
+    class Meta(CoffeeDrinkSerializer.Meta):
+        fields = CoffeeDrinkSerializer.Meta.fields + ['mentions']
+
+class FlavorProfileSerializer(serializers.ModelSerializer):
+    descriptors = serializers.SerializerMethodField()
+
+    class Meta:
+        model = models.FlavorProfile
+        fields = ['drink', 'review_count', 'descriptors']
+
+    def get_descriptors(self, profile):
+        return [{'id': int(descriptor_id),
+                 'reviews': reviews,
+                 'frequency': round(reviews / max(profile.review_count, 1), 4),
+                 'mean_intensity': round(total / count, 2) if count else None}
+                for descriptor_id, (reviews, total, count)
+                in sorted(profile.descriptors.items(), key=lambda item: int(item[0]))]
+
 class ImageSerializer(serializers.Serializer):
     photo = serializers.ImageField(required=True)
     class Meta:
@@ -82,15 +178,29 @@ class CoffeeDrinkPutSerializer(serializers.Serializer):
 
 
 class CoffeeShopSerializer(serializers.ModelSerializer):
-    drinks = CoffeeDrinkSerializer(default=None)
+    drinks = CoffeeDrinkSerializer(many=True, read_only=True, source='coffeedrink_set')
     class Meta:
         model = models.CoffeeShop
-        fields = ['id', 'name', 'address', 'drinks']
+        list_serializer_class = BulkListSerializer
+        fields = ['id', 'name', 'address', 'owner', 'latitude', 'longitude', 'drinks',
+                  'review_count', 'rating_mean', 'rating_histogram']
+        read_only_fields = ['owner', 'review_count', 'rating_mean', 'rating_histogram']
+        extra_kwargs = {'latitude': {'min_value': -90, 'max_value': 90},
+                        'longitude': {'min_value': -180, 'max_value': 180}}
+
+    def validate(self, attrs):
+        if ('latitude' in attrs) != ('longitude' in attrs) or \
+                (attrs.get('latitude') is None) != (attrs.get('longitude') is None):
+            raise serializers.ValidationError('Latitude and longitude go together')
+        return attrs
 
     def create(self, validated_data):
         name = validated_data['name']
         address = validated_data['address']
-        instance = self.Meta.model(name=name, address=address)
+        owner_id = validated_data.get('owner_id')
+        instance = self.Meta.model(name=name, address=address, owner_id=owner_id,
+                                   latitude=validated_data.get('latitude'),
+                                   longitude=validated_data.get('longitude'))
         instance.save()
         return instance
     '''
@@ -103,27 +213,39 @@ class CoffeeShopSerializer(serializers.ModelSerializer):
         return instance
     '''
 
+class NearbyShopSerializer(CoffeeShopSerializer):
+    distance = serializers.FloatField(read_only=True)
+
+    class Meta(CoffeeShopSerializer.Meta):
+        fields = CoffeeShopSerializer.Meta.fields + ['distance']
+
+
 class CoffeeShopPutSerializer(serializers.Serializer):
     id = serializers.IntegerField(required=True)
     name = serializers.CharField(max_length=63, required=False)
     address = serializers.CharField(max_length=255, required=False)
+    latitude = serializers.FloatField(required=False, allow_null=True)
+    longitude = serializers.FloatField(required=False, allow_null=True)
     class Meta:
         model = models.CoffeeShop
-        fields = ['id', 'name', 'address']
+        fields = ['id', 'name', 'address', 'latitude', 'longitude']
 
 
 class ReviewSerializer(serializers.ModelSerializer):
     # descriptors = Jso(required=False)
-    author = serializers.IntegerField(required=False, source='author.id')
+    author = serializers.IntegerField(source='author_id', read_only=True)
+    drink = PrefetchedPrimaryKeyRelatedField(queryset=models.CoffeeDrink.objects.only('id'),
+                                             required=False, allow_null=True)
 
     class Meta:
         model = models.Review
         fields = ['drink', 'id', 'author', 'notes', 'descriptors', 'overall_rating']
 
-    def set_author(self, instance, user):
-        instance.author = user
-        instance.save()
-        return instance
+    def validate(self, attrs):
+        # New reviews are of a drink, updates may leave it out
+        if self.instance is None and attrs.get('drink') is None:
+            raise serializers.ValidationError({'drink': 'This field is required.'})
+        return attrs
 
     '''
     def update(self, instance, data):
@@ -141,8 +263,24 @@ class ReviewSerializer(serializers.ModelSerializer):
 class ReviewPutSerializer(serializers.Serializer):
     notes = serializers.CharField(required=False)
     descriptors = serializers.JSONField(default=dict, required=False)
-    overall_rating = serializers.DecimalField(max_digits=2, 
-                                              decimal_places=1, required=False)
+    overall_rating = serializers.DecimalField(max_digits=2, decimal_places=1, required=False,
+                                              min_value=0, max_value=5)
+
+
+class JobSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = models.Job
+        fields = ['id', 'name', 'status', 'attempts', 'max_attempts', 'run_at',
+                  'started_at', 'finished_at', 'result', 'last_error', 'created_at']
+
+
+class SearchResultSerializer(serializers.Serializer):
+    kind = serializers.CharField()
+    id = serializers.IntegerField()
+    title = serializers.CharField()
+    body = serializers.CharField()
+    rank = serializers.FloatField()
 
 
 class TokenSerializer(serializers.Serializer):
@@ -0,0 +1,134 @@
+from django.contrib.auth.models import Group, User
+from django.db.models.signals import (m2m_changed, post_delete, post_init, post_save,
+                                      pre_delete, pre_save)
+from django.dispatch import receiver
+from django.utils import timezone
+
+from coffeestores import aggregates, descriptors, models, responses, roles, search, storage
+
+
+def group_members(group):
+    return group.user_set.values_list('id', flat=True)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear', 'post_clear'):
+        return
+    if not reverse:
+        roles.invalidate([instance.pk])
+    elif pk_set:
+        roles.invalidate(pk_set)
+    elif action == 'pre_clear':
+        roles.invalidate(group_members(instance))
+
+
+@receiver(post_save, sender=Group)
+@receiver(pre_delete, sender=Group)
+def group_changed(sender, instance, created=False, **kwargs):
+    if not created:
+        roles.invalidate(group_members(instance))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=models.CoffeeDrinker)
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=models.CoffeeDrinker)
+def user_changed(sender, instance, **kwargs):
+    # Flags may have changed, and ids can be reused after a delete, never
+    # trust an identity cached before. Senders are listed so other models
+    # keep their fast deletes
+    roles.invalidate([instance.pk])
+
+
+@receiver(pre_save, sender=models.Descriptor)
+def descriptor_saving(sender, instance, raw, **kwargs):
+    if not raw:
+        instance._paths = descriptors.get_paths(instance)
+
+
+@receiver(post_save, sender=models.Descriptor)
+def descriptor_saved(sender, instance, raw, **kwargs):
+    if not raw:
+        descriptors.move(instance, *instance._paths)
+    descriptors.invalidate()
+
+
+@receiver(post_delete, sender=models.Descriptor)
+def descriptor_deleted(sender, instance, **kwargs):
+    descriptors.invalidate()
+
+
+@receiver(post_save, sender=models.CoffeeShop)
+@receiver(post_save, sender=models.CoffeeDrink)
+@receiver(post_save, sender=models.Review)
+def searchable_saved(sender, instance, raw, update_fields=None, **kwargs):
+    kind = search.KINDS[sender.__name__]
+    if update_fields is not None and not set(update_fields) & set(search.document_fields(kind)):
+        return
+    search.index_objects(kind, [instance])
+
+
+@receiver(post_delete, sender=models.CoffeeShop)
+@receiver(post_delete, sender=models.CoffeeDrink)
+@receiver(post_delete, sender=models.Review)
+def searchable_deleted(sender, instance, **kwargs):
+    search.remove_objects(search.KINDS[sender.__name__], [instance.pk])
+
+
+@receiver(pre_save, sender=models.CoffeeShop)
+@receiver(pre_save, sender=models.CoffeeDrink)
+def derived_fields_saving(sender, instance, **kwargs):
+    instance.set_derived_fields()
+
+
+@receiver(post_save, sender=models.CoffeeShop)
+@receiver(post_delete, sender=models.CoffeeShop)
+def shop_changed(sender, instance, **kwargs):
+    responses.invalidate_shops([instance.pk])
+
+
+@receiver(post_save, sender=models.CoffeeDrink)
+@receiver(post_delete, sender=models.CoffeeDrink)
+def drink_changed(sender, instance, **kwargs):
+    responses.invalidate_drinks([instance])
+
+
+@receiver(pre_delete, sender=models.CoffeeDrink)
+def drink_deleting(sender, instance, **kwargs):
+    # Its reviews go with it, so do their ratings on the shop. Read under lock
+    # in the delete's transaction, the instance's totals may be stale
+    drink = models.CoffeeDrink.objects.select_for_update().filter(pk=instance.pk).first()
+    if drink is not None:
+        aggregates.move_drinks([(drink, drink.shop_id, None)])
+
+
+@receiver(pre_delete, sender=models.CoffeeDrinker)
+def author_deleting(sender, instance, **kwargs):
+    # Their reviews lose the author by an UPDATE that leaves updated_at alone
+    models.Review.objects.filter(author=instance).update(updated_at=timezone.now())
+
+
+
+@receiver(post_init, sender=models.CoffeeDrink)
+@receiver(post_init, sender=models.CoffeeDrinker)
+def photo_loaded(sender, instance, **kwargs):
+    # The stored name, to tell which blob a save or delete lets go of
+    photo = instance.__dict__.get('photo')
+    instance._photo_before = photo if isinstance(photo, str) else None
+
+
+@receiver(post_save, sender=models.CoffeeDrink)
+@receiver(post_save, sender=models.CoffeeDrinker)
+def photo_saved(sender, instance, created, raw, update_fields=None, **kwargs):
+    if raw or update_fields is not None and 'photo' not in update_fields:
+        return
+    before = None if created else instance._photo_before
+    instance._photo_before = instance.photo.name
+    storage.replace(before, instance._photo_before)
+
+
+@receiver(post_delete, sender=models.CoffeeDrink)
+@receiver(post_delete, sender=models.CoffeeDrinker)
+def photo_deleted(sender, instance, **kwargs):
+    storage.release(instance._photo_before)
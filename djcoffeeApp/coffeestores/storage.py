@@ -0,0 +1,214 @@
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+import time
+from collections import Counter
+
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import transaction
+from django.db.models import F
+
+from coffeestores import models
+
+
+# Photos are stored as <upload_to>/<sha256 of the bytes>.<extension>
+BLOB_NAME = re.compile(r'^[0-9a-f]{64}(\.\w+)?$')
+TEMP_PREFIX = '.upload-'
+VARIANTS_DIR = 'variants'
+# Files younger than this may belong to a write that is not committed yet
+SWEEP_GRACE = 60 * 60
+
+
+class BlobWriter:
+    # Hashes the bytes while writing them to a temporary file next to their
+    # destination, close() renames it into place
+    def __init__(self, storage, directory):
+        self.storage = storage
+        self.directory = directory
+        self.digest = hashlib.sha256()
+        self.size = 0
+        os.makedirs(storage.path(directory), exist_ok=True)
+        fd, self.temp = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=storage.path(directory))
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self.digest.update(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def close(self, extension):
+        self.file.close()
+        name = posixpath.join(self.directory, self.digest.hexdigest() + extension)
+        if self.storage.exists(name):
+            os.remove(self.temp)
+        else:
+            os.chmod(self.temp, self.storage.file_permissions_mode or 0o644)
+            os.replace(self.temp, self.storage.path(name))
+        return name
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp):
+            os.remove(self.temp)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    # Files are named after their content, the same bytes are stored once
+    # whatever name they were uploaded under
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def open_writer(self, directory):
+        return BlobWriter(self, directory)
+
+    def _save(self, name, content):
+        directory, basename = posixpath.split(name)
+        writer = self.open_writer(directory)
+        try:
+            for chunk in content.chunks():
+                writer.write(chunk)
+            return writer.close(os.path.splitext(basename)[1].lower())
+        except BaseException:
+            writer.abort()
+            raise
+
+
+def is_blob(name):
+    if not name:
+        return False
+    directory, basename = posixpath.split(name)
+    return posixpath.basename(directory) != VARIANTS_DIR and bool(BLOB_NAME.match(basename))
+
+
+def acquire(name):
+    # Call inside the transaction of the row that now references name
+    if not is_blob(name):
+        return
+    if models.Blob.objects.filter(name=name).update(references=F('references') + 1):
+        return
+    # The row is new or delete_unreferenced() just took it along with the
+    # file, which a writer may have found in place before. Not committed
+    # pointing at a file that is gone
+    if not default_storage.exists(name):
+        raise FileNotFoundError(name)
+    models.Blob.objects.bulk_create([models.Blob(name=name, size=default_storage.size(name))],
+                                    ignore_conflicts=True)
+    models.Blob.objects.filter(name=name).update(references=F('references') + 1)
+
+
+def release(name):
+    # Call inside the transaction of the row that stopped referencing name,
+    # the file goes once that is committed and nothing took it back
+    if not is_blob(name):
+        return
+    models.Blob.objects.filter(name=name, references__gt=0).update(
+        references=F('references') - 1)
+    transaction.on_commit(lambda: delete_unreferenced([name]))
+
+
+def replace(before, after):
+    if before == after:
+        return
+    acquire(after)
+    release(before)
+
+
+def delete_unreferenced(names):
+    # The row stays locked until the file is gone, so an acquire() of the
+    # name either counts before the check or waits and finds both gone
+    removed = []
+    for name in names:
+        with transaction.atomic():
+            blob = models.Blob.objects.select_for_update().filter(name=name).first()
+            if blob is None or blob.references:
+                continue
+            blob.delete()
+            default_storage.delete(name)
+            removed.append(name)
+    return removed
+
+
+def get_photo_models():
+    return [models.CoffeeDrink, models.CoffeeDrinker]
+
+
+def recount():
+    # Call inside a transaction. Blob rows are locked first, references
+    # committed while counting are counted or add themselves after
+    blobs = {blob.name: blob for blob in models.Blob.objects.select_for_update()}
+    references = Counter()
+    for model in get_photo_models():
+        names = model.objects.exclude(photo='').exclude(photo=None).values_list('photo',
+                                                                                flat=True)
+        references.update(name for name in names.iterator() if is_blob(name))
+    changed = []
+    for name, count in references.items():
+        if name not in blobs:
+            blobs[name] = models.Blob(name=name, references=count,
+                                      size=default_storage.size(name)
+                                      if default_storage.exists(name) else 0)
+            blobs[name].save()
+        elif blobs[name].references != count:
+            blobs[name].references = count
+            changed.append(blobs[name])
+    for name, blob in blobs.items():
+        if name not in references and blob.references:
+            blob.references = 0
+            changed.append(blob)
+    models.Blob.objects.bulk_update(changed, ['references'], batch_size=500)
+    return len(changed)
+
+
+def get_variant_names():
+    names = set()
+    for model in get_photo_models():
+        for variants in model.objects.exclude(photo_variants={}).values_list(
+                'photo_variants', flat=True).iterator():
+            for variant, formats in variants.items():
+                if isinstance(formats, dict):
+                    names.update(formats.values())
+    return names
+
+
+def sweep(grace=SWEEP_GRACE, dry_run=False):
+    # Reclaims the files of unreferenced photos and variants, and the
+    # leftovers of interrupted uploads. Returns (files, bytes) removed
+    with transaction.atomic():
+        recount()
+        referenced = set(models.Blob.objects.filter(references__gt=0).values_list(
+            'name', flat=True))
+        models.Blob.objects.filter(references=0).delete()
+        transaction.set_rollback(dry_run)
+    variants = get_variant_names()
+    cutoff = time.time() - grace
+    directories = {model._meta.get_field('photo').upload_to for model in get_photo_models()}
+    files = size = 0
+    for directory in directories:
+        for name in list_files(directory):
+            basename = posixpath.basename(name)
+            if basename.startswith(TEMP_PREFIX):
+                orphan = True
+            elif posixpath.basename(posixpath.dirname(name)) == VARIANTS_DIR:
+                orphan = name not in variants
+            else:
+                orphan = is_blob(name) and name not in referenced
+            if not orphan or os.path.getmtime(default_storage.path(name)) > cutoff:
+                continue
+            files += 1
+            size += default_storage.size(name)
+            if not dry_run:
+                default_storage.delete(name)
+    return files, size
+
+
+def list_files(directory):
+    if not default_storage.exists(directory):
+        return
+    subdirectories, files = default_storage.listdir(directory)
+    for name in files:
+        yield posixpath.join(directory, name)
+    for subdirectory in subdirectories:
+        yield from list_files(posixpath.join(directory, subdirectory))
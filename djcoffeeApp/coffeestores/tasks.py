@@ -0,0 +1,19 @@
+from coffeestores import descriptors, flavors, images, jobs, models
+
+
+def review_change(review, delta):
+    return [review.drink_id, review.descriptors, delta]
+
+
+@jobs.task('reviews.changed')
+def reviews_changed(review_ids, changes):
+    # changes are review_change() of the reviews before and after the write,
+    # their ratings are applied with the write itself
+    descriptors.index_reviews(list(models.Review.objects.filter(id__in=review_ids).only(
+        'id', 'drink_id', 'descriptors')))
+    flavors.update_profiles(changes)
+
+
+@jobs.task('images.variants')
+def photo_variants(model_label, pk, source):
+    images.process(model_label, pk, source)
@@ -1,8 +1,30 @@
+import csv
+import gzip
+import json
+import os
+import tempfile
+import tracemalloc
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+
+from PIL import Image, PngImagePlugin
 from rest_framework.test import APITestCase
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth.models import Group
 
-from coffeestores import models, serializers
+from coffeestores import aggregates, descriptors, geo, images, jobs, models, responses
+from coffeestores import revocations, serializers, storage, uploads
 
 
 class CoffeeShopViewSetTestCase(APITestCase):
@@ -41,6 +63,8 @@ class CoffeeShopViewSetTestCase(APITestCase):
         shop_owner.save()
         shop_owner.groups.add(owner_group)
         shop_owner.save()
+        # Shops without an owner are for staff only
+        models.CoffeeShop.objects.update(owner=shop_owner)
 
     def test_coffeeshop_list(self):
         url = reverse('shops')
@@ -217,6 +241,1725 @@ class CoffeeShopViewSetTestCase(APITestCase):
         self.assertEqual(data['address'], 'test111')
 
 
+class CoffeeShopQueryCountTestCase(APITestCase):
+    def create_shops(self, count):
+        shops = models.CoffeeShop.objects.bulk_create(
+            [models.CoffeeShop(name='shop%d' % i, address='addr%d' % i)
+             for i in range(models.CoffeeShop.objects.count(), count)])
+        models.CoffeeDrink.objects.bulk_create(
+            [models.CoffeeDrink(name='drink', price='1.00', volume=100, shop=shop)
+             for shop in shops[:50] for _ in range(3)])
+        # Bulk inserts skip the signals, like the importer
+        responses.clear()
+
+    def test_coffeeshop_list_queries(self):
+        url = reverse('shops')
+
+        # count + page + drinks prefetch, regardless of the table size, and
+        # count and newest change of shops and drinks for the ETag
+        for size in [10, 1000, 100000]:
+            self.create_shops(size)
+            with self.assertNumQueries(7):
+                response = self.client.get(url, format='json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['count'], size)
+            self.assertEqual(len(response.data['results']), 10)
+            self.assertEqual(len(response.data['results'][0]['drinks']), 3)
+
+            with self.assertNumQueries(7):
+                response = self.client.get(url, {'ordering': '-name'}, format='json')
+            self.assertEqual(response.status_code, 200)
+
+    def test_coffeeshop_one_shop_queries(self):
+        url = reverse('shops')
+        self.create_shops(10)
+
+        # ETag + shop + drinks prefetch
+        with self.assertNumQueries(3):
+            response = self.client.get(url, {'id': 1}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['drinks']), 3)
+
+
+class ResponseCacheTestCase(APITestCase):
+    def setUp(self):
+        owner_group = Group(name='shop owner')
+        owner_group.save()
+        response = self.client.post(reverse('auth-register'),
+                                    {'username': 'owner', 'password': 'test'},
+                                    format='json')
+        self.headers = {'Authorization': 'Bearer ' + response.data['access']}
+        owner = models.CoffeeDrinker.objects.get(username='owner')
+        owner.groups.add(owner_group)
+        self.shops = []
+        for i in range(2):
+            shop = models.CoffeeShop(name='shop%d' % i, address='addr', owner=owner)
+            shop.save()
+            self.shops.append(shop)
+        self.drink = models.CoffeeDrink(name='drink', price='1.00', volume=100,
+                                        shop=self.shops[0])
+        self.drink.save()
+        responses.reset_stats()
+
+    def get(self, name, query=None, cached=None):
+        if cached:
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse(name), query, format='json')
+        else:
+            response = self.client.get(reverse(name), query, format='json')
+        self.assertEqual(response.status_code, 200)
+        if cached is not None:
+            self.assertEqual(response['X-Cache'], 'HIT' if cached else 'MISS')
+        return response.data
+
+    def test_cache(self):
+        self.get('shops', {'ordering': 'name', 'page_size': 5}, cached=False)
+        self.get('shops', {'page_size': 5, 'ordering': 'name'}, cached=True)
+        self.get('shops', {'ordering': '-name', 'page_size': 5}, cached=False)
+        for shop in self.shops:
+            self.get('shops', {'id': shop.id}, cached=False)
+        self.get('drink', {'id': self.drink.id}, cached=False)
+        self.get('drink', {'id': self.drink.id}, cached=True)
+
+        # A new drink shows in the list and its shop, the other shop is kept
+        response = self.client.post(reverse('drink'),
+                                    {'name': 'new', 'price': '2.00', 'volume': 200,
+                                     'shop': self.shops[1].id},
+                                    headers=self.headers, format='json')
+        self.assertEqual(response.status_code, 201)
+        data = self.get('shops', {'ordering': 'name', 'page_size': 5}, cached=False)
+        self.assertEqual(len(data['results'][1]['drinks']), 1)
+        data = self.get('shops', {'id': self.shops[1].id}, cached=False)
+        self.assertEqual(len(data['drinks']), 1)
+        self.get('shops', {'id': self.shops[0].id}, cached=True)
+        self.get('drink', {'id': self.drink.id}, cached=True)
+
+        # Moving a drink changes both shops
+        response = self.client.put(reverse('drink'),
+                                   {'id': self.drink.id, 'shop': self.shops[1].id},
+                                   headers=self.headers, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get('shops', {'id': self.shops[0].id}, cached=False)['drinks'],
+                         [])
+        self.assertEqual(len(self.get('shops', {'id': self.shops[1].id},
+                                      cached=False)['drinks']), 2)
+        self.assertEqual(self.get('drink', {'id': self.drink.id}, cached=False)['shop'],
+                         self.shops[1].id)
+
+        # Reviews change the ratings of the drink and its shop
+        self.get('shops', {'id': self.shops[0].id}, cached=True)
+        response = self.client.post(reverse('reviews'),
+                                    {'drink': self.drink.id, 'notes': '',
+                                     'descriptors': [], 'overall_rating': 4},
+                                    headers=self.headers, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.get('drink', {'id': self.drink.id}, cached=False)['review_count'],
+                         1)
+        self.assertEqual(self.get('shops', {'id': self.shops[1].id},
+                                  cached=False)['review_count'], 1)
+        self.get('shops', {'id': self.shops[0].id}, cached=True)
+
+        # Bulk writes and the importer
+        response = self.client.put(reverse('shops-bulk'),
+                                   [{'id': self.shops[0].id, 'name': 'renamed'}],
+                                   headers=self.headers, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get('shops', {'id': self.shops[0].id}, cached=False)['name'],
+                         'renamed')
+        responses.clear()
+        self.get('drink', {'id': self.drink.id}, cached=False)
+
+        self.assertEqual(responses.get_stats(), {'shops': {'hits': 4, 'misses': 10},
+                                                 'drink': {'hits': 2, 'misses': 4}})
+        out = StringIO()
+        call_command('response_cache_stats', '--reset', stdout=out)
+        self.assertIn('drink: 2 hits, 4 misses, 33.3% hit rate', out.getvalue())
+        self.assertEqual(responses.get_stats()['drink'], {'hits': 0, 'misses': 0})
+
+    def test_errors_not_cached(self):
+        self.client.get(reverse('drink'), {'id': 999}, format='json')
+        response = self.client.get(reverse('drink'), {'id': 999}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(responses.get_stats()['drink'], {'hits': 0, 'misses': 2})
+
+
+class ConditionalGetTestCase(APITestCase):
+    def setUp(self):
+        response = self.client.post(reverse('auth-register'),
+                                    {'username': 'test', 'password': 'test'},
+                                    format='json')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+        self.shop = models.CoffeeShop(name='shop', address='addr')
+        self.shop.save()
+        self.drink = models.CoffeeDrink(name='drink', price='1.00', volume=100,
+                                        shop=self.shop)
+        self.drink.save()
+
+    def get(self, name, query=None, **headers):
+        return self.client.get(reverse(name), query, headers=headers, format='json')
+
+    def assertNotModified(self, name, query=None, **headers):
+        response = self.get(name, query, **headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        return response
+
+    def assertModified(self, name, query=None, **headers):
+        response = self.get(name, query, **headers)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_etags(self):
+        cases = [('shops', None), ('shops', {'id': self.shop.id}),
+                 ('drink', {'id': self.drink.id}), ('reviews', {'id': self.drink.id}),
+                 ('users-me', None)]
+        etags = {}
+        for name, query in cases:
+            etag = self.assertModified(name, query)['ETag']
+            self.assertNotModified(name, query, if_none_match=etag)
+            etags[name, str(query)] = etag
+        self.assertModified('shops', {'ordering': 'name'}, if_none_match=etags['shops', 'None'])
+
+        # A review changes every one of them but the user
+        response = self.client.post(reverse('reviews'),
+                                    {'drink': self.drink.id, 'notes': '',
+                                     'descriptors': [], 'overall_rating': 4},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        for name, query in cases:
+            if name == 'users-me':
+                self.assertNotModified(name, query, if_none_match=etags[name, str(query)])
+            else:
+                etags[name, str(query)] = self.assertModified(
+                    name, query, if_none_match=etags[name, str(query)])['ETag']
+
+        response = self.client.put(reverse('users-me'), {'first_name': 'new'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertModified('users-me', if_none_match=etags['users-me', 'None'])
+
+        # Deletes leave no newer timestamp, the counts change
+        other = models.CoffeeDrink(name='other', price='1.00', volume=100, shop=self.shop)
+        other.save()
+        etag = self.assertModified('shops', {'id': self.shop.id})['ETag']
+        other.delete()
+        self.assertModified('shops', {'id': self.shop.id}, if_none_match=etag)
+
+        # So does an author deleted from under their reviews
+        etag = self.assertModified('reviews', {'id': self.drink.id})['ETag']
+        models.CoffeeDrinker.objects.get(username='test').delete()
+        self.client.credentials()
+        self.assertModified('reviews', {'id': self.drink.id}, if_none_match=etag)
+
+    def test_last_modified(self):
+        models.CoffeeDrink.objects.filter(id=self.drink.id).update(
+            updated_at=timezone.now() - timedelta(days=1))
+        last_modified = self.assertModified('drink', {'id': self.drink.id})['Last-Modified']
+        self.assertNotModified('drink', {'id': self.drink.id},
+                               if_modified_since=last_modified)
+        # Lists have rows that can leave without a newer timestamp, ETags only
+        assert not self.get('shops').has_header('Last-Modified')
+
+        self.drink.price = '2.00'
+        self.drink.save()
+        self.assertModified('drink', {'id': self.drink.id}, if_modified_since=last_modified)
+
+    def test_timestamps(self):
+        old = timezone.now() - timedelta(days=1)
+        models.CoffeeDrink.objects.update(updated_at=old)
+        models.CoffeeShop.objects.update(updated_at=old)
+        # Bulk writes skip auto_now
+        drinks = models.CoffeeDrink.objects.all()
+        serializer = serializers.CoffeeDrinkSerializer(drinks, data=[{'name': 'new'}],
+                                                       many=True, partial=True)
+        assert serializer.is_valid(), serializer.errors
+        serializer.save()
+        self.assertGreater(models.CoffeeDrink.objects.get().updated_at, old)
+
+        # Rebuilding ratings only touches rows that change
+        models.CoffeeDrink.objects.update(updated_at=old)
+        call_command('rebuild_ratings', stdout=StringIO())
+        self.assertEqual(models.CoffeeDrink.objects.get().updated_at, old)
+        models.CoffeeDrink.objects.update(review_count=3)
+        call_command('rebuild_ratings', stdout=StringIO())
+        drink = models.CoffeeDrink.objects.get()
+        self.assertEqual(drink.review_count, 0)
+        self.assertGreater(drink.updated_at, old)
+        self.assertEqual(models.CoffeeShop.objects.get().updated_at, old)
+
+
+class ImageVariantsTestCase(APITestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        owner_group = Group(name='shop owner')
+        owner_group.save()
+        response = self.client.post(reverse('auth-register'),
+                                    {'username': 'owner', 'password': 'test'},
+                                    format='json')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+        models.CoffeeDrinker.objects.get(username='owner').groups.add(owner_group)
+        shop = models.CoffeeShop(name='shop', address='addr',
+                                 owner=models.CoffeeDrinker.objects.get(username='owner'))
+        shop.save()
+        self.drinks = []
+        for i in range(2):
+            drink = models.CoffeeDrink(name='drink%d' % i, price='1.00', volume=100, shop=shop)
+            drink.save()
+            self.drinks.append(drink)
+
+    def photo(self, name='photo.jpg'):
+        # Landscape pixels the EXIF orientation turns into a portrait photo
+        image = Image.new('RGB', (1200, 600), 'red')
+        exif = image.getexif()
+        exif[0x0112] = 6
+        exif[0x010f] = 'Camera maker'
+        content = BytesIO()
+        image.save(content, 'JPEG', exif=exif)
+        return SimpleUploadedFile(name, content.getvalue(), content_type='image/jpeg')
+
+    def upload(self, url, data):
+        # The variants once the upload's job ran, a drink id goes in the query
+        drink_id = data.pop('id', None)
+        if drink_id is not None:
+            url += '?id=%s' % drink_id
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        if drink_id is not None:
+            return self.client.get(reverse('drink'), {'id': drink_id})
+        return self.client.get(reverse('users-me'))
+
+    def open_variant(self, url):
+        return Image.open(os.path.join(settings.MEDIA_ROOT, url.lstrip('/')))
+
+    def test_drink_variants(self):
+        response = self.upload(reverse('drink-upload'),
+                               {'id': self.drinks[0].id, 'photo': self.photo()})
+        variants = response.data['photo_variants']
+        self.assertEqual(set(variants), {'thumbnail', 'medium'})
+        for variant, size in [('thumbnail', (160, 160)), ('medium', (400, 800))]:
+            self.assertEqual(set(variants[variant]), {'webp', 'jpeg'})
+            for format, url in variants[variant].items():
+                with self.open_variant(url) as image:
+                    self.assertEqual(image.format, format.upper())
+                    self.assertEqual(image.size, size)
+                    self.assertEqual(dict(image.getexif()), {})
+
+        # Same picture, same files
+        response = self.upload(reverse('drink-upload'),
+                               {'id': self.drinks[1].id, 'photo': self.photo('other.jpg')})
+        self.assertEqual(response.data['photo_variants'], variants)
+
+    @override_settings(JOBS_EAGER=False)
+    def test_pending_and_stale(self):
+        # Until the worker ran there are no variants
+        url = '%s?id=%s' % (reverse('drink-upload'), self.drinks[0].id)
+        response = self.client.post(url, {'photo': self.photo()}, format='multipart')
+        self.assertIsNone(response.data['photo_variants'])
+        job = models.Job.objects.get(id=response['X-Job-Id'])
+        self.assertEqual((job.name, job.status), ('images.variants', models.Job.QUEUED))
+        self.assertEqual(jobs.run_pending(), 1)
+        response = self.client.get(reverse('drink'), {'id': self.drinks[0].id})
+        self.assertEqual(set(response.data['photo_variants']), {'thumbnail', 'medium'})
+
+        drink = models.CoffeeDrink.objects.get(id=self.drinks[0].id)
+        drink.photo_variants = {}
+        drink.save()
+        source = drink.photo.name
+        drink.photo = 'files/replaced.jpg'
+        drink.save()
+        images.process('coffeestores.CoffeeDrink', drink.id, source)
+        self.assertEqual(models.CoffeeDrink.objects.get(id=drink.id).photo_variants, {})
+
+        drink.photo = source
+        drink.save()
+        out = StringIO()
+        call_command('rebuild_photo_variants', stdout=out)
+        self.assertIn('CoffeeDrink: 1 photos processed, 0 failed', out.getvalue())
+        drink.refresh_from_db()
+        self.assertEqual(set(images.get_urls(drink)), {'thumbnail', 'medium'})
+
+    def test_user_variants(self):
+        response = self.upload(reverse('users-me-upload'), {'photo': self.photo()})
+        self.assertEqual(set(response.data['photo_variants']), {'thumbnail', 'medium'})
+        assert response.data['photo_variants']['thumbnail']['webp'].startswith('/users/variants/')
+
+    def photo_with_metadata(self, format):
+        image = Image.new('RGB', (40, 20), 'red')
+        exif = image.getexif()
+        exif[0x0112] = 6
+        exif[0x010f] = 'Camera maker'
+        exif.get_ifd(0x8825)[2] = (51.0, 30.0, 0.0)
+        options = {'exif': exif}
+        if format == 'PNG':
+            options['pnginfo'] = PngImagePlugin.PngInfo()
+            options['pnginfo'].add_text('Comment', 'secret')
+        if format == 'WEBP':
+            options['xmp'] = b'<x:xmpmeta>secret</x:xmpmeta>'
+        content = BytesIO()
+        image.save(content, format, **options)
+        return content.getvalue()
+
+    def test_original_metadata(self):
+        for format in uploads.METADATA_FILTERS:
+            content = self.photo_with_metadata(format)
+            stripped = set()
+            # Wherever the chunks of the upload happen to split
+            for size in [1, 7, len(content)]:
+                metadata = uploads.METADATA_FILTERS[format]()
+                stripped.add(b''.join(metadata.feed(content[start:start + size])
+                                      for start in range(0, len(content), size))
+                             + metadata.close())
+            self.assertEqual(len(stripped), 1)
+            stripped = stripped.pop()
+            self.assertNotIn(b'Camera maker', stripped)
+            self.assertNotIn(b'secret', stripped)
+            with Image.open(BytesIO(stripped)) as image, Image.open(BytesIO(content)) as source:
+                self.assertEqual(image.format, format)
+                self.assertEqual(image.tobytes(), source.tobytes())
+                self.assertNotIn('xmp', image.info)
+                self.assertNotIn('Comment', image.info)
+                # JPEG keeps its orientation, nothing else
+                self.assertEqual(dict(image.getexif()), {0x0112: 6} if format == 'JPEG' else {})
+
+        # What the photo URL serves
+        photo = SimpleUploadedFile('photo.jpg', self.photo_with_metadata('JPEG'))
+        response = self.upload(reverse('drink-upload'), {'id': self.drinks[0].id,
+                                                         'photo': photo})
+        with self.open_variant(response.data['photo']) as image:
+            self.assertEqual(dict(image.getexif()), {0x0112: 6})
+            self.assertEqual(image.getexif().get_ifd(0x8825), {})
+
+    def media_files(self):
+        return sorted(os.path.relpath(os.path.join(root, name), settings.MEDIA_ROOT)
+                      for root, dirs, files in os.walk(settings.MEDIA_ROOT)
+                      for name in files if 'variants' not in root)
+
+    def test_deduplicated_photos(self):
+        for drink in self.drinks:
+            self.upload(reverse('drink-upload'), {'id': drink.id, 'photo': self.photo()})
+        names = {drink.photo.name for drink in models.CoffeeDrink.objects.all()}
+        self.assertEqual(len(names), 1)
+        name = names.pop()
+        self.assertTrue(storage.is_blob(name))
+        self.assertEqual(self.media_files(), [name])
+        blob = models.Blob.objects.get()
+        self.assertEqual((blob.name, blob.references), (name, 2))
+        self.assertEqual(blob.size, os.path.getsize(os.path.join(settings.MEDIA_ROOT, name)))
+
+        # The file stays while a row references it
+        image = Image.new('RGB', (10, 10), 'blue')
+        content = BytesIO()
+        image.save(content, 'PNG')
+        self.upload(reverse('drink-upload'),
+                    {'id': self.drinks[0].id,
+                     'photo': SimpleUploadedFile('blue.png', content.getvalue())})
+        self.assertEqual(models.Blob.objects.get(name=name).references, 1)
+        self.assertEqual(len(self.media_files()), 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            models.CoffeeDrink.objects.get(id=self.drinks[1].id).delete()
+        self.assertFalse(models.Blob.objects.filter(name=name).exists())
+        self.assertEqual(self.media_files(),
+                         [models.CoffeeDrink.objects.get(id=self.drinks[0].id).photo.name])
+
+    def test_sweep(self):
+        self.upload(reverse('drink-upload'), {'id': self.drinks[0].id, 'photo': self.photo()})
+        drink = models.CoffeeDrink.objects.get(id=self.drinks[0].id)
+        kept = [drink.photo.name, 'files/legacy.jpg']
+        orphans = ['files/%s.jpg' % ('0' * 64), 'files/%suploaded' % storage.TEMP_PREFIX,
+                   'files/variants/%s.webp' % ('1' * 64)]
+        for name in kept[1:] + orphans:
+            with open(os.path.join(settings.MEDIA_ROOT, name), 'wb') as f:
+                f.write(b'orphan')
+        # Counts drifted by writes around the signals
+        models.Blob.objects.update(references=5)
+        models.Blob.objects.create(name='users/%s.png' % ('2' * 64), references=1)
+
+        out = StringIO()
+        call_command('sweep_media', '--dry-run', '--grace', '0', stdout=out)
+        self.assertIn('Would remove 3 files, 18 bytes', out.getvalue())
+        self.assertEqual(models.Blob.objects.count(), 2)
+        # Too recent
+        call_command('sweep_media', stdout=StringIO())
+        for name in orphans:
+            assert os.path.exists(os.path.join(settings.MEDIA_ROOT, name))
+
+        call_command('sweep_media', '--grace', '0', stdout=out)
+        self.assertIn('Removed 3 files, 18 bytes', out.getvalue())
+        for name in orphans:
+            assert not os.path.exists(os.path.join(settings.MEDIA_ROOT, name))
+        for name in kept + list(images.get_urls(drink)['medium'].values()):
+            assert os.path.exists(os.path.join(settings.MEDIA_ROOT, name.lstrip('/')))
+        self.assertEqual(list(models.Blob.objects.values_list('name', 'references')),
+                         [(drink.photo.name, 1)])
+
+
+class JobQueueTestCase(APITestCase):
+    def setUp(self):
+        self.calls = []
+        jobs.TASKS['tests.flaky'] = self.flaky
+        self.addCleanup(jobs.TASKS.pop, 'tests.flaky')
+        shop = models.CoffeeShop(name='shop', address='addr')
+        shop.save()
+        self.drink = models.CoffeeDrink(name='drink', price='1.00', volume=100, shop=shop)
+        self.drink.save()
+        response = self.client.post(reverse('auth-register'),
+                                    {'username': 'test', 'password': 'test'},
+                                    format='json')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+        self.user = models.CoffeeDrinker.objects.get(username='test')
+
+    def flaky(self, failures):
+        self.calls.append(failures)
+        if len(self.calls) <= failures:
+            raise RuntimeError('failure %d' % len(self.calls))
+        return len(self.calls)
+
+    def test_review_job(self):
+        response = self.client.post(reverse('reviews'),
+                                    {'drink': self.drink.id, 'notes': '',
+                                     'descriptors': [], 'overall_rating': 4},
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+        job = models.Job.objects.get(id=response['X-Job-Id'])
+        self.assertEqual((job.name, job.status, job.attempts, job.owner_id),
+                         ('reviews.changed', models.Job.DONE, 1, self.user.id))
+        self.drink.refresh_from_db()
+        self.assertEqual((self.drink.review_count, self.drink.rating_mean), (1, Decimal('4.0')))
+
+        # Ratings change with the review, the flavor profile once a worker
+        # gets to the job
+        descriptor = models.Descriptor(name='fruity', description='', color='#000000')
+        descriptor.save()
+        with override_settings(JOBS_EAGER=False):
+            response = self.client.put(reverse('reviews'),
+                                       {'id': response.data['id'], 'overall_rating': 2,
+                                        'descriptors': [descriptor.id]},
+                                       format='json')
+        self.assertEqual(response.status_code, 200)
+        job = models.Job.objects.get(id=response['X-Job-Id'])
+        self.assertEqual(job.status, models.Job.QUEUED)
+        self.drink.refresh_from_db()
+        self.assertEqual((self.drink.review_count, self.drink.rating_mean), (1, Decimal('2.0')))
+        self.assertEqual(models.FlavorProfile.objects.get(drink=self.drink).descriptors, {})
+        out = StringIO()
+        call_command('run_workers', '--once', '--workers', '1', stdout=out)
+        self.assertIn('Ran 1 jobs', out.getvalue())
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.Job.DONE)
+        self.assertIn(str(descriptor.id),
+                      models.FlavorProfile.objects.get(drink=self.drink).descriptors)
+        self.drink.refresh_from_db()
+        self.assertEqual((self.drink.review_count, self.drink.rating_mean), (1, Decimal('2.0')))
+
+    def test_retries(self):
+        with self.assertLogs('coffeestores.jobs', 'ERROR'):
+            job = jobs.enqueue('tests.flaky', 2, max_attempts=3)
+        self.assertEqual((job.status, job.attempts), (models.Job.QUEUED, 1))
+        self.assertIn('failure 1', job.last_error)
+        # Backed off, not due yet
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertEqual(jobs.run_pending(), 0)
+
+        models.Job.objects.update(run_at=timezone.now())
+        with self.assertLogs('coffeestores.jobs', 'ERROR'):
+            self.assertEqual(jobs.run_pending(), 1)
+        models.Job.objects.update(run_at=timezone.now())
+        self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.result, job.last_error),
+                         (models.Job.DONE, 3, 3, ''))
+
+        with self.assertLogs('coffeestores.jobs', 'ERROR'):
+            job = jobs.enqueue('tests.flaky', 10, max_attempts=1)
+        self.assertEqual((job.status, job.attempts), (models.Job.FAILED, 1))
+
+        for attempts in range(1, 20):
+            backoff = jobs.get_backoff(attempts).total_seconds()
+            self.assertLessEqual(backoff, jobs.BACKOFF_MAX)
+            self.assertGreaterEqual(backoff, min(jobs.BACKOFF_BASE * 2 ** (attempts - 1),
+                                                 jobs.BACKOFF_MAX) / 2)
+
+        with self.assertRaises(ValueError):
+            jobs.enqueue('tests.unknown')
+
+    def test_idempotency_key(self):
+        first = jobs.enqueue('tests.flaky', 0, key='flaky:1')
+        second = jobs.enqueue('tests.flaky', 0, key='flaky:1')
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(self.calls, [0])
+        self.assertEqual(models.Job.objects.count(), 1)
+
+    @override_settings(JOBS_EAGER=False)
+    def test_claim_and_stale(self):
+        for i in range(3):
+            jobs.enqueue('tests.flaky', 0)
+        jobs.enqueue('tests.flaky', 0, delay=60)
+        claimed = jobs.claim('worker-1', limit=2)
+        self.assertEqual([job.status for job in claimed], [models.Job.RUNNING] * 2)
+        self.assertEqual([job.attempts for job in claimed], [1, 1])
+        self.assertEqual(len(jobs.claim('worker-2', limit=5)), 1)
+        self.assertEqual(jobs.claim('worker-3'), [])
+
+        # worker-1 died, its jobs go back to the queue
+        models.Job.objects.filter(worker='worker-1').update(
+            started_at=timezone.now() - timedelta(seconds=jobs.STALE_AFTER + 1))
+        models.Job.objects.filter(id=claimed[1].id).update(max_attempts=1)
+        self.assertEqual(jobs.maintain(), (1, 1))
+        self.assertEqual(models.Job.objects.get(id=claimed[1].id).status, models.Job.FAILED)
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(models.Job.objects.get(id=claimed[0].id).status, models.Job.DONE)
+
+        # Done jobs are dropped after a while
+        models.Job.objects.filter(status=models.Job.DONE).update(
+            finished_at=timezone.now() - timedelta(seconds=jobs.KEEP_DONE + 1))
+        jobs.maintain()
+        self.assertFalse(models.Job.objects.filter(status=models.Job.DONE).exists())
+
+    @override_settings(JOBS_EAGER=False)
+    def test_lost_job(self):
+        def rename(name):
+            models.CoffeeDrink.objects.filter(id=self.drink.id).update(name=name)
+        jobs.TASKS['tests.rename'] = rename
+        self.addCleanup(jobs.TASKS.pop, 'tests.rename')
+        job = jobs.enqueue('tests.rename', 'renamed')
+        [claimed] = jobs.claim('worker-1')
+
+        # Still running when maintain() takes it back, the run commits nothing
+        models.Job.objects.filter(id=job.id).update(
+            started_at=timezone.now() - timedelta(seconds=jobs.STALE_AFTER + 1))
+        self.assertEqual(jobs.maintain(), (1, 0))
+        with self.assertLogs('coffeestores.jobs', 'WARNING'):
+            jobs.execute(claimed)
+        self.drink.refresh_from_db()
+        self.assertEqual(self.drink.name, 'drink')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker), (models.Job.QUEUED, ''))
+
+        # Failures of a lost run do not touch the job either
+        [claimed] = jobs.claim('worker-2')
+        models.Job.objects.filter(id=job.id).update(status=models.Job.QUEUED, worker='')
+        jobs.TASKS['tests.rename'] = lambda name: 1 / 0
+        with self.assertLogs('coffeestores.jobs', 'ERROR'):
+            jobs.execute(claimed)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.last_error), (models.Job.QUEUED, ''))
+
+        jobs.TASKS['tests.rename'] = rename
+        self.assertEqual(jobs.run_pending(), 1)
+        self.drink.refresh_from_db()
+        self.assertEqual(self.drink.name, 'renamed')
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.Job.DONE)
+
+    def test_jobs_endpoint(self):
+        url = reverse('jobs')
+        own = jobs.enqueue('tests.flaky', 0, owner_id=self.user.id)
+        with self.assertLogs('coffeestores.jobs', 'ERROR'):
+            other = jobs.enqueue('tests.flaky', 10, owner_id=None)
+
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([job['id'] for job in response.data['results']], [own.id])
+        response = self.client.get(url, {'id': own.id}, format='json')
+        self.assertEqual((response.data['status'], response.data['result']),
+                         (models.Job.DONE, 1))
+        response = self.client.get(url, {'id': other.id}, format='json')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(url, {'id': 'test'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {'status': 'test'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        # Staff see every job
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(url, {'status': models.Job.QUEUED}, format='json')
+        self.assertEqual([job['id'] for job in response.data['results']], [other.id])
+
+        self.client.credentials()
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, 401)
+
+
+class StreamedBody:
+    # A multipart body with a photo of head followed by size filler bytes,
+    # made up while it is read rather than held in memory
+    boundary = 'StreamedBoundary'
+
+    def __init__(self, head, size):
+        head = ('--%s\r\nContent-Disposition: form-data; name="photo"; filename="big.jpg"'
+                '\r\nContent-Type: image/jpeg\r\n\r\n' % self.boundary).encode() + head
+        tail = ('\r\n--%s--\r\n' % self.boundary).encode()
+        self.length = len(head) + size + len(tail)
+        self.pieces = self.generate(head, size, tail)
+        self.piece = b''
+        self.offset = 0
+        self.read_bytes = 0
+
+    def generate(self, head, size, tail):
+        yield head
+        filler = b'\0' * (1024 * 1024)
+        while size > 0:
+            yield filler[:size]
+            size -= len(filler)
+        yield tail
+
+    def read(self, size=-1):
+        wanted = self.length if size < 0 else size
+        data = []
+        while wanted > 0:
+            if self.offset == len(self.piece):
+                self.piece, self.offset = next(self.pieces, b''), 0
+                if not self.piece:
+                    break
+            part = self.piece[self.offset:self.offset + wanted]
+            self.offset += len(part)
+            wanted -= len(part)
+            data.append(part)
+        data = b''.join(data)
+        self.read_bytes += len(data)
+        return data
+
+    def readline(self, size=-1):
+        # Wrapped by LimitedStream, never used by the multipart parser
+        raise NotImplementedError
+
+
+@override_settings(PHOTO_UPLOAD_MAX_BYTES=1024 * 1024 * 1024, JOBS_EAGER=False)
+class StreamingUploadTestCase(APITestCase):
+    size = 300 * 1024 * 1024
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        owner_group = Group(name='shop owner')
+        owner_group.save()
+        response = self.client.post(reverse('auth-register'),
+                                    {'username': 'owner', 'password': 'test'},
+                                    format='json')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+        owner = models.CoffeeDrinker.objects.get(username='owner')
+        owner.groups.add(owner_group)
+        shop = models.CoffeeShop(name='shop', address='addr', owner=owner)
+        shop.save()
+        self.drink = models.CoffeeDrink(name='drink', price='1.00', volume=100, shop=shop)
+        self.drink.save()
+        content = BytesIO()
+        Image.new('RGB', (120, 60), 'red').save(content, 'JPEG')
+        self.jpeg = content.getvalue()
+
+    def post(self, url, body, query=None):
+        if query:
+            url += '?' + '&'.join('%s=%s' % item for item in query.items())
+        return self.client.post(url, **{
+            'wsgi.input': body, 'CONTENT_LENGTH': str(body.length),
+            'CONTENT_TYPE': 'multipart/form-data; boundary=%s' % body.boundary})
+
+    def post_traced(self, url, body, query=None):
+        # With the peak of Python allocations during the request. Peak RSS
+        # is the process's, an earlier test may already have set it higher
+        tracemalloc.start()
+        try:
+            response = self.post(url, body, query)
+            return response, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def media_files(self):
+        return [os.path.join(root, name) for root, dirs, files in os.walk(settings.MEDIA_ROOT)
+                for name in files]
+
+    def test_large_photo(self):
+        # Trailing bytes after the JPEG end marker, still a valid photo
+        body = StreamedBody(self.jpeg, self.size)
+        response, peak = self.post_traced(reverse('drink-upload'), body, {'id': self.drink.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(peak, 64 * 1024 * 1024)
+        self.assertEqual(body.read_bytes, body.length)
+
+        self.drink.refresh_from_db()
+        self.assertTrue(self.drink.photo.name.endswith('.jpg'))
+        self.assertEqual(self.drink.photo.size, len(self.jpeg) + self.size)
+        # Written once, in place
+        self.assertEqual(self.media_files(), [self.drink.photo.path])
+
+    def test_early_rejection(self):
+        # Not an image, rejected on the first chunk
+        body = StreamedBody(b'%PDF-1.7\n', self.size)
+        response, peak = self.post_traced(reverse('drink-upload'), body, {'id': self.drink.id})
+        self.assertEqual(response.status_code, 415)
+        self.assertLess(body.read_bytes, 1024 * 1024)
+        self.assertLess(peak, 64 * 1024 * 1024)
+
+        # Too large by its Content-Length, the body is not read at all
+        with override_settings(PHOTO_UPLOAD_MAX_BYTES=10 * 1024 * 1024):
+            body = StreamedBody(self.jpeg, self.size)
+            response = self.post(reverse('users-me-upload'), body)
+            self.assertEqual(response.status_code, 413)
+            self.assertEqual(body.read_bytes, 0)
+
+            # Over the limit once read, Content-Length leaves room for the form
+            body = StreamedBody(self.jpeg, 10 * 1024 * 1024)
+            response = self.post(reverse('drink-upload'), body, {'id': self.drink.id})
+            self.assertEqual(response.status_code, 413)
+
+        # Drinks of other owners are refused before the body
+        other = models.CoffeeDrinker.objects.create(username='other')
+        shop = models.CoffeeShop.objects.create(name='other', address='addr', owner=other)
+        drink = models.CoffeeDrink.objects.create(name='other', price='1.00', volume=100,
+                                                  shop=shop)
+        body = StreamedBody(self.jpeg, self.size)
+        response = self.post(reverse('drink-upload'), body, {'id': drink.id})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(body.read_bytes, 0)
+        # So is an upload that does not say which drink in the query
+        body = StreamedBody(self.jpeg, self.size)
+        response = self.post(reverse('drink-upload'), body)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(body.read_bytes, 0)
+
+        with override_settings(PHOTO_UPLOAD_MAX_PIXELS=120 * 60 - 1):
+            response = self.post(reverse('drink-upload'), StreamedBody(self.jpeg, 0),
+                                 {'id': self.drink.id})
+            self.assertEqual(response.status_code, 413)
+
+        # Nothing left behind by the rejected uploads
+        self.assertEqual(self.media_files(), [])
+        self.drink.refresh_from_db()
+        self.assertFalse(self.drink.photo)
+
+
+class CursorPaginationTestCase(APITestCase):
+    def setUp(self):
+        models.CoffeeShop.objects.bulk_create(
+            [models.CoffeeShop(name='shop%d' % (i % 7), address='addr')
+             for i in range(25)])
+
+    def collect(self, url, query):
+        names, ids = [], []
+        while url:
+            response = self.client.get(url, query, format='json')
+            self.assertEqual(response.status_code, 200)
+            names += [shop['name'] for shop in response.data['results']]
+            ids += [shop['id'] for shop in response.data['results']]
+            url, query = response.data['next'], None
+        return names, ids, response
+
+    def test_cursor_pages(self):
+        url = reverse('shops')
+
+        response = self.client.get(url, {'pagination': 'cursor'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 25)
+        self.assertIsNone(response.data['previous'])
+        self.assertEqual(len(response.data['results']), 10)
+
+        # Ordering with duplicate keys, every shop exactly once
+        names, ids, response = self.collect(url, {'pagination': 'cursor',
+                                                  'ordering': '-name'})
+        self.assertEqual(sorted(ids), list(range(1, 26)))
+        self.assertEqual(names, sorted(names, reverse=True))
+
+        # Previous link of the last page leads back to the middle one
+        response = self.client.get(response.data['previous'], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([shop['id'] for shop in response.data['results']],
+                         ids[10:20])
+        self.assertIsNotNone(response.data['next'])
+
+    def test_cursor_skip_count(self):
+        url = reverse('shops')
+
+        # page + drinks prefetch, the counts are the ETag's
+        query = {'pagination': 'cursor', 'skip_count': 1}
+        with self.assertNumQueries(6):
+            response = self.client.get(url, query, format='json')
+        self.assertEqual(response.status_code, 200)
+        assert 'count' not in list(response.data)
+        for skip_count in ['0', 'false']:
+            query = {'pagination': 'cursor', 'skip_count': skip_count}
+            response = self.client.get(url, query, format='json')
+            self.assertEqual(response.status_code, 200)
+            assert 'count' in list(response.data)
+
+        # Filters still apply
+        query = {'pagination': 'cursor', 'name': 'shop1'}
+        names, ids, response = self.collect(url, query)
+        self.assertEqual(len(ids), 4)
+
+    def test_cursor_invalid(self):
+        url = reverse('shops')
+
+        response = self.client.get(url, {'cursor': 'test'}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client.get(url, {'cursor': 'eyJwIjogWyJ0ZXN0Il0sICJyIjogMH0='},
+                                   format='json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursor_benchmark(self):
+        out = StringIO()
+        call_command('benchmark', 'pagination', size=50, repeat=1, stdout=out)
+        assert 'cursor' in out.getvalue()
+        self.assertEqual(models.CoffeeShop.objects.count(), 25)
+
+
+class ShopOwnerPermissionTestCase(APITestCase):
+    def setUp(self):
+        shop_one = models.CoffeeShop(name='test1',
+                                     address='test_addr1')
+        shop_one.save()
+        url = reverse('auth-register')
+        data = {'username': 'test',
+                 'password': 'test'}
+        response = self.client.post(url, data, format='json')
+        self.headers = {'Authorization': 'Bearer ' + response.data['access']}
+        self.user = models.CoffeeDrinker.objects.get(username='test')
+        shop_one.owner = self.user
+        shop_one.save()
+        self.owner_group = Group(name='shop owner')
+        self.owner_group.save()
+
+    def test_not_an_owner(self):
+        query = {'name': 'test', 'address': 'test'}
+        response = self.client.post(reverse('shops'), query, headers=self.headers,
+                                    format='json')
+        self.assertEqual(response.status_code, 403)
+
+        # Role cache is dropped when the membership changes
+        self.user.groups.add(self.owner_group)
+        response = self.client.post(reverse('shops'), query, headers=self.headers,
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+
+        self.owner_group.user_set.clear()
+        response = self.client.post(reverse('shops'), query, headers=self.headers,
+                                    format='json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_owner_write_queries(self):
+        self.user.groups.add(self.owner_group)
+        query = {'shop': 1, 'name': 'test', 'price': '1.00', 'volume': 100}
+        response = self.client.post(reverse('drink'), query, headers=self.headers,
+                                    format='json')
+        self.assertEqual(response.status_code, 201)
+
+        # Shop lookup + insert + search document, no user or group queries
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('drink'), query, headers=self.headers,
+                                        format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(queries), 3)
+        assert not any('auth_group' in query['sql'] for query in queries)
+
+        # Drink lookup + update + search document, in a savepoint
+        query = {'id': 1, 'name': 'test11'}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.put(reverse('drink'), query, headers=self.headers,
+                                       format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 5)
+        assert not any('auth_group' in query['sql'] for query in queries)
+
+
+class ShopOwnershipTestCase(APITestCase):
+    def setUp(self):
+        owner_group = Group(name='shop owner')
+        owner_group.save()
+        self.headers = {}
+        for username in ['owner1', 'owner2']:
+            url = reverse('auth-register')
+            data = {'username': username,
+                     'password': 'test'}
+            response = self.client.post(url, data, format='json')
+            self.headers[username] = {'Authorization': 'Bearer ' + response.data['access']}
+            user = models.CoffeeDrinker.objects.get(username=username)
+            user.groups.add(owner_group)
+
+    def create_shop(self, username, name):
+        query = {'name': name, 'address': 'test'}
+        response = self.client.post(reverse('shops'), query,
+                                    headers=self.headers[username], format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data['id']
+
+    def test_owner_writes(self):
+        shop_id = self.create_shop('owner1', 'shop1')
+        drink = models.CoffeeDrink(name='test', price='1.00', volume=100, shop_id=shop_id)
+        drink.save()
+
+        # Other owners can not touch the shop or its drinks
+        query = {'id': shop_id, 'name': 'test'}
+        response = self.client.put(reverse('shops'), query,
+                                   headers=self.headers['owner2'], format='json')
+        self.assertEqual(response.status_code, 403)
+        query = {'shop': shop_id, 'name': 'test', 'price': '1.00', 'volume': 100}
+        response = self.client.post(reverse('drink'), query,
+                                    headers=self.headers['owner2'], format='json')
+        self.assertEqual(response.status_code, 403)
+        query = {'id': drink.id, 'name': 'test'}
+        response = self.client.put(reverse('drink'), query,
+                                   headers=self.headers['owner2'], format='json')
+        self.assertEqual(response.status_code, 403)
+
+        # Moving an own drink to somebody else's shop
+        other_shop_id = self.create_shop('owner2', 'shop2')
+        query = {'id': drink.id, 'shop': other_shop_id}
+        response = self.client.put(reverse('drink'), query,
+                                   headers=self.headers['owner1'], format='json')
+        self.assertEqual(response.status_code, 403)
+
+        query = {'id': drink.id, 'name': 'test11'}
+        response = self.client.put(reverse('drink'), query,
+                                   headers=self.headers['owner1'], format='json')
+        self.assertEqual(response.status_code, 200)
+        query = {'id': shop_id, 'name': 'test11'}
+        response = self.client.put(reverse('shops'), query,
+                                   headers=self.headers['owner1'], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['owner'], 1)
+
+    def test_ownerless_shop(self):
+        shop_id = self.create_shop('owner1', 'shop1')
+        drink = models.CoffeeDrink(name='test', price='1.00', volume=100, shop_id=shop_id)
+        drink.save()
+        # The owner's account is gone, the shop is not open to other owners
+        models.CoffeeDrinker.objects.filter(username='owner1').delete()
+        self.assertIsNone(models.CoffeeShop.objects.get(id=shop_id).owner_id)
+        query = {'id': shop_id, 'name': 'test'}
+        response = self.client.put(reverse('shops'), query,
+                                   headers=self.headers['owner2'], format='json')
+        self.assertEqual(response.status_code, 403)
+        query = {'id': drink.id, 'name': 'test'}
+        response = self.client.put(reverse('drink'), query,
+                                   headers=self.headers['owner2'], format='json')
+        self.assertEqual(response.status_code, 403)
+
+        # Staff can still look after it
+        staff = models.CoffeeDrinker.objects.get(username='owner2')
+        staff.is_staff = True
+        staff.save()
+        query = {'id': shop_id, 'name': 'test'}
+        response = self.client.put(reverse('shops'), query,
+                                   headers=self.headers['owner2'], format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_move_rated_drink(self):
+        shop_id = self.create_shop('owner1', 'shop1')
+        other_shop_id = self.create_shop('owner1', 'shop2')
+        drink = models.CoffeeDrink(name='test', price='1.00', volume=100, shop_id=shop_id)
+        drink.save()
+        for rating in [4.5, 3.2]:
+            query = {'drink': drink.id, 'overall_rating': rating}
+            response = self.client.post(reverse('reviews'), query,
+                                        headers=self.headers['owner2'], format='json')
+            self.assertEqual(response.status_code, 201)
+
+        # The drink's ratings go along with it
+        query = {'id': drink.id, 'shop': other_shop_id}
+        response = self.client.put(reverse('drink'), query,
+                                   headers=self.headers['owner1'], format='json')
+        self.assertEqual(response.status_code, 200)
+        shop = models.CoffeeShop.objects.get(id=shop_id)
+        self.assertEqual((shop.review_count, shop.rating_sum, shop.rating_histogram),
+                         (0, 0, {}))
+        shop = models.CoffeeShop.objects.get(id=other_shop_id)
+        self.assertEqual((shop.review_count, shop.rating_sum, shop.rating_histogram),
+                         (2, Decimal('7.7'), {'3': 1, '4': 1}))
+        self.assertEqual(str(shop.rating_mean), '3.85')
+
+        # And leave with it
+        models.CoffeeDrink.objects.get(id=drink.id).delete()
+        shop = models.CoffeeShop.objects.get(id=other_shop_id)
+        self.assertEqual((shop.review_count, shop.rating_sum, shop.rating_histogram),
+                         (0, 0, {}))
+
+    def test_my_shops(self):
+        url = reverse('owners-me-shops')
+
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, 401)
+
+        for i in range(12):
+            shop_id = self.create_shop('owner1', 'shop%d' % i)
+            models.CoffeeDrink.objects.bulk_create(
+                [models.CoffeeDrink(name='test', price='1.00', volume=100, shop_id=shop_id)
+                 for _ in range(2)])
+        self.create_shop('owner2', 'other')
+
+        # Count + page + drinks prefetch
+        headers = self.headers['owner1']
+        response = self.client.get(url, headers=headers, format='json')
+        with self.assertNumQueries(3):
+            response = self.client.get(url, headers=headers, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 12)
+        results = response.data['results']
+        assert all(shop['owner'] == 1 for shop in results)
+        self.assertEqual(len(results[0]['drinks']), 2)
+        assert 'rating_mean' in list(results[0])
+        assert 'rating_mean' in list(results[0]['drinks'][0])
+
+
+class BulkWriteTestCase(APITestCase):
+    def setUp(self):
+        owner_group = Group(name='shop owner')
+        owner_group.save()
+        url = reverse('auth-register')
+        data = {'username': 'test',
+                 'password': 'test'}
+        response = self.client.post(url, data, format='json')
+        self.headers = {'Authorization': 'Bearer ' + response.data['access']}
+        models.CoffeeDrinker.objects.get(username='test').groups.add(owner_group)
+
+    def test_bulk_shops(self):
+        url = reverse('shops-bulk')
+
+        # Per-item errors, nothing is written
+        query = [{'name': 'shop1', 'address': 'addr'}, {'name': 'shop2'}]
+        response = self.client.post(url, query, headers=self.headers, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        assert 'address' in list(response.data[1])
+        self.assertEqual(models.CoffeeShop.objects.count(), 0)
+
+        query = [{'name': 'shop%d' % i, 'address': 'addr'} for i in range(20)]
+        response = self.client.post(url, query, headers=self.headers, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data), 20)
+        assert all(shop['owner'] == 1 for shop in response.data)
+        self.assertEqual(models.CoffeeShop.objects.filter(owner_id=1).count(), 20)
+
+        query = [{'id': 1, 'name': 'new1'}, {'id': 1111, 'name': 'new2'}, {'name': 'new3'}]
+        response = self.client.put(url, query, headers=self.headers, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        assert 'id' in list(response.data[1])
+        assert 'id' in list(response.data[2])
+
+        query = [{'id': 1, 'name': 'new1'}, {'id': 2, 'address': 'new2'}]
+        response = self.client.put(url, query, headers=self.headers, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[0]['name'], 'new1')
+        self.assertEqual(response.data[1]['address'], 'new2')
+        self.assertEqual(models.CoffeeShop.objects.get(id=2).name, 'shop1')
+
+    def test_bulk_drinks(self):
+        url = reverse('drink-bulk')
+        shops = models.CoffeeShop.objects.bulk_create(
+            [models.CoffeeShop(name='shop', address='addr', owner_id=1) for _ in range(3)])
+
+        response = self.client.post(url, [], headers=self.headers, format='json')
+        self.assertEqual(response.status_code, 201)
+
+        # Shops + insert + search documents, however long the menu is
+        for size in [5, 50]:
+            query = [{'shop': shops[i % 3].id, 'name': 'drink%d' % i,
+                      'price': '1.50', 'volume': 100 + i} for i in range(size)]
+            with self.assertNumQueries(5):
+                response = self.client.post(url, query, headers=self.headers,
+                                            format='json')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(len(response.data), size)
+        self.assertEqual(models.CoffeeDrink.objects.count(), 55)
+
+        query = [{'shop': 1, 'name': 'ok', 'price': '1.00', 'volume': 1},
+                 {'shop': 1111, 'name': 'bad', 'price': '1.00', 'volume': 1}]
+        response = self.client.post(url, query, headers=self.headers, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        assert 'shop' in list(response.data[1])
+
+        other_owner = models.CoffeeDrinker.objects.create(username='other')
+        other = models.CoffeeShop.objects.create(name='other', address='addr',
+                                                 owner=other_owner)
+        query = [{'shop': other.id, 'name': 'test', 'price': '1.00', 'volume': 1}]
+        response = self.client.post(url, query, headers=self.headers, format='json')
+        self.assertEqual(response.status_code, 403)
+
+        query = [{'id': 1, 'price': '2.00'}, {'id': 2, 'name': 'new', 'shop': 3}]
+        response = self.client.put(url, query, headers=self.headers, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(models.CoffeeDrink.objects.get(id=1).price, Decimal('2.00'))
+        drink = models.CoffeeDrink.objects.get(id=2)
+        self.assertEqual((drink.name, drink.shop_id, drink.volume), ('new', 3, 101))
+
+        query = [{'id': 1, 'shop': other.id}]
+        response = self.client.put(url, query, headers=self.headers, format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(models.CoffeeDrink.objects.get(id=1).shop_id, 1)
+
+
+class ExportTestCase(APITestCase):
+    def setUp(self):
+        shop_one = models.CoffeeShop(name='test1',
+                                     address='test_addr1')
+        shop_one.save()
+        drink_one = models.CoffeeDrink(name='test1',
+                                       price='99.99',
+                                       volume=300)
+        drink_one.shop = shop_one
+        drink_one.save()
+        models.Review.objects.bulk_create(
+            [models.Review(drink=drink_one, notes='note, "%d"' % i,
+                           descriptors={'1': i}, overall_rating=i)
+             for i in range(5)])
+
+        url = reverse('auth-register')
+        data = {'username': 'test',
+                 'password': 'test'}
+        response = self.client.post(url, data, format='json')
+        self.headers = {'Authorization': 'Bearer ' + response.data['access']}
+
+    def export(self, kind, query=None):
+        response = self.client.get(reverse('export', args=[kind]), query,
+                                   headers=self.headers)
+        return response, b''.join(response.streaming_content)
+
+    def test_export_permissions(self):
+        response = self.client.get(reverse('export', args=['reviews']))
+        self.assertEqual(response.status_code, 401)
+        response = self.client.get(reverse('export', args=['reviews']),
+                                   headers=self.headers)
+        self.assertEqual(response.status_code, 403)
+
+    def test_export(self):
+        models.CoffeeDrinker.objects.filter(username='test').update(is_staff=True)
+
+        response = self.client.get(reverse('export', args=['test']), headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('export', args=['reviews']),
+                                   {'output': 'xml'}, headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+        response, content = self.export('reviews')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(content.decode().splitlines()))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[2]['notes'], 'note, "2"')
+        self.assertEqual(json.loads(rows[2]['descriptors']), {'1': 2})
+        self.assertEqual(rows[2]['drink'], '1')
+
+        response, content = self.export('reviews', {'output': 'ndjson', 'since_id': 3})
+        rows = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [4, 5])
+        self.assertEqual(rows[0]['descriptors'], {'1': 3})
+        self.assertEqual(rows[0]['overall_rating'], '3.0')
+
+        # Edited rows come back with since, whatever their id
+        since = timezone.now()
+        models.Review.objects.filter(id__in=[1, 4]).update(
+            updated_at=since + timedelta(seconds=1))
+        response, content = self.export('reviews', {'output': 'ndjson',
+                                                    'since': since.isoformat()})
+        rows = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [1, 4])
+        response, content = self.export('reviews', {'output': 'ndjson', 'since_id': 3,
+                                                    'since': since.isoformat()})
+        rows = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows], [4])
+        response = self.client.get(reverse('export', args=['reviews']),
+                                   {'since': 'yesterday'}, headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+        response, content = self.export('drinks', {'output': 'ndjson', 'gzip': 1})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        rows = [json.loads(line) for line in gzip.decompress(content).splitlines()]
+        self.assertEqual(rows[0]['shop'], 1)
+        self.assertEqual(rows[0]['price'], '99.99')
+
+    def test_export_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'shops.csv.gz')
+            call_command('export_coffee', 'shops', '--gzip', '--file', path)
+            with gzip.open(path, 'rt') as f:
+                rows = list(csv.DictReader(f))
+        self.assertEqual(rows[0]['name'], 'test1')
+        self.assertEqual(rows[0]['address'], 'test_addr1')
+
+        since = timezone.now()
+        models.CoffeeShop.objects.filter(id=rows[0]['id']).update(
+            updated_at=since + timedelta(seconds=1))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'shops.ndjson')
+            call_command('export_coffee', 'shops', '--output', 'ndjson',
+                         '--since', since.isoformat(), '--file', path)
+            with open(path) as f:
+                self.assertEqual([json.loads(line)['id'] for line in f],
+                                 [int(rows[0]['id'])])
+        with self.assertRaises(CommandError):
+            call_command('export_coffee', 'shops', '--since', 'yesterday')
+
+
+class ImportTestCase(APITestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        models.CoffeeShop(name='existing', address='test').save()
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_import(self):
+        shops = self.write('shops.csv', 'id,name,address,owner\n'
+                                        '10,shop1,addr1,\n'
+                                        '11,shop2,addr2,\n'
+                                        '12,,addr3,\n')
+        drinks = self.write('drinks.ndjson', '\n'.join(json.dumps(row) for row in [
+            {'id': 20, 'name': 'drink1', 'price': '1.50', 'shop': 10, 'volume': 100},
+            {'id': 21, 'name': 'drink2', 'price': '2.50', 'shop': 11, 'volume': 200},
+            {'id': 22, 'name': 'drink3', 'price': '2.50', 'shop': 99, 'volume': 200},
+        ]))
+        reviews = []
+        for i in range(25):
+            reviews.append({'id': i, 'drink': 20 + i % 2, 'author': None, 'notes': 'n',
+                            'descriptors': {'1': 2}, 'overall_rating': '4.0'})
+        with gzip.open(os.path.join(self.directory.name, 'reviews.ndjson.gz'), 'wt') as f:
+            f.write('\n'.join(json.dumps(row) for row in reviews))
+        checkpoint = os.path.join(self.directory.name, 'checkpoint.json')
+
+        out, err = StringIO(), StringIO()
+        call_command('import_coffee', shops=shops, drinks=drinks,
+                     reviews=os.path.join(self.directory.name, 'reviews.ndjson.gz'),
+                     batch_size=10, checkpoint=checkpoint, stdout=out, stderr=err)
+        assert 'rows/s' in out.getvalue()
+        # Shop without a name, drink of an unknown shop
+        assert 'shops row 3' in err.getvalue()
+        assert 'drinks row 3' in err.getvalue()
+
+        self.assertEqual(models.CoffeeShop.objects.count(), 3)
+        drink = models.CoffeeDrink.objects.get(name='drink1')
+        self.assertEqual(drink.shop.name, 'shop1')
+        self.assertEqual(models.Review.objects.filter(drink=drink).count(), 13)
+        self.assertEqual(drink.review_count, 13)
+        self.assertEqual(models.Review.objects.get(id=1).descriptors, {'1': 2})
+
+        # Resuming a finished import adds nothing
+        call_command('import_coffee', shops=shops, drinks=drinks,
+                     reviews=os.path.join(self.directory.name, 'reviews.ndjson.gz'),
+                     batch_size=10, checkpoint=checkpoint, stdout=StringIO(),
+                     stderr=StringIO())
+        self.assertEqual(models.Review.objects.count(), 25)
+
+        # An interrupted review import picks up after the last batch and
+        # still maps drinks through the saved ids
+        with open(checkpoint) as f:
+            rows = json.load(f)
+        rows['reviews'] = 20
+        with open(checkpoint, 'w') as f:
+            json.dump(rows, f)
+        call_command('import_coffee',
+                     reviews=os.path.join(self.directory.name, 'reviews.ndjson.gz'),
+                     batch_size=10, checkpoint=checkpoint, stdout=StringIO())
+        self.assertEqual(models.Review.objects.count(), 30)
+        self.assertEqual(models.Review.objects.filter(drink=drink).count(), 16)
+
+
+    def test_import_unmapped_parent(self):
+        # The failed shop has the id of an unrelated shop here
+        existing = models.CoffeeShop.objects.get(name='existing')
+        shops = self.write('shops.csv', 'id,name,address,owner\n'
+                                        '%d,,addr1,\n'
+                                        '50,shop2,addr2,\n' % existing.id)
+        drinks = self.write('drinks.ndjson', '\n'.join(json.dumps(row) for row in [
+            {'id': 20, 'name': 'drink1', 'price': '1.50', 'shop': existing.id, 'volume': 100},
+            {'id': 21, 'name': 'drink2', 'price': '2.50', 'shop': 50, 'volume': 200},
+        ]))
+        err = StringIO()
+        call_command('import_coffee', shops=shops, drinks=drinks, stdout=StringIO(),
+                     stderr=err)
+        self.assertIn('drinks row 1: shop %d was not imported' % existing.id, err.getvalue())
+        self.assertFalse(models.CoffeeDrink.objects.filter(shop=existing).exists())
+        self.assertEqual(models.CoffeeDrink.objects.get().shop.name, 'shop2')
+
+        # Without the shops in the import, ids are those of the shops here
+        drinks = self.write('more.ndjson', json.dumps(
+            {'id': 22, 'name': 'drink3', 'price': '1.50', 'shop': existing.id, 'volume': 100}))
+        call_command('import_coffee', drinks=drinks, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(models.CoffeeDrink.objects.get(name='drink3').shop, existing)
+
+class DescriptorTreeTestCase(APITestCase):
+    def setUp(self):
+        def create(name, parent=None):
+            descriptor = models.Descriptor(name=name, description='', color='#000000',
+                                           parent=parent)
+            descriptor.save()
+            return descriptor
+        self.fruity = create('fruity')
+        self.berry = create('berry', self.fruity)
+        self.strawberry = create('strawberry', self.berry)
+        self.roasted = create('roasted')
+
+    def test_paths(self):
+        self.assertEqual(self.strawberry.path, '%d/%d/%d/' % (
+            self.fruity.id, self.berry.id, self.strawberry.id))
+        subtree = models.Descriptor.objects.filter(descriptors.subtree_filter(self.fruity.path))
+        self.assertEqual({d.name for d in subtree}, {'fruity', 'berry', 'strawberry'})
+        self.assertEqual(descriptors.get_subtree_ids([self.berry.id]),
+                         {self.berry.id, self.strawberry.id})
+
+        # Moving a descriptor carries its descendants along
+        self.berry.parent = self.roasted
+        self.berry.save()
+        self.strawberry.refresh_from_db()
+        self.assertEqual(self.strawberry.path, '%d/%d/%d/' % (
+            self.roasted.id, self.berry.id, self.strawberry.id))
+        self.assertEqual(descriptors.get_subtree_ids([self.roasted.id]),
+                         {self.roasted.id, self.berry.id, self.strawberry.id})
+
+        # Refused like Descriptor.clean() refuses it
+        self.roasted.parent = self.strawberry
+        with self.assertRaises(ValidationError) as raised:
+            self.roasted.save()
+        self.assertIn('parent', raised.exception.message_dict)
+
+        models.Descriptor.objects.update(path='')
+        descriptors.rebuild_paths()
+        self.strawberry.refresh_from_db()
+        self.assertEqual(self.strawberry.path, '%d/%d/%d/' % (
+            self.roasted.id, self.berry.id, self.strawberry.id))
+
+    def test_tree(self):
+        url = reverse('descriptors')
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        assert response.status_code == 200
+        self.assertEqual([node['name'] for node in response.data], ['fruity', 'roasted'])
+        self.assertEqual(response.data[0]['children'][0]['children'][0]['name'],
+                         'strawberry')
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        self.assertEqual(response['ETag'], etag)
+
+        self.strawberry.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data[0]['children'][0]['children'], [])
+
+    def test_subtree(self):
+        url = reverse('descriptors-subtree')
+        response = self.client.get(url + '?id=%d' % self.berry.id)
+        assert response.status_code == 200
+        self.assertEqual(response.data['name'], 'berry')
+        self.assertEqual(response.data['children'][0]['name'], 'strawberry')
+
+        response = self.client.get(url + '?id=abc')
+        assert response.status_code == 400
+        response = self.client.get(url + '?id=999')
+        assert response.status_code == 404
+
+
+class DescriptorReviewsTestCase(APITestCase):
+    def setUp(self):
+        def create(name, parent=None):
+            descriptor = models.Descriptor(name=name, description='', color='#000000',
+                                           parent=parent)
+            descriptor.save()
+            return descriptor
+        self.sweet = create('sweet')
+        self.chocolate = create('chocolate', self.sweet)
+        self.floral = create('floral')
+        shop = models.CoffeeShop(name='shop', address='addr')
+        shop.save()
+        self.drinks = []
+        for i in range(3):
+            drink = models.CoffeeDrink(name='drink%d' % i, price='1.00', volume=100,
+                                       shop=shop)
+            drink.save()
+            self.drinks.append(drink)
+
+        url = reverse('auth-register')
+        response = self.client.post(url, {'username': 'test', 'password': 'test'},
+                                    format='json')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+
+    def review(self, drink, descriptors):
+        response = self.client.post(reverse('reviews'),
+                                    {'drink': drink.id, 'notes': '',
+                                     'descriptors': descriptors, 'overall_rating': 4},
+                                    format='json')
+        assert response.status_code == 201
+        return response.data['id']
+
+
+class DescriptorSearchTestCase(DescriptorReviewsTestCase):
+    def search(self, query):
+        response = self.client.get(reverse('drinks-search'), query)
+        assert response.status_code == 200
+        return [(drink['name'], drink['mentions']) for drink in response.data['results']]
+
+    def test_index(self):
+        review_id = self.review(self.drinks[0], {str(self.chocolate.id): 4,
+                                                 str(self.floral.id): 1, '999': 2})
+        rows = models.ReviewDescriptor.objects.filter(review_id=review_id)
+        self.assertEqual({(row.descriptor_id, row.drink_id, row.intensity) for row in rows},
+                         {(self.chocolate.id, self.drinks[0].id, 4),
+                          (self.floral.id, self.drinks[0].id, 1)})
+
+        response = self.client.put(reverse('reviews'),
+                                   {'id': review_id, 'descriptors': [self.sweet.id]},
+                                   format='json')
+        assert response.status_code == 200
+        rows = models.ReviewDescriptor.objects.filter(review_id=review_id)
+        self.assertEqual([(row.descriptor_id, row.intensity) for row in rows],
+                         [(self.sweet.id, None)])
+
+        models.ReviewDescriptor.objects.all().delete()
+        call_command('rebuild_review_descriptors', stdout=StringIO())
+        self.assertEqual(models.ReviewDescriptor.objects.get().descriptor_id, self.sweet.id)
+
+    def test_search(self):
+        self.review(self.drinks[0], [self.chocolate.id])
+        self.review(self.drinks[1], {str(self.chocolate.id): 5})
+        self.review(self.drinks[1], {str(self.sweet.id): 2, str(self.chocolate.id): 3})
+        self.review(self.drinks[2], [self.floral.id])
+
+        # Descendants count once per review
+        self.assertEqual(self.search({'descriptor': self.sweet.id}),
+                         [('drink1', 2), ('drink0', 1)])
+        self.assertEqual(self.search({'descriptor': self.chocolate.id,
+                                      'min_intensity': 4}),
+                         [('drink1', 1)])
+        self.assertEqual(self.search({'descriptor': '%d,%d' % (self.chocolate.id,
+                                                               self.floral.id)}),
+                         [('drink1', 2), ('drink0', 1), ('drink2', 1)])
+        self.assertEqual(self.search({'descriptor': 999}), [])
+
+        response = self.client.get(reverse('drinks-search'), {'descriptor': 'abc'})
+        assert response.status_code == 400
+        response = self.client.get(reverse('drinks-search'))
+        assert response.status_code == 400
+
+
+class FlavorProfileTestCase(DescriptorReviewsTestCase):
+    def profile(self, drink):
+        response = self.client.get(reverse('drink-flavor'), {'id': drink.id})
+        assert response.status_code == 200
+        return response.data
+
+    def test_profile(self):
+        drink = self.drinks[0]
+        self.assertEqual(self.profile(drink),
+                         {'drink': drink.id, 'review_count': 0, 'descriptors': []})
+
+        self.review(drink, {str(self.chocolate.id): 4, str(self.sweet.id): 2})
+        review_id = self.review(drink, {str(self.chocolate.id): 2})
+        self.review(drink, [self.floral.id])
+        self.review(self.drinks[1], [self.floral.id])
+        profile = self.profile(drink)
+        self.assertEqual(profile['review_count'], 3)
+        self.assertEqual(profile['descriptors'], [
+            {'id': self.sweet.id, 'reviews': 2, 'frequency': 0.6667, 'mean_intensity': 2.67},
+            {'id': self.chocolate.id, 'reviews': 2, 'frequency': 0.6667,
+             'mean_intensity': 3.0},
+            {'id': self.floral.id, 'reviews': 1, 'frequency': 0.3333,
+             'mean_intensity': None},
+        ])
+
+        response = self.client.put(reverse('reviews'),
+                                   {'id': review_id, 'descriptors': [self.floral.id]},
+                                   format='json')
+        assert response.status_code == 200
+        profile = self.profile(drink)
+        self.assertEqual([(d['id'], d['reviews']) for d in profile['descriptors']],
+                         [(self.sweet.id, 1), (self.chocolate.id, 1), (self.floral.id, 2)])
+
+        call_command('check_flavor_profiles', stdout=StringIO())
+        models.FlavorProfile.objects.filter(drink=drink).update(review_count=10)
+        with self.assertRaisesMessage(CommandError, '1 drinks'):
+            call_command('check_flavor_profiles', stdout=StringIO())
+        call_command('rebuild_flavor_profiles', stdout=StringIO())
+        call_command('check_flavor_profiles', stdout=StringIO())
+        self.assertEqual(self.profile(drink)['review_count'], 3)
+
+        response = self.client.get(reverse('drink-flavor'), {'id': 999})
+        assert response.status_code == 404
+
+
+class SearchTestCase(APITestCase):
+    def setUp(self):
+        shop = models.CoffeeShop(name='Chocolate Corner', address='12 Bean street')
+        shop.save()
+        self.mocha = models.CoffeeDrink(name='Mocha', price='3.00', volume=300, shop=shop)
+        self.mocha.save()
+        latte = models.CoffeeDrink(name='Latte', price='3.00', volume=300, shop=shop)
+        latte.save()
+        models.Review(drink=latte, notes='Notes of dark chocolate and cherry',
+                      overall_rating=4).save()
+
+    def search(self, query):
+        response = self.client.get(reverse('search'), query)
+        assert response.status_code == 200
+        return [(result['kind'], result['title'] or result['body'])
+                for result in response.data]
+
+    def test_search(self):
+        expected = [('shop', 'Chocolate Corner'),
+                    ('review', 'Notes of dark chocolate and cherry')]
+        self.assertEqual(self.search({'q': 'chocolate'}), expected)
+        # Prefixes and typos
+        self.assertEqual(self.search({'q': 'choc'}), expected)
+        self.assertEqual(self.search({'q': 'chocolte'}), expected)
+        self.assertEqual(self.search({'q': 'choc cherr'}), expected[1:])
+        self.assertEqual(self.search({'q': 'bean'}), [('shop', 'Chocolate Corner')])
+        self.assertEqual(self.search({'q': 'choc', 'kind': 'review,drink'}), expected[1:])
+        self.assertEqual(self.search({'q': 'choc', 'limit': 1}), expected[:1])
+        self.assertEqual(self.search({'q': 'xyz'}), [])
+        self.assertEqual(self.search({'q': ' '}), [])
+
+        response = self.client.get(reverse('search'), {'q': 'choc', 'kind': 'user'})
+        assert response.status_code == 400
+        response = self.client.get(reverse('search'), {'q': 'choc', 'limit': 100})
+        assert response.status_code == 400
+
+    def test_index_updates(self):
+        self.mocha.name = 'Chocolate mocha'
+        self.mocha.save()
+        self.assertEqual(self.search({'q': 'choc', 'kind': 'drink'}),
+                         [('drink', 'Chocolate mocha')])
+        self.assertEqual(self.search({'q': 'mocha'}), [('drink', 'Chocolate mocha')])
+
+        self.mocha.delete()
+        self.assertEqual(self.search({'q': 'mocha'}), [])
+
+        models.SearchDocument.objects.all().delete()
+        self.assertEqual(self.search({'q': 'bean'}), [])
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(self.search({'q': 'bean'}), [('shop', 'Chocolate Corner')])
+
+
+class NearbyShopsTestCase(APITestCase):
+    def setUp(self):
+        # Around Red Square, Moscow
+        shops = [('square', 55.7539, 37.6208), ('kremlin', 55.7520, 37.6175),
+                 ('arbat', 55.7495, 37.5910), ('tverskaya', 55.7650, 37.6050),
+                 ('petersburg', 59.9343, 30.3351), ('unknown', None, None)]
+        for name, latitude, longitude in shops:
+            models.CoffeeShop(name=name, address='addr', latitude=latitude,
+                              longitude=longitude).save()
+        models.CoffeeShop.objects.filter(name='kremlin').update(rating_mean=4)
+
+    def nearby(self, query):
+        response = self.client.get(reverse('shops-nearby'), query)
+        assert response.status_code == 200
+        return [shop['name'] for shop in response.data['results']]
+
+    def test_nearby(self):
+        here = {'lat': 55.7540, 'lon': 37.6200}
+        self.assertEqual(models.CoffeeShop.objects.get(name='square').geohash, 'ucfv0jdwh')
+        self.assertEqual(models.CoffeeShop.objects.get(name='unknown').geohash, '')
+
+        self.assertEqual(self.nearby(here), ['square', 'kremlin'])
+        self.assertEqual(self.nearby({**here, 'radius': 5}),
+                         ['square', 'kremlin', 'tverskaya', 'arbat'])
+        self.assertEqual(self.nearby({**here, 'radius': 5, 'min_rating': 3}), ['kremlin'])
+        response = self.client.get(reverse('shops-nearby'), {**here, 'radius': 5})
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual(response.data['results'][0]['distance'], 0.051)
+
+        for query in [{}, {'lat': 'abc', 'lon': 1}, {'lat': 91, 'lon': 1},
+                      {**here, 'radius': 0}, {**here, 'radius': 51}]:
+            response = self.client.get(reverse('shops-nearby'), query)
+            assert response.status_code == 400
+
+    def test_nearby_cells(self):
+        self.assertEqual(geo.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        # Cells are large enough for the radius on both sides of the antimeridian
+        cells = geo.nearby_cells(0.0, 179.999, 1)
+        assert any(cell.startswith('8') for cell in cells)
+        assert any(cell.startswith('2') for cell in cells)
+        self.assertIsNone(geo.nearby_cells(89.9999, 0.0, 1))
+
+    def test_bulk_coordinates(self):
+        owner = models.CoffeeDrinker.objects.create(username='owner')
+        owner.groups.add(Group.objects.get_or_create(name='shop owner')[0])
+        self.client.force_authenticate(owner)
+        response = self.client.post(reverse('shops-bulk'),
+                                    [{'name': 'new', 'address': 'addr',
+                                      'latitude': 55.7541, 'longitude': 37.6201}],
+                                    format='json')
+        assert response.status_code == 201
+        self.assertEqual(self.nearby({'lat': 55.7540, 'lon': 37.6200, 'radius': 0.1}),
+                         ['new', 'square'])
+
+        response = self.client.post(reverse('shops'),
+                                    {'name': 'half', 'address': 'addr', 'latitude': 1},
+                                    format='json')
+        assert response.status_code == 400
+
+
+class DrinkListTestCase(APITestCase):
+    def setUp(self):
+        self.shops = []
+        for i in range(2):
+            shop = models.CoffeeShop(name='shop%d' % i, address='addr')
+            shop.save()
+            self.shops.append(shop)
+        drinks = [('espresso', '2.00', 30, 0), ('latte', '3.00', 300, 0),
+                  ('cappuccino', '3.00', 200, 1), ('filter', '2.50', 500, 1),
+                  ('sample', '0.00', 0, 1)]
+        for name, price, volume, shop in drinks:
+            models.CoffeeDrink(name=name, price=price, volume=volume,
+                               shop=self.shops[shop]).save()
+
+    def names(self, query):
+        response = self.client.get(reverse('drinks'), query)
+        assert response.status_code == 200
+        return [drink['name'] for drink in response.data['results']]
+
+    def test_list(self):
+        self.assertEqual(self.names({}),
+                         ['espresso', 'latte', 'cappuccino', 'filter', 'sample'])
+        self.assertEqual(self.names({'min_price': '2.50', 'max_price': 3}),
+                         ['latte', 'cappuccino', 'filter'])
+        self.assertEqual(self.names({'min_volume': 100, 'max_volume': 300,
+                                     'ordering': '-volume'}), ['latte', 'cappuccino'])
+        self.assertEqual(self.names({'shop': self.shops[1].id, 'ordering': 'price'}),
+                         ['sample', 'filter', 'cappuccino'])
+        # Cheapest per ml, drinks without a volume left out
+        self.assertEqual(self.names({'ordering': 'price_per_ml'}),
+                         ['filter', 'latte', 'cappuccino', 'espresso'])
+        self.assertEqual(self.names({'ordering': 'price_per_ml', 'page_size': 2,
+                                     'pagination': 'cursor'}), ['filter', 'latte'])
+        drink = models.CoffeeDrink.objects.get(name='filter')
+        self.assertEqual(drink.price_per_ml, Decimal('0.005'))
+
+        response = self.client.get(reverse('drinks'), {'min_price': 'abc'})
+        assert response.status_code == 400
+
+    def test_query_plans(self):
+        # Every query of the listing has to run off an index, without sorting
+        cases = [{'ordering': 'price'}, {'ordering': '-volume'},
+                 {'ordering': 'price_per_ml'},
+                 {'min_price': 1, 'max_price': 3, 'ordering': 'price'},
+                 {'shop': self.shops[0].id, 'ordering': 'price'},
+                 {'shop': self.shops[0].id, 'ordering': '-price_per_ml'},
+                 {'ordering': 'price_per_ml', 'pagination': 'cursor'}]
+        for query in cases:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('drinks'), query)
+            assert response.status_code == 200
+            for captured in queries:
+                with connection.cursor() as cursor:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + captured['sql'])
+                    plan = [row[-1] for row in cursor.fetchall()]
+                for step in plan:
+                    if 'coffeestores_coffeedrink' in step:
+                        self.assertIn('INDEX', step, (query, plan))
+                    self.assertNotIn('TEMP B-TREE', step, (query, plan))
+
+
 class CoffeeDrinkViewSetTestCase(APITestCase):
     def setUp(self):
         shop_one = models.CoffeeShop(name='test1',
@@ -241,6 +1984,8 @@ class CoffeeDrinkViewSetTestCase(APITestCase):
         shop_owner.save()
         shop_owner.groups.add(owner_group)
         shop_owner.save()
+        # Shops without an owner are for staff only
+        models.CoffeeShop.objects.update(owner=shop_owner)
 
     def test_coffeedrink_get(self):
         url = reverse('drink')
@@ -419,6 +2164,35 @@ class ReviewViewSetTestCase(APITestCase):
         self.assertEqual(data['descriptors'], [1,2])
         self.assertEqual(data['overall_rating'], '1.1')
 
+    def test_reviews_list_by_drink(self):
+        url = reverse('reviews')
+
+        drink_two = models.CoffeeDrink(name='test2', price='1.00', volume=100,
+                                       shop_id=1)
+        drink_two.save()
+        authors = [models.CoffeeDrinker.objects.create(username='test%d' % i)
+                   for i in range(15)]
+        models.Review.objects.bulk_create(
+            [models.Review(drink=drink_two, author=author, overall_rating=2)
+             for author in authors])
+
+        # Only reviews of the requested drink, authors joined in, and the ETag
+        with self.assertNumQueries(4):
+            response = self.client.get(url, {'id': drink_two.id}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 15)
+        results = response.data['results']
+        self.assertEqual(len(results), 10)
+        self.assertEqual([review['author'] for review in results],
+                         [author.id for author in authors[:10]])
+        assert all(review['drink'] == drink_two.id for review in results)
+
+        query = {'id': drink_two.id, 'pagination': 'cursor'}
+        response = self.client.get(url, query, format='json')
+        with self.assertNumQueries(4):
+            response = self.client.get(response.data['next'], format='json')
+        self.assertEqual(len(response.data['results']), 5)
+
     def test_reviews_create(self):
         url = reverse('reviews')
 
@@ -460,6 +2234,124 @@ class ReviewViewSetTestCase(APITestCase):
         self.assertEqual(data['descriptors'], [1])
         self.assertEqual(data['overall_rating'], '2.2')
 
+    @override_settings(JOBS_EAGER=False)
+    def test_reviews_create_single_write(self):
+        url = reverse('reviews')
+
+        self.register()
+        headers = {'Authorization': 'Bearer ' + self.access}
+        query = {'drink': 1, 'overall_rating': 4.5}
+        # Missing and unknown drinks are refused by the serializer
+        response = self.client.post(url, {'overall_rating': 4.5}, headers=headers, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('drink', response.data)
+        response = self.client.post(url, {'drink': 999, 'overall_rating': 4.5},
+                                    headers=headers, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('drink', response.data)
+
+        drink = models.CoffeeDrink.objects.get(id=1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, query, headers=headers, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['author'],
+                         models.CoffeeDrinker.objects.get(username='test').id)
+        statements = [query['sql'] for query in queries.captured_queries]
+        # Drink lookup, then in one transaction the review and its search
+        # document, the ratings of its drink and shop (locked, then
+        # updated) and the job for the flavor profile
+        self.assertEqual(len(statements), 10)
+        self.assertTrue(statements[1].startswith('SAVEPOINT'))
+        self.assertTrue(statements[-1].startswith('RELEASE SAVEPOINT'))
+        writes = [(sql.split(' ')[0], sql.split('"')[1]) for sql in statements
+                  if sql.startswith(('INSERT', 'UPDATE'))]
+        self.assertEqual(writes, [('INSERT', 'coffeestores_review'),
+                                  ('INSERT', 'coffeestores_searchdocument'),
+                                  ('UPDATE', 'coffeestores_coffeedrink'),
+                                  ('UPDATE', 'coffeestores_coffeeshop'),
+                                  ('INSERT', 'coffeestores_job')])
+        # The job has not run, the ratings were updated all the same
+        reviewed = models.CoffeeDrink.objects.get(id=1)
+        self.assertEqual(reviewed.review_count, drink.review_count + 1)
+        self.assertEqual(reviewed.rating_sum, drink.rating_sum + Decimal('4.5'))
+
+    def test_reviews_aggregates(self):
+        url = reverse('reviews')
+
+        self.register()
+        call_command('rebuild_ratings', stdout=StringIO())
+        drink_two = models.CoffeeDrink(name='test2', price='1.00', volume=100,
+                                       shop_id=1)
+        drink_two.save()
+
+        headers = {'Authorization': 'Bearer ' + self.access}
+        for drink, rating in [(1, 4.5), (1, 3.2), (drink_two.id, 5.0)]:
+            query = {'drink': drink, 'overall_rating': rating}
+            response = self.client.post(url, query, headers=headers, format='json')
+            self.assertEqual(response.status_code, 201)
+        query = {'id': 1, 'overall_rating': 3.9}
+        response = self.client.put(url, query, headers=headers, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(reverse('drink'), {'id': 1}, format='json')
+        self.assertEqual(response.data['review_count'], 3)
+        self.assertEqual(response.data['rating_mean'], '3.87')
+        self.assertEqual(response.data['rating_histogram'], {'3': 2, '4': 1})
+
+        response = self.client.get(reverse('shops'), {'id': 1}, format='json')
+        self.assertEqual(response.data['review_count'], 4)
+        self.assertEqual(response.data['rating_mean'], '4.15')
+        self.assertEqual(response.data['rating_histogram'], {'3': 2, '4': 1, '5': 1})
+
+        # Rebuilding from scratch gives the same numbers
+        models.CoffeeDrink.objects.update(review_count=0, rating_histogram={})
+        call_command('rebuild_ratings', stdout=StringIO())
+        drink = models.CoffeeDrink.objects.get(id=1)
+        self.assertEqual(drink.review_count, 3)
+        self.assertEqual(str(drink.rating_mean), '3.87')
+        self.assertEqual(drink.rating_histogram, {'3': 2, '4': 1})
+        shop = models.CoffeeShop.objects.get(id=1)
+        self.assertEqual(shop.rating_histogram, {'3': 2, '4': 1, '5': 1})
+
+        # Ratings go from 0 to 5
+        for rating in [-0.5, 5.5]:
+            response = self.client.post(url, {'drink': 1, 'overall_rating': rating},
+                                        headers=headers, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('overall_rating', response.data)
+        response = self.client.put(url, {'id': 1, 'overall_rating': -1},
+                                   headers=headers, format='json')
+        self.assertEqual(response.status_code, 400)
+        # Written around the API, still bucketed the same both ways
+        self.assertEqual(aggregates.get_bucket(Decimal('-0.5')), '-1')
+        models.Review.objects.filter(id=1).update(overall_rating=Decimal('-0.5'))
+        call_command('rebuild_ratings', stdout=StringIO())
+        drink = models.CoffeeDrink.objects.get(id=1)
+        self.assertIn('-1', drink.rating_histogram)
+
+    def test_shops_by_rating(self):
+        url = reverse('shops')
+
+        models.CoffeeShop.objects.bulk_create([
+            models.CoffeeShop(name='good', address='a', rating_mean=4.5, review_count=2),
+            models.CoffeeShop(name='bad', address='a', rating_mean=1.5, review_count=9),
+        ])
+
+        query = {'ordering': '-rating_mean'}
+        with self.assertNumQueries(7):
+            response = self.client.get(url, query, format='json')
+        self.assertEqual(response.data['results'][0]['name'], 'good')
+
+        query = {'min_rating': 2, 'max_rating': 5}
+        response = self.client.get(url, query, format='json')
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['name'], 'good')
+
+        query = {'min_reviews': 5, 'ordering': 'review_count', 'pagination': 'cursor'}
+        response = self.client.get(url, query, format='json')
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['name'], 'bad')
+
     def test_reviews_update(self):
         url = reverse('reviews')
 
@@ -519,6 +2411,10 @@ class ReviewViewSetTestCase(APITestCase):
 
         
 class AuthViewSetTestCase(APITestCase):
+    def setUp(self):
+        # Failed login counters of other tests
+        cache.clear()
+
     def register(self):
         url = reverse('auth-register')
         data = {'username': 'test',
@@ -585,6 +2481,82 @@ class AuthViewSetTestCase(APITestCase):
         assert 'refresh' in list(response.data)
         assert 'access' in list(response.data)
 
+    def test_login_throttling(self):
+        self.register()
+        models.CoffeeDrinker.objects.create(username='other', password=make_password('other'))
+        url = reverse('auth-login')
+        for i in range(settings.LOGIN_FAILURES_PER_USERNAME):
+            response = self.client.post(url, {'username': 'test', 'password': 'wrong'},
+                                        format='json')
+            self.assertEqual(response.status_code, 401)
+        # Refused before the user is looked up or the password hashed
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, {'username': 'test', 'password': 'test'},
+                                        format='json')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(queries), 0)
+        self.assertLessEqual(int(response['Retry-After']), settings.LOGIN_FAILURE_WINDOW + 1)
+        # Usernames are case sensitive, so are their counts
+        response = self.client.post(url, {'username': 'TEST', 'password': 'test'},
+                                    format='json')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post(url, {'username': 'other', 'password': 'other'},
+                                    format='json')
+        self.assertEqual(response.status_code, 200)
+
+        # A successful login starts the count over
+        response = self.client.post(url, {'username': 'other', 'password': 'wrong'},
+                                    format='json')
+        self.assertEqual(response.status_code, 401)
+        with override_settings(LOGIN_FAILURES_PER_USERNAME=2):
+            for password, status_code in [('other', 200), ('wrong', 401), ('other', 200)]:
+                response = self.client.post(url, {'username': 'other', 'password': password},
+                                            format='json')
+                self.assertEqual(response.status_code, status_code)
+
+        # Storms of usernames from one address
+        with override_settings(LOGIN_FAILURES_PER_IP=3):
+            for i in range(3):
+                response = self.client.post(url, {'username': 'nobody%d' % i, 'password': 'x'},
+                                            format='json', REMOTE_ADDR='10.0.0.1')
+                self.assertEqual(response.status_code, 404)
+            response = self.client.post(url, {'username': 'other', 'password': 'other'},
+                                        format='json', REMOTE_ADDR='10.0.0.1')
+            self.assertEqual(response.status_code, 429)
+            response = self.client.post(url, {'username': 'other', 'password': 'other'},
+                                        format='json', REMOTE_ADDR='10.0.0.2')
+            self.assertEqual(response.status_code, 200)
+
+    def test_rehash_on_login(self):
+        url = reverse('auth-login')
+        user = models.CoffeeDrinker.objects.create(
+            username='test', password=make_password('test', hasher='pbkdf2_sha1'))
+        data = {'username': 'test', 'password': 'test'}
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, 200)
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$%d$'
+                                                 % settings.PASSWORD_HASH_ITERATIONS))
+
+        with override_settings(PASSWORD_HASH_ITERATIONS=settings.PASSWORD_HASH_ITERATIONS * 2):
+            response = self.client.post(url, data, format='json')
+            self.assertEqual(response.status_code, 200)
+            user.refresh_from_db()
+            self.assertTrue(user.password.startswith('pbkdf2_sha256$%d$'
+                                                     % settings.PASSWORD_HASH_ITERATIONS))
+            # Up to date, nothing to save
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(url, data, format='json')
+            self.assertEqual(response.status_code, 200)
+            assert not any(query['sql'].startswith('UPDATE') for query in queries)
+
+        # A lower work factor never weakens a stored hash
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, 200)
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$%d$'
+                                                 % (settings.PASSWORD_HASH_ITERATIONS * 2)))
+
     def test_refresh(self):
         self.register()
         url = reverse('auth-refresh')
@@ -602,6 +2574,150 @@ class AuthViewSetTestCase(APITestCase):
         assert 'access' in list(response.data)
 
 
+class TokenRevocationTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        response = self.client.post(reverse('auth-register'),
+                                    {'username': 'test', 'password': 'test'},
+                                    format='json')
+        self.tokens = response.data
+
+    def test_rotation(self):
+        url = reverse('auth-refresh')
+        response = self.client.post(url, {'refresh': self.tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, 200)
+        rotated = response.data['refresh']
+        self.assertNotEqual(rotated, self.tokens['refresh'])
+        # Each refresh token works once
+        response = self.client.post(url, {'refresh': self.tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, {'refresh': rotated}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+        self.assertEqual(self.client.get(reverse('users-me')).data['username'], 'test')
+
+    def test_logout(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.tokens['access'])
+        self.assertEqual(self.client.get(reverse('users-me')).status_code, 200)
+        response = self.client.post(reverse('auth-logout'), {'refresh': 'test'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('auth-logout'), {'refresh': self.tokens['refresh']},
+                                    format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse('users-me')).status_code, 401)
+        self.client.credentials()
+        response = self.client.post(reverse('auth-refresh'), {'refresh': self.tokens['refresh']},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_filter(self):
+        # Not revoked, answered without a query
+        with self.assertNumQueries(0):
+            self.assertFalse(revocations.is_revoked('0' * 32))
+        # An id taken by a revocation that commits later on
+        expires_at = timezone.now() + timedelta(hours=1)
+        late_id = models.RevokedToken.objects.create(jti='late', expires_at=expires_at).id
+        models.RevokedToken.objects.filter(id=late_id).delete()
+        # Revoked by another process, seen once the filter loads it
+        models.RevokedToken.objects.create(jti='1' * 32,
+                                           expires_at=timezone.now() + timedelta(hours=1))
+        self.assertFalse(revocations.is_revoked('1' * 32))
+        with override_settings(REVOKED_TOKENS_BLOOM_REFRESH=0):
+            self.assertTrue(revocations.is_revoked('1' * 32))
+        with override_settings(REVOKED_TOKENS_BLOOM=False):
+            self.assertTrue(revocations.is_revoked('1' * 32))
+        # Committed after the later one was loaded
+        models.RevokedToken.objects.create(id=late_id, jti='2' * 32, expires_at=expires_at)
+        models.RevokedToken.objects.filter(id=late_id).update(
+            revoked_at=timezone.now() - timedelta(seconds=60))
+        self.assertFalse(revocations.is_revoked('2' * 32))
+        with override_settings(REVOKED_TOKENS_BLOOM_REFRESH=0):
+            self.assertTrue(revocations.is_revoked('2' * 32))
+
+        bloom = revocations.BloomFilter(1000)
+        for i in range(1000):
+            bloom.add('in%d' % i)
+        assert all('in%d' % i in bloom for i in range(1000))
+        false_positives = sum('out%d' % i in bloom for i in range(10000))
+        self.assertLess(false_positives, 100)
+
+    def test_prune(self):
+        now = timezone.now()
+        models.RevokedToken.objects.create(jti='expired', expires_at=now - timedelta(seconds=1))
+        models.RevokedToken.objects.create(jti='live', expires_at=now + timedelta(hours=1))
+        out = StringIO()
+        call_command('prune_revoked_tokens', stdout=out)
+        self.assertIn('Pruned 1 revoked tokens', out.getvalue())
+        self.assertEqual(list(models.RevokedToken.objects.values_list('jti', flat=True)),
+                         ['live'])
+
+
+class TokenUserTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        response = self.client.post(reverse('auth-register'),
+                                    {'username': 'test', 'password': 'test'},
+                                    format='json')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+        self.user = models.CoffeeDrinker.objects.get(username='test')
+        shop = models.CoffeeShop.objects.create(name='shop', address='addr')
+        self.drink = models.CoffeeDrink.objects.create(name='drink', price='1.00',
+                                                       volume=100, shop=shop)
+        # Caches the roles and flags of the user
+        self.client.get(reverse('users-me'))
+
+    def user_queries(self, queries):
+        return [query['sql'] for query in queries if '"auth_user"' in query['sql']]
+
+    def test_endpoint_queries(self):
+        url = reverse('users-me')
+        # ETag row + the CoffeeDrinker to serialize, no user lookup for the token
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(response.data['username'], 'test')
+        # CoffeeDrinker + its two tables' updates
+        with self.assertNumQueries(3):
+            response = self.client.put(url, {'first_name': 'first'}, format='json')
+        self.assertEqual(response.data['first_name'], 'first')
+
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('reviews'),
+                                        {'drink': self.drink.id, 'notes': '',
+                                         'descriptors': [], 'overall_rating': 4},
+                                        format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['author'], self.user.id)
+        self.assertEqual(self.user_queries(queries), [])
+        response = self.client.get(reverse('reviews'), {'id': self.drink.id})
+        self.assertEqual(response.data['results'][0]['author'], self.user.id)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.delete(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([sql for sql in self.user_queries(queries)
+                              if sql.startswith('SELECT')]), 1)
+        # The token outlives the user, not its access
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 401)
+
+    def test_identity_changes(self):
+        response = self.client.get(reverse('export', args=['shops']))
+        self.assertEqual(response.status_code, 403)
+        # Flags and groups apply to tokens issued before
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('export', args=['shops']))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse('owners-me-shops')).status_code, 403)
+        self.user.groups.add(Group.objects.create(name='shop owner'))
+        self.assertEqual(self.client.get(reverse('owners-me-shops')).status_code, 200)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('users-me')).status_code, 401)
+
+
 class UsersMeViewSetTestCase(APITestCase):
     def register(self):
         url = reverse('auth-register')
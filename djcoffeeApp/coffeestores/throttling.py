@@ -0,0 +1,49 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def cache_key(kind, value, window):
+    digest = hashlib.md5(value.encode()).hexdigest()
+    return 'login-failures:%s:%s:%d' % (kind, digest, window)
+
+
+def get_client_ip(request):
+    return request.META.get('REMOTE_ADDR') or ''
+
+
+def get_counters(username, ip):
+    # (cache key, limit) of the current window, the same for every worker.
+    # Usernames as given, they are case sensitive
+    window = int(time.time() // settings.LOGIN_FAILURE_WINDOW)
+    return [(cache_key('username', username, window),
+             settings.LOGIN_FAILURES_PER_USERNAME),
+            (cache_key('ip', ip, window), settings.LOGIN_FAILURES_PER_IP)]
+
+
+def get_retry_after(username, ip):
+    # Seconds until a login may be tried again, 0 when it may be now.
+    # A cache lookup, made before any user query or password hash
+    counters = get_counters(username, ip)
+    failures = cache.get_many([key for key, limit in counters])
+    if all(failures.get(key, 0) < limit for key, limit in counters):
+        return 0
+    window = settings.LOGIN_FAILURE_WINDOW
+    return int(window - time.time() % window) + 1
+
+
+def record_failure(username, ip):
+    for key, limit in get_counters(username, ip):
+        cache.add(key, 0, settings.LOGIN_FAILURE_WINDOW)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Expired in between
+            cache.set(key, 1, settings.LOGIN_FAILURE_WINDOW)
+
+
+def reset(username):
+    key, limit = get_counters(username, '')[0]
+    cache.delete(key)
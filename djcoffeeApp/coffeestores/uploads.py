@@ -0,0 +1,300 @@
+import math
+import struct
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from PIL import Image
+from rest_framework import status
+from rest_framework.exceptions import APIException, UnsupportedMediaType
+
+
+# format: (leading bytes, extension)
+SIGNATURES = {
+    'JPEG': ([b'\xff\xd8\xff'], '.jpg'),
+    'PNG': ([b'\x89PNG\r\n\x1a\n'], '.png'),
+    'GIF': ([b'GIF87a', b'GIF89a'], '.gif'),
+    'WEBP': ([b'RIFF'], '.webp'),
+}
+# Room for the multipart boundaries and the other form fields
+MULTIPART_OVERHEAD = 64 * 1024
+# Dimensions have to be readable from this much of the file
+MAX_HEADER_BYTES = 1024 * 1024
+
+
+class PayloadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Upload is too large'
+    default_code = 'payload_too_large'
+
+
+def sniff(head):
+    for format, (signatures, extension) in SIGNATURES.items():
+        if any(head.startswith(signature) for signature in signatures):
+            if format == 'WEBP' and head[8:12] != b'WEBP':
+                continue
+            return format
+    return None
+
+
+class MetadataFilter:
+    # Streams a photo through without its EXIF, XMP and text metadata, GPS
+    # positions included. Image data passes unchanged, byte for byte
+    def __init__(self):
+        self.pending = b''
+        self.copy = 0
+        self.skip = 0
+        self.blank = False
+        self.started = False
+
+    def feed(self, data):
+        out = []
+        self.pending += data
+        while self.pending:
+            if self.copy:
+                piece = self.pending[:self.copy] if self.copy < len(self.pending) \
+                    else self.pending
+                out.append(piece)
+                self.pending = self.pending[len(piece):]
+                self.copy -= len(piece)
+            elif self.skip:
+                count = min(self.skip, len(self.pending))
+                if self.blank:
+                    out.append(bytes(count))
+                self.pending = self.pending[count:]
+                self.skip -= count
+            else:
+                header = self.step()
+                if header is None:
+                    break
+                out.append(header)
+        return b''.join(out)
+
+    def close(self):
+        # A truncated header, kept as it was
+        rest, self.pending = self.pending, b''
+        return rest
+
+    def take(self, size):
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def step(self):
+        # Consumes the next header from pending and returns what replaces
+        # it, None until enough of it arrived. GIFs carry no EXIF
+        self.copy = math.inf
+        return b''
+
+
+class JPEGMetadataFilter(MetadataFilter):
+    # APP1 (EXIF, XMP), APP13 (IPTC) and comments are left out, the
+    # orientation is kept in an EXIF segment of its own
+    dropped = {0xE1, 0xED, 0xFE}
+
+    def step(self):
+        if len(self.pending) < 2:
+            return None
+        if not self.started:
+            self.started = True
+            return self.take(2)
+        if self.pending[0] != 0xFF:
+            self.copy = math.inf
+            return b''
+        marker = self.pending[1]
+        if marker == 0xFF:
+            return self.take(1)
+        if marker == 0xDA:
+            # Start of scan, the rest is image data
+            self.copy = math.inf
+            return b''
+        if len(self.pending) < 4:
+            return None
+        length = 2 + struct.unpack('>H', self.pending[2:4])[0]
+        if marker not in self.dropped:
+            self.copy = length
+            return b''
+        if marker != 0xE1:
+            self.skip = length
+            return b''
+        if len(self.pending) < length:
+            return None
+        return orientation_segment(self.take(length)[4:])
+
+
+def orientation_segment(payload):
+    if not payload.startswith(b'Exif\x00\x00'):
+        return b''
+    exif = Image.Exif()
+    try:
+        exif.load(payload[6:])
+    except Exception:
+        return b''
+    orientation = exif.get(0x0112)
+    if orientation not in range(2, 9):
+        return b''
+    tiff = b'MM\x00*' + struct.pack('>IHHHIHHI', 8, 1, 0x0112, 3, 1, orientation, 0, 0)
+    return b'\xff\xe1' + struct.pack('>H', 2 + 6 + len(tiff)) + b'Exif\x00\x00' + tiff
+
+
+class PNGMetadataFilter(MetadataFilter):
+    dropped = {b'eXIf', b'tEXt', b'zTXt', b'iTXt'}
+
+    def step(self):
+        if not self.started:
+            if len(self.pending) < 8:
+                return None
+            self.started = True
+            return self.take(8)
+        if len(self.pending) < 8:
+            return None
+        length, kind = struct.unpack('>I4s', self.pending[:8])
+        header = self.take(8)
+        # Data and CRC
+        if kind in self.dropped:
+            self.skip = length + 4
+            return b''
+        self.copy = math.inf if kind == b'IEND' else length + 4
+        return header
+
+
+class WebPMetadataFilter(MetadataFilter):
+    # The RIFF size was written before the chunks are seen, so metadata
+    # chunks are blanked into JUNK chunks of the same size rather than
+    # dropped. Readers skip those
+    dropped = {b'EXIF', b'XMP '}
+
+    def step(self):
+        if not self.started:
+            if len(self.pending) < 12:
+                return None
+            self.started = True
+            return self.take(12)
+        if len(self.pending) < 8:
+            return None
+        kind, size = struct.unpack('<4sI', self.pending[:8])
+        padded = size + (size & 1)
+        if kind == b'VP8X':
+            if len(self.pending) < 9:
+                return None
+            header = bytearray(self.take(9))
+            # No EXIF or XMP flags
+            header[8] &= ~0x0C
+            self.copy = padded - 1
+            return bytes(header)
+        self.take(8)
+        if kind in self.dropped:
+            self.skip, self.blank = padded, True
+            return b'JUNK' + struct.pack('<I', size)
+        self.copy = padded
+        return struct.pack('<4sI', kind, size)
+
+
+METADATA_FILTERS = {
+    'JPEG': JPEGMetadataFilter,
+    'PNG': PNGMetadataFilter,
+    'WEBP': WebPMetadataFilter,
+}
+
+
+class StoredPhoto(UploadedFile):
+    # Already in storage under stored_name, assign that rather than the file
+    def __init__(self, stored_name, name, content_type, size):
+        super().__init__(None, name, content_type, size)
+        self.stored_name = stored_name
+
+
+class PhotoUploadHandler(FileUploadHandler):
+    # Streams the "photo" file straight into storage less its metadata,
+    # rejecting it as soon as the bytes seen so far show it is not an image
+    # or is too large
+
+    def __init__(self, request, directory, field_name='photo'):
+        super().__init__(request)
+        self.directory = directory
+        self.field_name = field_name
+        self.max_bytes = settings.PHOTO_UPLOAD_MAX_BYTES
+        self.max_pixels = settings.PHOTO_UPLOAD_MAX_PIXELS
+        self.writer = None
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # Nothing of the body is read yet
+        if content_length > self.max_bytes + MULTIPART_OVERHEAD:
+            raise PayloadTooLarge()
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        if field_name != self.field_name:
+            raise SkipFile()
+        self.head = b''
+        self.format = None
+        self.dimensions = None
+        self.writer = default_storage.open_writer(self.directory)
+
+    def receive_data_chunk(self, raw_data, start):
+        try:
+            if self.format is None:
+                self.format = sniff(raw_data)
+                if self.format is None:
+                    raise UnsupportedMediaType(self.content_type or '',
+                                               detail='Photo is not a JPEG, PNG, GIF or WebP image')
+                self.metadata = METADATA_FILTERS.get(self.format, MetadataFilter)()
+            if start + len(raw_data) > self.max_bytes:
+                raise PayloadTooLarge()
+            if self.dimensions is None:
+                self.head += raw_data
+                self.check_dimensions(final=len(self.head) >= MAX_HEADER_BYTES)
+            self.writer.write(self.metadata.feed(raw_data))
+        except BaseException:
+            self.abort()
+            raise
+        return None
+
+    def check_dimensions(self, final):
+        try:
+            with Image.open(BytesIO(self.head)) as image:
+                format, dimensions = image.format, image.size
+        except Exception:
+            if final:
+                raise UnsupportedMediaType(self.content_type or '',
+                                           detail='Photo is not a readable image')
+            return
+        if format != self.format:
+            raise UnsupportedMediaType(self.content_type or '',
+                                       detail='Photo content does not match its format')
+        if dimensions[0] * dimensions[1] > self.max_pixels:
+            raise PayloadTooLarge('Photo has more than %d pixels' % self.max_pixels)
+        self.dimensions = dimensions
+        self.head = b''
+
+    def file_complete(self, file_size):
+        if self.writer is None:
+            return None
+        try:
+            if self.format is None:
+                raise UnsupportedMediaType(self.content_type or '', detail='Photo is empty')
+            if self.dimensions is None:
+                self.check_dimensions(final=True)
+            self.writer.write(self.metadata.close())
+            stored_size = self.writer.size
+            stored_name = self.writer.close(SIGNATURES[self.format][1])
+        except BaseException:
+            self.abort()
+            raise
+        self.writer = None
+        return StoredPhoto(stored_name, self.file_name, self.content_type, stored_size)
+
+    def upload_interrupted(self):
+        self.abort()
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.abort()
+            self.writer = None
+
+
+def handle_photo(request, model):
+    # Call before anything reads the body
+    request.upload_handlers = [PhotoUploadHandler(request,
+                                                  model._meta.get_field('photo').upload_to)]
@@ -1,9 +1,14 @@
 from django.shortcuts import render, get_object_or_404
-from django.contrib.auth.hashers import check_password, make_password
+from django.http import Http404, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, quote_etag
+from django.db import transaction
+from django.db.models import Count, Max, Prefetch, prefetch_related_objects
+from django.contrib.auth.hashers import make_password
 
 
 import rest_framework.filters
-from rest_framework import status, viewsets, permissions
+from rest_framework import status, viewsets
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.parsers import FormParser, MultiPartParser, JSONParser
 from rest_framework_simplejwt.tokens import RefreshToken, Token
@@ -15,78 +20,267 @@ from django_filters.rest_framework import DjangoFilterBackend
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 # Create your views here.
-from coffeestores import serializers, models, paginators, filters
-
+from coffeestores import serializers, models, paginators, filters, permissions
+from coffeestores import aggregates, descriptors, exports, geo, images, jobs, responses, search, tasks
+from coffeestores import authentication, revocations, throttling, uploads
+
+
+pagination_parameters = [
+    openapi.Parameter('pagination', openapi.IN_QUERY,
+                      description='Pagination mode: "page" (default) or "cursor"',
+                      type=openapi.TYPE_STRING, enum=['page', 'cursor']),
+    openapi.Parameter('cursor', openapi.IN_QUERY,
+                      description='Opaque cursor from a next/previous link, implies cursor mode',
+                      type=openapi.TYPE_STRING),
+    openapi.Parameter('skip_count', openapi.IN_QUERY,
+                      description='Cursor mode only: omit the total count',
+                      type=openapi.TYPE_BOOLEAN),
+]
+
+
+def get_scopes(name):
+    # Details depend on their own generation, everything else on the list's
+    def get(request):
+        id = request.GET.get('id', '')
+        return ['%s:%d' % (name, int(id))] if id.isdigit() else ['%ss' % name]
+    return get
+
+
+def shop_validators(viewset, request):
+    id = request.GET.get('id')
+    if not id:
+        # Shops list their drinks
+        shops = viewset.filter_queryset(viewset.get_queryset())
+        return responses.make_etag(request, responses.get_version(shops),
+                                   responses.get_version(models.CoffeeDrink.objects.all())), None
+    if not id.isdigit():
+        return None
+    version = models.CoffeeShop.objects.filter(id=id).annotate(
+        drink_count=Count('coffeedrink'), drinks_updated_at=Max('coffeedrink__updated_at')
+    ).values_list('updated_at', 'drink_count', 'drinks_updated_at').first()
+    if version is None:
+        return None
+    # Drinks moving to another shop leave no newer timestamp behind
+    return responses.make_etag(request, *version), None
+
+
+def drink_validators(viewset, request):
+    id = request.GET.get('id', '')
+    if not id.isdigit():
+        return None
+    updated_at = models.CoffeeDrink.objects.filter(id=id).values_list(
+        'updated_at', flat=True).first()
+    if updated_at is None:
+        return None
+    return responses.make_etag(request, updated_at), updated_at
+
+
+def review_validators(viewset, request):
+    id = request.GET.get('id', '')
+    if not id.isdigit():
+        return None
+    reviews = models.Review.objects.filter(drink_id=id)
+    return responses.make_etag(request, responses.get_version(reviews)), None
+
+
+def drinker_validators(viewset, request):
+    # No timestamp, the row is small enough to compare as it is
+    if request.user.is_anonymous:
+        return None
+    row = viewset.queryset.filter(id=request.user.id).values_list(
+        *viewset.serializer_class.Meta.fields).first()
+    if row is None:
+        return None
+    return responses.make_etag(request, row), None
+
+
+def set_job(response, job):
+    # Follow-up work left to a worker, its status is at /jobs?id=
+    if job is not None:
+        response['X-Job-Id'] = job.id
+    return response
+
+
+def get_bulk_instances(queryset, data):
+    # Instances in request order, with a per-item error list like the one
+    # a ListSerializer reports
+    ids = [item.get('id') if isinstance(item, dict) else None for item in data]
+    found = queryset.in_bulk({int(item_id) for item_id in ids if str(item_id).isdigit()})
+    instances, errors, seen = [], [], set()
+    for item_id in ids:
+        if not str(item_id).isdigit():
+            errors.append({'id': ['No id provided']})
+        elif int(item_id) not in found:
+            errors.append({'id': ['Not found']})
+        elif int(item_id) in seen:
+            errors.append({'id': ['Duplicate id']})
+        else:
+            instances.append(found[int(item_id)])
+            errors.append({})
+            seen.add(int(item_id))
+    return instances, errors
+
+
+def get_bulk_related(model, data, field):
+    if not isinstance(data, list):
+        return {}
+    ids = {item.get(field) for item in data if isinstance(item, dict)}
+    return model.objects.in_bulk({int(pk) for pk in ids if str(pk).isdigit()})
 
 
 class CoffeeShopViewSet(viewsets.ModelViewSet):
-    queryset = models.CoffeeShop.objects.all()
+    queryset = models.CoffeeShop.objects.prefetch_related(
+        Prefetch('coffeedrink_set', queryset=models.CoffeeDrink.objects.order_by('id')))
     serializer_class = serializers.CoffeeShopSerializer
     put_serializer_class = serializers.CoffeeShopPutSerializer
-    paginator = paginators.CoffeeShopPaginator()
+    pagination_class = paginators.CoffeeShopPaginator
+    pagination_mode = 'page'
     filter_backends = [DjangoFilterBackend, rest_framework.filters.OrderingFilter]
     filterset_class = filters.CoffeeShopFilterSet
+    ordering_fields = ['id', 'name', 'address', 'rating_mean', 'review_count']
+    ordering = ['id']
+    owner_actions = ['create', 'update', 'bulk_create', 'bulk_update']
+    bulk_max_items = 1000
+    nearby_radius = 1
+    max_nearby_radius = 50
+
+    def get_permissions(self):
+        if self.action in self.owner_actions:
+            return [permissions.IsShopOwner()]
+        return super().get_permissions()
 
     shop_id = openapi.Parameter('id', openapi.IN_QUERY, 
                                 description="Id of a shop to get details of", 
                                 type=openapi.TYPE_INTEGER)
     @swagger_auto_schema(responses={200: serializers.CoffeeShopSerializer,
+                                    304: 'Not modified',
                                     400: 'Shop id is not a number',
                                     404: 'Invalid shop id'},
-                         manual_parameters=[shop_id])
+                         manual_parameters=[shop_id, *pagination_parameters])
+    @responses.cached('shops', get_scopes('shop'))
+    @responses.conditional(shop_validators)
     def list(self, request):
         coffeeshop_id = request.GET.get('id')
         if not coffeeshop_id:
             queryset = self.filter_queryset(self.get_queryset())
-            shops_data = self.serializer_class(queryset, many=True).data
-                
-            result_page = self.paginator.paginate_queryset(queryset, request)
+            paginator = paginators.get_paginator(request, self)
+            result_page = paginator.paginate_queryset(queryset, request)
             serializer = self.serializer_class(result_page, many=True,
                                                context={'request': request})
 
-            return self.paginator.get_paginated_response(serializer.data)
+            return paginator.get_paginated_response(serializer.data)
 
         if not coffeeshop_id.isdigit():
             return Response('Shop id is not a number', status=400)
-        shop = get_object_or_404(self.queryset, id=coffeeshop_id)
+        shop = get_object_or_404(self.get_queryset(), id=coffeeshop_id)
         shop_data = self.serializer_class(shop).data
-        drinks = models.CoffeeDrink.objects.filter(shop=coffeeshop_id)
-        drinks_data = serializers.CoffeeDrinkSerializer(drinks, many=True).data
-
-        shop_data['drinks'] = drinks_data
         return Response(shop_data)
 
+    nearby_parameters = [
+        openapi.Parameter('lat', openapi.IN_QUERY, description='Latitude in degrees',
+                          type=openapi.TYPE_NUMBER, required=True),
+        openapi.Parameter('lon', openapi.IN_QUERY, description='Longitude in degrees',
+                          type=openapi.TYPE_NUMBER, required=True),
+        openapi.Parameter('radius', openapi.IN_QUERY,
+                          description='Search radius in km, 1 by default, at most 50',
+                          type=openapi.TYPE_NUMBER),
+    ]
+    @swagger_auto_schema(responses={200: serializers.NearbyShopSerializer(many=True),
+                                    400: 'Invalid coordinates or radius'},
+                         manual_parameters=nearby_parameters)
+    def nearby(self, request):
+        try:
+            latitude = float(request.GET['lat'])
+            longitude = float(request.GET['lon'])
+            radius = float(request.GET.get('radius', self.nearby_radius))
+        except (KeyError, ValueError):
+            return Response('lat and lon must be numbers', status=400)
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180
+                and 0 < radius <= self.max_nearby_radius):
+            return Response('Coordinates or radius out of range', status=400)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        found = geo.nearby(queryset, latitude, longitude, radius)
+        paginator = paginators.CoffeeShopPaginator()
+        result_page = paginator.paginate_queryset(found, request)
+        shops = self.get_queryset().in_bulk([shop_id for distance, shop_id in result_page])
+        for distance, shop_id in result_page:
+            shops[shop_id].distance = round(distance, 3)
+        serializer = serializers.NearbyShopSerializer(
+            [shops[shop_id] for distance, shop_id in result_page], many=True)
+
+        return paginator.get_paginated_response(serializer.data)
+
     @swagger_auto_schema(responses={201: serializers.CoffeeShopSerializer,
                                     400: 'Invalid shop data',
-                                    401: 'Unauthorized or dont have the permission'})
+                                    401: 'Unauthorized',
+                                    403: 'Not a shop owner'})
     def create(self, request):
-        user = request.user
-        if user.is_anonymous or not user.groups.filter(name='shop owner').exists():
-            return Response('Unauthorized or dont have the permission', status=401)
         serializer = self.serializer_class(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=400)
-        serializer.save()
+        serializer.save(owner_id=request.user.id)
         return Response(serializer.data, status=201)
 
     @swagger_auto_schema(responses={200: serializers.CoffeeShopSerializer,
                                     400: 'Invalid shop data or shop id',
-                                    401: 'Unauthorized or dont have the permission',
+                                    401: 'Unauthorized',
+                                    403: 'Not a shop owner',
                                     404: 'Shop not found'},
                          request_body=serializers.CoffeeShopPutSerializer)
     def update(self, request):
-        user = request.user
-        if user.is_anonymous or not user.groups.filter(name='shop owner').exists():
-            return Response('Unauthorized or dont have the permission', status=401)
         if 'id' not in list(request.data) or not str(request.data['id']).isdigit():
             return Response('No shop id provided', status=400)
         shop = get_object_or_404(self.queryset, id=request.data['id'])
+        self.check_object_permissions(request, shop)
         serializer = self.serializer_class(shop, data=request.data, partial=True) 
         if not serializer.is_valid():
             return Response(serializer.errors, status=400)
         serializer.save()
         return Response(serializer.data, status=200)
 
+    @swagger_auto_schema(responses={201: serializers.CoffeeShopSerializer(many=True),
+                                    400: 'Invalid shop data, errors are reported per item',
+                                    401: 'Unauthorized',
+                                    403: 'Not a shop owner'},
+                         request_body=serializers.CoffeeShopSerializer(many=True))
+    def bulk_create(self, request):
+        serializer = self.serializer_class(data=request.data, many=True,
+                                           max_length=self.bulk_max_items)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=400)
+        with transaction.atomic():
+            shops = serializer.save(owner_id=request.user.id)
+            search.index_objects('shop', shops)
+            responses.invalidate_shops([])
+        prefetch_related_objects(shops, 'coffeedrink_set')
+        return Response(serializer.data, status=201)
+
+    @swagger_auto_schema(responses={200: serializers.CoffeeShopSerializer(many=True),
+                                    400: 'Invalid shop data, errors are reported per item',
+                                    401: 'Unauthorized',
+                                    403: 'Not a shop owner'},
+                         request_body=serializers.CoffeeShopPutSerializer(many=True))
+    def bulk_update(self, request):
+        if not isinstance(request.data, list) or len(request.data) > self.bulk_max_items:
+            return Response('Expected a list of at most %d shops' % self.bulk_max_items,
+                            status=400)
+        with transaction.atomic():
+            shops, errors = get_bulk_instances(self.queryset.select_for_update(),
+                                               request.data)
+            if any(errors):
+                return Response(errors, status=400)
+            for shop in shops:
+                self.check_object_permissions(request, shop)
+            serializer = self.serializer_class(shops, data=request.data, many=True,
+                                               partial=True)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=400)
+            serializer.save()
+            search.index_objects('shop', shops)
+            responses.invalidate_shops([shop.id for shop in shops])
+        return Response(serializer.data, status=200)
+
 
 class AuthViewSet(viewsets.ModelViewSet):
     queryset = models.CoffeeDrinker.objects.all()
@@ -103,50 +297,144 @@ class AuthViewSet(viewsets.ModelViewSet):
         if not serializer.is_valid():
             return Response(serializer.errors, status=400)
         user = serializer.save()
-        token = RefreshToken.for_user(user)
-        return Response({'refresh': str(token),
-                         'access': str(token.access_token)}, status=201)
+        return Response(authentication.get_tokens(user), status=201)
     
     @swagger_auto_schema(responses={200: serializers.TokenSerializer,
                                     400: 'Username or password not provided',
                                     401: 'Wrong password',
-                                    404: 'User not found'})
+                                    404: 'User not found',
+                                    429: 'Too many failed logins, see Retry-After'})
     def login(self, request):
         if 'username' not in list(request.data) or 'password' not in list(request.data):
             return Response('Username or password not provided', status=400)
-        user = get_object_or_404(self.queryset, username=request.data['username'])
-        if not check_password(request.data['password'], user.password):
+        username = str(request.data['username'])
+        ip = throttling.get_client_ip(request)
+        retry_after = throttling.get_retry_after(username, ip)
+        if retry_after:
+            return Response('Too many failed logins', status=429,
+                            headers={'Retry-After': str(retry_after)})
+        user = self.queryset.filter(username=username).first()
+        if user is None:
+            throttling.record_failure(username, ip)
+            raise Http404
+        # Saves a rehash when the stored one is not of the current policy
+        if not user.check_password(request.data['password']):
+            throttling.record_failure(username, ip)
             return Response('Wrong password', status=401)
-        token = RefreshToken.for_user(user)
-        return Response({'refresh': str(token),
-                         'access': str(token.access_token)})
+        throttling.reset(username)
+        return Response(authentication.get_tokens(user))
     
     @swagger_auto_schema(responses={200: serializers.TokenSerializer,
-                                    400: 'Invalid or expired token'},
+                                    400: 'Invalid, expired or already used token'},
+                         operation_description='The refresh token is replaced, '
+                                               'it can only be used once',
                          request_body=serializers.RefreshTokenSerializer)
     def refresh(self, request):
         try:
             token = RefreshToken(request.data['refresh'])
-        except TokenError:
+        except (KeyError, TokenError):
             return Response('Invalid or expired token', status=400)
+        if revocations.rotate(token) is None:
+            return Response('Token already used', status=400)
 
         return Response({'refresh': str(token),
                          'access': str(token.access_token)}, status=200)
 
+    @swagger_auto_schema(responses={200: 'Logged out',
+                                    400: 'Invalid or expired token'},
+                         operation_description='Revokes the refresh token and the '
+                                               'access token of the request',
+                         request_body=serializers.RefreshTokenSerializer)
+    def logout(self, request):
+        try:
+            token = RefreshToken(request.data['refresh'])
+        except (KeyError, TokenError):
+            return Response('Invalid or expired token', status=400)
+        revocations.revoke(token)
+        if request.auth is not None:
+            revocations.revoke(request.auth)
+        return Response('Logged out', status=200)
+
+
+class DescriptorViewSet(viewsets.ViewSet):
+    def tree_response(self, request, tree, data):
+        etag = quote_etag(tree['etag'])
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = Response(data)
+        response['ETag'] = etag
+        return response
+
+    @swagger_auto_schema(responses={200: serializers.DescriptorTreeSerializer(many=True),
+                                    304: 'Not modified'})
+    def tree(self, request):
+        tree = descriptors.get_tree()
+        return self.tree_response(request, tree, tree['roots'])
+
+    descriptor_id = openapi.Parameter('id', openapi.IN_QUERY,
+                                      description="Id of the subtree root",
+                                      type=openapi.TYPE_INTEGER)
+    @swagger_auto_schema(responses={200: serializers.DescriptorTreeSerializer,
+                                    304: 'Not modified',
+                                    400: 'Id not provided or invalid',
+                                    404: 'Descriptor not found'},
+                         manual_parameters=[descriptor_id])
+    def subtree(self, request):
+        id = request.GET.get('id')
+        if not id or not id.isdigit():
+            return Response('Id not provided or invalid', status=400)
+        tree = descriptors.get_tree()
+        if int(id) not in tree['nodes']:
+            return Response('Descriptor not found', status=404)
+        return self.tree_response(request, tree, tree['nodes'][int(id)])
+
 
 class CoffeeDrinkViewSet(viewsets.ModelViewSet):
     queryset = models.CoffeeDrink.objects.all()
     serializer_class = serializers.CoffeeDrinkSerializer
     put_serializer_class = serializers.CoffeeDrinkPutSerializer
     parser_classes = (FormParser, MultiPartParser, JSONParser)
+    pagination_class = paginators.CoffeeShopPaginator
+    pagination_mode = 'page'
+    filter_backends = [DjangoFilterBackend, rest_framework.filters.OrderingFilter]
+    filterset_class = filters.CoffeeDrinkFilterSet
+    # Only orderings an index can serve, see CoffeeDrink.Meta.indexes
+    ordering_fields = ['id', 'price', 'volume', 'price_per_ml']
+    ordering = ['id']
+    owner_actions = ['create', 'update', 'upload', 'bulk_create', 'bulk_update']
+    bulk_max_items = 1000
+
+    def get_permissions(self):
+        if self.action in self.owner_actions:
+            return [permissions.IsShopOwner()]
+        return super().get_permissions()
+
+    @swagger_auto_schema(responses={200: serializers.CoffeeDrinkSerializer(many=True),
+                                    400: 'Invalid filter values'},
+                         operation_description='Ordering by price_per_ml leaves out '
+                                               'drinks without a volume',
+                         manual_parameters=pagination_parameters)
+    def list(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
+        if any(field.lstrip('-') == 'price_per_ml' for field in queryset.query.order_by):
+            queryset = queryset.filter(price_per_ml__isnull=False)
+        paginator = paginators.get_paginator(request, self)
+        result_page = paginator.paginate_queryset(queryset, request)
+        serializer = self.serializer_class(result_page, many=True,
+                                           context={'request': request})
+
+        return paginator.get_paginated_response(serializer.data)
 
     drink_id = openapi.Parameter('id', openapi.IN_QUERY, 
                                  description="Id of a drink to get details of", 
                                  type=openapi.TYPE_INTEGER)
     @swagger_auto_schema(responses={200: serializers.CoffeeDrinkerSerializer,
+                                    304: 'Not modified',
                                     400: 'Id not provided or invalid',
                                     404: 'Invalid drink id'},
                          manual_parameters=[drink_id])
+    @responses.cached('drink', get_scopes('drink'))
+    @responses.conditional(drink_validators)
     def get(self, request):
         id = request.GET.get('id')
         if not id or not str(id).isdigit():
@@ -158,108 +446,229 @@ class CoffeeDrinkViewSet(viewsets.ModelViewSet):
 
     @swagger_auto_schema(responses={201: serializers.CoffeeDrinkerSerializer,
                                     400: 'Invalid drink data',
-                                    401: 'Unauthorized or dont have the permission',
+                                    401: 'Unauthorized',
+                                    403: 'Not a shop owner',
                                     415: 'Invalid parameters provided'},
                          request_body=serializers.CoffeeDrinkSerializer)
     def create(self, request):
-        user = request.user
-        if user.is_anonymous or not user.groups.filter(name='shop owner').exists():
-            return Response('Unauthorized or dont have the permission', status=401)
         serializer = self.serializer_class(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=400)
+        self.check_object_permissions(request, serializer.validated_data['shop'])
         serializer.save()
         return Response(serializer.data, status=201)
 
     @swagger_auto_schema(responses={200: serializers.CoffeeDrinkSerializer,
                                     400: 'Invalid drink data or drink id',
-                                    401: 'Unauthorized or dont have the permission',
+                                    401: 'Unauthorized',
+                                    403: 'Not a shop owner',
                                     404: 'Drink not found',
                                     415: 'Invalid parameters provided'},
                          request_body=serializers.CoffeeDrinkPutSerializer)
     def update(self, request):
-        user = request.user
-        if user.is_anonymous or not user.groups.filter(name='shop owner').exists():
-            return Response('Unauthorized or dont have the permission', status=401)
         if 'id' not in list(request.data) or not str(request.data['id']).isdigit():
             return Response('No shop id provided', status=400)
         
-        drink = get_object_or_404(self.queryset, id=request.data['id'])
-        serializer = self.serializer_class(drink, data=request.data, partial=True)
-        if not serializer.is_valid():
-            return Response(serializer.errors, status=400)
-        serializer.save()
+        with transaction.atomic():
+            # Locked so its ratings are current, they move with it
+            drink = get_object_or_404(self.queryset.select_related('shop').select_for_update(),
+                                      id=request.data['id'])
+            self.check_object_permissions(request, drink)
+            serializer = self.serializer_class(drink, data=request.data, partial=True)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=400)
+            shop_id = drink.shop_id
+            if 'shop' in serializer.validated_data:
+                self.check_object_permissions(request, serializer.validated_data['shop'])
+                responses.invalidate_shops([drink.shop_id])
+            serializer.save()
+            aggregates.move_drinks([(drink, shop_id, drink.shop_id)])
         return Response(serializer.data, status=200)
 
+    @swagger_auto_schema(responses={200: serializers.FlavorProfileSerializer,
+                                    400: 'Id not provided or invalid',
+                                    404: 'Invalid drink id'},
+                         manual_parameters=[drink_id])
+    def flavor(self, request):
+        id = request.GET.get('id')
+        if not id or not str(id).isdigit():
+            return Response('Id not provided or invalid', status=400)
+        profile = models.FlavorProfile.objects.filter(drink_id=id).first()
+        if profile is None:
+            drink = get_object_or_404(self.queryset, id=id)
+            profile = models.FlavorProfile(drink=drink)
+        return Response(serializers.FlavorProfileSerializer(profile).data)
+
+    search_parameters = [
+        openapi.Parameter('descriptor', openapi.IN_QUERY,
+                          description='Comma separated descriptor ids, '
+                                      'their descendants match too',
+                          type=openapi.TYPE_STRING, required=True),
+        openapi.Parameter('min_intensity', openapi.IN_QUERY,
+                          description='Only count mentions with at least this intensity',
+                          type=openapi.TYPE_INTEGER),
+    ]
+    @swagger_auto_schema(responses={200: serializers.DrinkSearchSerializer(many=True),
+                                    400: 'Invalid descriptor ids or intensity'},
+                         manual_parameters=search_parameters)
+    def search(self, request):
+        descriptor_ids = request.GET.get('descriptor', '').split(',')
+        if not all(id.isdigit() for id in descriptor_ids):
+            return Response('Invalid descriptor ids', status=400)
+        min_intensity = request.GET.get('min_intensity')
+        if min_intensity is not None and not min_intensity.isdigit():
+            return Response('Intensity is not a number', status=400)
+
+        ranking = descriptors.search_drinks([int(id) for id in descriptor_ids],
+                                            min_intensity and int(min_intensity))
+        paginator = paginators.CoffeeShopPaginator()
+        result_page = paginator.paginate_queryset(ranking, request)
+        drinks = self.queryset.in_bulk([row['drink_id'] for row in result_page])
+        for row in result_page:
+            drinks[row['drink_id']].mentions = row['mentions']
+        serializer = serializers.DrinkSearchSerializer(
+            [drinks[row['drink_id']] for row in result_page], many=True)
+
+        return paginator.get_paginated_response(serializer.data)
+
+    upload_parameters = [
+        openapi.Parameter('id', openapi.IN_QUERY,
+                          description='Id of the drink, checked before the photo is received',
+                          type=openapi.TYPE_INTEGER),
+    ]
     @swagger_auto_schema(responses={200: serializers.CoffeeDrinkSerializer,
                                     400: 'Invalid drink id',
-                                    401: 'Unauthorized or dont have the permission',
-                                    404: 'Drink not found'},
-                         operation_description='Upload image with a key "photo"',
+                                    401: 'Unauthorized',
+                                    403: 'Not a shop owner',
+                                    404: 'Drink not found',
+                                    413: 'Photo too large',
+                                    415: 'Not a JPEG, PNG, GIF or WebP image'},
+                         operation_description='Upload image with a key "photo". '
+                                               'Variants are made by the job of X-Job-Id',
+                         manual_parameters=upload_parameters,
                          request_body=serializers.ImageSerializer)
     def upload(self, request):
-        user = request.user
-        if user.is_anonymous or not user.groups.filter(name='shop owner').exists():
-            return Response('Unauthorized or dont have the permission', status=401)
-        if 'id' not in list(request.data) or not str(request.data['id']).isdigit():
+        uploads.handle_photo(request, models.CoffeeDrink)
+        # Only from the query, so the drink is checked before the body is read
+        drink_id = request.GET.get('id')
+        if drink_id is None or not drink_id.isdigit():
             return Response('No shop id provided', status=400)
 
-        shop = get_object_or_404(self.queryset, id=request.data['id'])
+        drink = get_object_or_404(self.queryset.select_related('shop'), id=drink_id)
+        self.check_object_permissions(request, drink)
         photo = request.FILES.get('photo', None)
 
         serializer = self.serializer_class()
-        shop = serializer.upload(shop, photo)
-        data = self.serializer_class(shop).data
-        return Response(data, status=200)
+        with transaction.atomic():
+            drink = serializer.upload(drink, photo)
+            job = images.schedule(drink, request.user.id)
+        data = self.serializer_class(drink).data
+        return set_job(Response(data, status=200), job)
+
+    @swagger_auto_schema(responses={201: serializers.CoffeeDrinkSerializer(many=True),
+                                    400: 'Invalid drink data, errors are reported per item',
+                                    401: 'Unauthorized',
+                                    403: 'Not a shop owner'},
+                         request_body=serializers.CoffeeDrinkSerializer(many=True))
+    def bulk_create(self, request):
+        shops = get_bulk_related(models.CoffeeShop, request.data, 'shop')
+        serializer = self.serializer_class(data=request.data, many=True,
+                                           max_length=self.bulk_max_items,
+                                           context={'prefetched': {'shop': shops}})
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=400)
+        for shop in {item['shop'] for item in serializer.validated_data}:
+            self.check_object_permissions(request, shop)
+        with transaction.atomic():
+            drinks = serializer.save()
+            search.index_objects('drink', drinks)
+            responses.invalidate_drinks(drinks)
+        return Response(serializer.data, status=201)
+
+    @swagger_auto_schema(responses={200: serializers.CoffeeDrinkSerializer(many=True),
+                                    400: 'Invalid drink data, errors are reported per item',
+                                    401: 'Unauthorized',
+                                    403: 'Not a shop owner'},
+                         request_body=serializers.CoffeeDrinkPutSerializer(many=True))
+    def bulk_update(self, request):
+        if not isinstance(request.data, list) or len(request.data) > self.bulk_max_items:
+            return Response('Expected a list of at most %d drinks' % self.bulk_max_items,
+                            status=400)
+        shops = get_bulk_related(models.CoffeeShop, request.data, 'shop')
+        with transaction.atomic():
+            queryset = self.queryset.select_related('shop').select_for_update()
+            drinks, errors = get_bulk_instances(queryset, request.data)
+            if any(errors):
+                return Response(errors, status=400)
+            serializer = self.serializer_class(drinks, data=request.data, many=True,
+                                               partial=True,
+                                               context={'prefetched': {'shop': shops}})
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=400)
+            for drink in drinks:
+                self.check_object_permissions(request, drink)
+            for shop in {item['shop'] for item in serializer.validated_data
+                         if 'shop' in item}:
+                self.check_object_permissions(request, shop)
+            # Shops the drinks move away from list them too
+            responses.invalidate_shops({drink.shop_id for drink in drinks})
+            shop_ids = [drink.shop_id for drink in drinks]
+            serializer.save()
+            aggregates.move_drinks([(drink, shop_id, drink.shop_id)
+                                    for drink, shop_id in zip(drinks, shop_ids)])
+            search.index_objects('drink', drinks)
+            responses.invalidate_drinks(drinks)
+        return Response(serializer.data, status=200)
 
 
 class ReviewViewSet(viewsets.ModelViewSet):
-    queryset = models.Review.objects.all()
+    queryset = models.Review.objects.order_by('id')
     serializer_class = serializers.ReviewSerializer
     put_serializer_class = serializers.ReviewSerializer
-    paginator = paginators.CoffeeShopPaginator()
+    pagination_class = paginators.CoffeeShopPaginator
+    pagination_mode = 'page'
 
-    review_id = openapi.Parameter('id', openapi.IN_QUERY, 
-                                 description="Id of a review to get details of", 
+    drink_id = openapi.Parameter('id', openapi.IN_QUERY, 
+                                 description="Id of a drink to get reviews of", 
                                  type=openapi.TYPE_INTEGER)
     @swagger_auto_schema(responses={200: serializers.ReviewSerializer,
+                                    304: 'Not modified',
                                     400: 'Invalid drink id'},
-                         manual_parameters=[review_id])
+                         manual_parameters=[drink_id, *pagination_parameters])
+    @responses.conditional(review_validators)
     def list(self, request):
         coffeedrink_id = request.GET.get('id')
         if not coffeedrink_id:
             return Response('No drink id provided', status=400)
         if not coffeedrink_id.isdigit():
             return Response('Drink id is not a number', status=400)
-        reviews = self.queryset.filter(id=coffeedrink_id)
-        drinks_data = self.serializer_class(reviews, many=True).data
-
-        result_page = self.paginator.paginate_queryset(reviews, request)
+        reviews = self.queryset.filter(drink_id=coffeedrink_id).select_related('author')
+        paginator = paginators.get_paginator(request, self)
+        result_page = paginator.paginate_queryset(reviews, request)
         serializer = self.serializer_class(result_page, many=True,
                                            context={'request': request})
 
-        return self.paginator.get_paginated_response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
 
     @swagger_auto_schema(responses={200: serializers.ReviewSerializer,
                                     400: 'Invalid review data or drink id',
-                                    401: 'Unauthorized',
-                                    404: 'Drink not found'},
+                                    401: 'Unauthorized'},
                          request_body=serializers.ReviewSerializer)
     def create(self, request):
         user = request.user
         if user.is_anonymous:
             return Response('Unauthorized', status=401)
-        if 'drink' not in list(request.data) or not str(request.data['drink']).isdigit():
-            return Response('No drink id provided', status=400)
-        drink = get_object_or_404(models.CoffeeDrink.objects.all(), 
-                                  id=request.data['drink'])
         serializer = self.serializer_class(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=400)
-        instance = serializer.save()
-        drinker = models.CoffeeDrinker.objects.get(id=user.id)
-        serializer.set_author(instance, drinker)
-        return Response(serializer.data, status=201)
+        with transaction.atomic():
+            # The author goes in with the insert, the review is written once
+            instance = serializer.save(author_id=user.id)
+            aggregates.update_ratings([(instance.drink_id, instance.overall_rating, 1)])
+            # Descriptor index and flavor profile
+            job = jobs.enqueue('reviews.changed', [instance.id],
+                               [tasks.review_change(instance, 1)], owner_id=user.id)
+        return set_job(Response(serializer.data, status=201), job)
 
     @swagger_auto_schema(responses={200: serializers.ReviewSerializer,
                                     400: 'Invalid review data or review id',
@@ -272,15 +681,23 @@ class ReviewViewSet(viewsets.ModelViewSet):
             return Response('Unauthorized', status=401)
         if 'id' not in list(request.data) or not str(request.data['id']).isdigit():
             return Response('No review id provided', status=400)
-        review = get_object_or_404(self.queryset, id=request.data['id'])
-        if review.author.id != user.id:
-            return Response('Not the review author', status=401)
-
-        serializer = self.serializer_class(review, data=request.data, partial=True)
-        if not serializer.is_valid():
-            return Response(serializer.errors, status=400)
-        serializer.save()
-        return Response(serializer.data, status=200)
+        with transaction.atomic():
+            review = get_object_or_404(self.queryset.select_for_update(),
+                                       id=request.data['id'])
+            if review.author_id != user.id:
+                return Response('Not the review author', status=401)
+
+            serializer = self.serializer_class(review, data=request.data, partial=True)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=400)
+            removed = tasks.review_change(review, -1)
+            rating = (review.drink_id, review.overall_rating)
+            review = serializer.save()
+            aggregates.update_ratings([(*rating, -1),
+                                       (review.drink_id, review.overall_rating, 1)])
+            job = jobs.enqueue('reviews.changed', [review.id],
+                               [removed, tasks.review_change(review, 1)], owner_id=user.id)
+        return set_job(Response(serializer.data, status=200), job)
 
 
 class UsersMeViewSet(viewsets.ModelViewSet):
@@ -290,13 +707,14 @@ class UsersMeViewSet(viewsets.ModelViewSet):
     parser_classes = (FormParser, MultiPartParser, JSONParser)
 
     @swagger_auto_schema(responses={200: serializers.CoffeeDrinkerSerializer,
+                                    304: 'Not modified',
                                     401: 'Unauthorized'})
+    @responses.conditional(drinker_validators)
     def get(self, request):
         user = request.user
         if user.is_anonymous:
             return Response('Unauthorized', status=401)
-        drinker = self.queryset.get(id=user.id)
-        serializer = self.serializer_class(drinker)
+        serializer = self.serializer_class(user.drinker)
         return Response(serializer.data)
 
     @swagger_auto_schema(responses={200: serializers.CoffeeDrinkerSerializer,
@@ -307,8 +725,7 @@ class UsersMeViewSet(viewsets.ModelViewSet):
         user = request.user
         if user.is_anonymous:
             return Response('Unauthorized', status=401)
-        drinker = self.queryset.get(id=user.id)
-        serializer = self.serializer_class(request.user, data=request.data, partial=True)
+        serializer = self.serializer_class(user.drinker, data=request.data, partial=True)
         if not serializer.is_valid():
             return Response(serializer.errors, status=400)
         serializer.save()
@@ -320,23 +737,170 @@ class UsersMeViewSet(viewsets.ModelViewSet):
         user = request.user
         if user.is_anonymous:
             return Response('Unauthorized', status=401)
-        drinker = self.queryset.get(id=user.id)
-        drinker.delete()
+        user.drinker.delete()
         return Response('Successfully deleted user', status=200)
 
     @swagger_auto_schema(responses={200: serializers.CoffeeDrinkerSerializer,
-                                    401: 'Unauthorized'},
+                                    401: 'Unauthorized',
+                                    413: 'Photo too large',
+                                    415: 'Not a JPEG, PNG, GIF or WebP image'},
+                         operation_description='Variants are made by the job of X-Job-Id',
                          request_body=serializers.ImageSerializer)
     def upload(self, request):
         user = request.user
         if user.is_anonymous:
             return Response('Unauthorized', status=401)
-        drinker = self.queryset.get(id=user.id)
+        uploads.handle_photo(request, models.CoffeeDrinker)
+        drinker = user.drinker
         serializer = self.serializer_class()
         photo = request.FILES.get('photo', None)
 
-        drinker = serializer.upload(drinker, photo)
+        with transaction.atomic():
+            drinker = serializer.upload(drinker, photo)
+            job = images.schedule(drinker, user.id)
         data = self.serializer_class(drinker).data
-        return Response(data, status=200)
-    
+        return set_job(Response(data, status=200), job)
+
+
+class OwnersMeViewSet(viewsets.ModelViewSet):
+    queryset = models.CoffeeShop.objects.prefetch_related(
+        Prefetch('coffeedrink_set', queryset=models.CoffeeDrink.objects.order_by('id')))
+    serializer_class = serializers.CoffeeShopSerializer
+    pagination_class = paginators.CoffeeShopPaginator
+    pagination_mode = 'page'
+    permission_classes = [permissions.IsShopOwner]
 
+    @swagger_auto_schema(responses={200: serializers.CoffeeShopSerializer(many=True),
+                                    401: 'Unauthorized',
+                                    403: 'Not a shop owner'},
+                         manual_parameters=pagination_parameters)
+    def shops(self, request):
+        shops = self.queryset.filter(owner_id=request.user.id).order_by('id')
+        paginator = paginators.get_paginator(request, self)
+        result_page = paginator.paginate_queryset(shops, request)
+        serializer = self.serializer_class(result_page, many=True,
+                                           context={'request': request})
+
+        return paginator.get_paginated_response(serializer.data)
+
+
+class ExportViewSet(viewsets.ViewSet):
+    permission_classes = [IsAdminUser]
+    content_types = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+    export_parameters = [
+        openapi.Parameter('output', openapi.IN_QUERY, description='csv (default) or ndjson',
+                          type=openapi.TYPE_STRING, enum=exports.FORMATS),
+        openapi.Parameter('since_id', openapi.IN_QUERY,
+                          description='Only rows with a greater id',
+                          type=openapi.TYPE_INTEGER),
+        openapi.Parameter('since', openapi.IN_QUERY,
+                          description='Only rows created or updated after this ISO 8601 time',
+                          type=openapi.TYPE_STRING, format=openapi.FORMAT_DATETIME),
+        openapi.Parameter('gzip', openapi.IN_QUERY, description='Gzip the dump',
+                          type=openapi.TYPE_BOOLEAN),
+    ]
+    @swagger_auto_schema(responses={200: 'Streamed dump',
+                                    400: 'Invalid output format, since_id or since',
+                                    401: 'Unauthorized',
+                                    403: 'Not a staff member',
+                                    404: 'Unknown export'},
+                         manual_parameters=export_parameters)
+    def export(self, request, kind):
+        if kind not in exports.EXPORTS:
+            raise Http404
+        output = request.GET.get('output', 'csv')
+        if output not in exports.FORMATS:
+            return Response('Invalid output format', status=400)
+        since_id = request.GET.get('since_id')
+        if since_id is not None and not since_id.isdigit():
+            return Response('since_id is not a number', status=400)
+        since = request.GET.get('since')
+        if since is not None:
+            try:
+                since = exports.parse_since(since)
+            except ValueError:
+                return Response('since is not an ISO 8601 time', status=400)
+        gzip = request.GET.get('gzip') in ('1', 'true')
+
+        filename = '%s.%s' % (kind, output)
+        response = StreamingHttpResponse(
+            exports.export(kind, output, since_id and int(since_id), gzip, since=since),
+            content_type='application/gzip' if gzip else self.content_types[output])
+        if gzip:
+            filename += '.gz'
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        return response
+
+
+class JobViewSet(viewsets.ViewSet):
+    queryset = models.Job.objects.order_by('-id')
+    serializer_class = serializers.JobSerializer
+    pagination_mode = 'page'
+
+    job_parameters = [
+        openapi.Parameter('id', openapi.IN_QUERY, description='Id of a job to get',
+                          type=openapi.TYPE_INTEGER),
+        openapi.Parameter('status', openapi.IN_QUERY, description='Only jobs with the status',
+                          type=openapi.TYPE_STRING, enum=list(dict(models.Job.STATUSES))),
+    ]
+    @swagger_auto_schema(responses={200: serializers.JobSerializer(many=True),
+                                    400: 'Invalid job id or status',
+                                    401: 'Unauthorized',
+                                    404: 'Not found'},
+                         operation_description='Jobs started by the user, all of them for staff',
+                         manual_parameters=[*job_parameters, *pagination_parameters])
+    def list(self, request):
+        user = request.user
+        if user.is_anonymous:
+            return Response('Unauthorized', status=401)
+        jobs = self.queryset
+        if not user.is_staff:
+            jobs = jobs.filter(owner_id=user.id)
+
+        job_id = request.GET.get('id')
+        if job_id is not None:
+            if not job_id.isdigit():
+                return Response('Job id is not a number', status=400)
+            job = get_object_or_404(jobs, id=job_id)
+            return Response(self.serializer_class(job).data)
+
+        job_status = request.GET.get('status')
+        if job_status is not None:
+            if job_status not in dict(models.Job.STATUSES):
+                return Response('Invalid status', status=400)
+            jobs = jobs.filter(status=job_status)
+        paginator = paginators.get_paginator(request, self)
+        result_page = paginator.paginate_queryset(jobs, request)
+        serializer = self.serializer_class(result_page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+
+class SearchViewSet(viewsets.ViewSet):
+    max_limit = 50
+
+    search_parameters = [
+        openapi.Parameter('q', openapi.IN_QUERY, description='Words to search for, '
+                          'each matches as a prefix and tolerates typos',
+                          type=openapi.TYPE_STRING, required=True),
+        openapi.Parameter('kind', openapi.IN_QUERY,
+                          description='Comma separated kinds to search, all by default',
+                          type=openapi.TYPE_STRING),
+        openapi.Parameter('limit', openapi.IN_QUERY,
+                          description='Number of results, at most %d' % max_limit,
+                          type=openapi.TYPE_INTEGER),
+    ]
+    @swagger_auto_schema(responses={200: serializers.SearchResultSerializer(many=True),
+                                    400: 'Invalid kind or limit'},
+                         manual_parameters=search_parameters)
+    def search(self, request):
+        kinds = None
+        if request.GET.get('kind'):
+            kinds = request.GET['kind'].split(',')
+            if not set(kinds) <= set(search.DOCUMENTS):
+                return Response('Invalid kind', status=400)
+        limit = request.GET.get('limit', '20')
+        if not limit.isdigit() or not 0 < int(limit) <= self.max_limit:
+            return Response('Invalid limit', status=400)
+        results = search.search(request.GET.get('q', ''), kinds, int(limit))
+        return Response(serializers.SearchResultSerializer(results, many=True).data)
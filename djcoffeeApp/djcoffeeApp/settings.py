@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -51,7 +52,9 @@ INSTALLED_APPS = [
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.BasePagination',
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # Users come from the token and the roles cache, see
+        # coffeestores/authentication.py
+        'coffeestores.authentication.StatelessJWTAuthentication',
     ],
     'DEFAULT_PARSER_CLASSES': [
         'rest_framework.parsers.JSONParser',
@@ -109,6 +112,53 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+# Every process keeps its own local memory cache, share one between them in
+# production, e.g. REDIS_CACHE_URL=redis://127.0.0.1:6379/1
+if os.environ.get('REDIS_CACHE_URL'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['REDIS_CACHE_URL'],
+    }
+# Cache alias of the shop and drink responses
+RESPONSE_CACHE = 'default'
+
+# Background jobs, run by manage.py run_workers. Eager runs them inside the
+# request that enqueues them, the test runner turns it on
+JOBS_EAGER = False
+TEST_RUNNER = 'coffeestores.runner.TestRunner'
+
+
+# Revoked token ids are checked against an in-process bloom filter first,
+# which picks up revocations of other processes every REFRESH seconds
+REVOKED_TOKENS_BLOOM = True
+REVOKED_TOKENS_BLOOM_REFRESH = 30
+
+# Password hashing. New passwords use the first hasher, hashes of the
+# others or with fewer iterations are upgraded on the next successful login.
+# Django's own work factor, login bursts are kept off the CPU by the login
+# throttling below rather than by cheaper hashes
+PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 600000))
+PASSWORD_HASHERS = [
+    'coffeestores.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
+# Failed logins per username and per client address in a window, further
+# attempts are refused without checking the password
+LOGIN_FAILURES_PER_USERNAME = 5
+LOGIN_FAILURES_PER_IP = 50
+LOGIN_FAILURE_WINDOW = 15 * 60
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -146,6 +196,17 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Uploads are stored once per content, see coffeestores/storage.py
+STORAGES = {
+    'default': {'BACKEND': 'coffeestores.storage.ContentAddressedStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+# Photo uploads larger than this are rejected while streaming, see
+# coffeestores/uploads.py
+PHOTO_UPLOAD_MAX_BYTES = 10 * 1024 * 1024
+PHOTO_UPLOAD_MAX_PIXELS = 40 * 1000 * 1000
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -31,16 +31,36 @@ urlpatterns = [
                                                             'post': 'create',
                                                             'put': 'update'}), 
          name='shops'),
+    path('shops/nearby', views.CoffeeShopViewSet.as_view(actions={'get': 'nearby'}),
+         name='shops-nearby'),
+    path('shops/bulk', views.CoffeeShopViewSet.as_view(actions={'post': 'bulk_create',
+                                                                'put': 'bulk_update'}),
+         name='shops-bulk'),
     path('auth/register', views.AuthViewSet.as_view(actions={'post': 'register'}), 
          name='auth-register'),
     path('auth/login', views.AuthViewSet.as_view(actions={'post': 'login'}), 
          name='auth-login'),
     path('auth/refresh', views.AuthViewSet.as_view(actions={'post': 'refresh'}), 
          name='auth-refresh'),
+    path('auth/logout', views.AuthViewSet.as_view(actions={'post': 'logout'}),
+         name='auth-logout'),
+    path('descriptors/', views.DescriptorViewSet.as_view(actions={'get': 'tree'}),
+         name='descriptors'),
+    path('descriptors/subtree', views.DescriptorViewSet.as_view(actions={'get': 'subtree'}),
+         name='descriptors-subtree'),
     path('drink/', views.CoffeeDrinkViewSet.as_view(actions={'get': 'get',
                                                              'post': 'create',
                                                              'put': 'update'}),
          name='drink'),
+    path('drink/bulk', views.CoffeeDrinkViewSet.as_view(actions={'post': 'bulk_create',
+                                                                 'put': 'bulk_update'}),
+         name='drink-bulk'),
+    path('drinks/', views.CoffeeDrinkViewSet.as_view(actions={'get': 'list'}),
+         name='drinks'),
+    path('drinks/search', views.CoffeeDrinkViewSet.as_view(actions={'get': 'search'}),
+         name='drinks-search'),
+    path('drink/flavor', views.CoffeeDrinkViewSet.as_view(actions={'get': 'flavor'}),
+         name='drink-flavor'),
     path('drink/upload', views.CoffeeDrinkViewSet.as_view(actions={'post': 'upload'}),
          name='drink-upload'),
     path('reviews/', views.ReviewViewSet.as_view(actions={'get': 'list',
@@ -53,6 +73,12 @@ urlpatterns = [
          name='users-me'),
     path('users/me/upload', views.UsersMeViewSet.as_view(actions={'post': 'upload'}),
          name='users-me-upload'),
+    path('owners/me/shops', views.OwnersMeViewSet.as_view(actions={'get': 'shops'}),
+         name='owners-me-shops'),
+    path('export/<str:kind>', views.ExportViewSet.as_view(actions={'get': 'export'}),
+         name='export'),
+    path('jobs', views.JobViewSet.as_view(actions={'get': 'list'}), name='jobs'),
+    path('search', views.SearchViewSet.as_view(actions={'get': 'search'}), name='search'),
     path('admin/', admin.site.urls),
 ]
 